@@ -42,33 +42,33 @@
 
 
 import logging
-import time
 
+from saintBioutils.genbank.rate_limit import get_entrez_policy
 
-def entrez_retry(retries, entrez_func, *func_args, **func_kwargs):
+
+def entrez_retry(retries, entrez_func, *func_args, policy=None, **func_kwargs):
     """Call to NCBI using Entrez.
+
+    Calls are rate limited and failed calls retried with exponential backoff, according to the
+    retry policy.
+
     :param retries: int, maximum number of retries excepted if network error encountered
     :param entrez_func: function, call method to NCBI
     :param *func_args: tuple, arguments passed to Entrez function
+    :param policy: RetryPolicy, defaults to the process-wide Entrez policy
     :param ** func_kwargs: dictionary, keyword arguments passed to Entrez function
     Returns record.
     """
     logger = logging.getLogger(__name__)
-    record, retries, tries = None, retries, 0
 
-    while record is None and tries < retries:
-        try:
-            record = entrez_func(*func_args, **func_kwargs)
+    if policy is None:
+        policy = get_entrez_policy()
+
+    try:
+        record = policy.run(entrez_func, func_args, func_kwargs, retries=retries)
 
-        except IOError:
-            # log retry attempt
-            if tries < retries:
-                logger.warning(
-                    f"Network error encountered during try no.{tries}.\nRetrying in 10s",
-                    exc_info=1,
-                )
-                time.sleep(10)
-            tries += 1
+    except policy.retry_on:
+        record = None
 
     if record is None:
         logger.error(
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) University of St Andrews 2020-2021
+# (c) University of Strathclyde 2020-2021
+# (c) James Hutton Institute 2020-2021
+#
+# Author:
+# Emma E. M. Hobbs
+#
+# Contact
+# eemh1@st-andrews.ac.uk
+#
+# Emma E. M. Hobbs,
+# Biomolecular Sciences Building,
+# University of St Andrews,
+# North Haugh Campus,
+# St Andrews,
+# KY16 9ST
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Persistent on-disk cache of NCBI Assembly accession resolutions"""
+
+
+import logging
+import time
+
+from saintBioutils.utilities.store import SQLiteStore
+
+
+class AssemblyCache(SQLiteStore):
+    """SQLite-backed cache of assembly accession to assembly name and FTP path.
+
+    Lets compile_url() skip the Entrez esearch and esummary calls for assemblies that have
+    already been resolved.
+    """
+
+    tables = (
+        "CREATE TABLE IF NOT EXISTS assemblies ("
+        "accession TEXT PRIMARY KEY, "
+        "assembly_name TEXT NOT NULL, "
+        "ftp_path TEXT, "
+        "cached_at REAL NOT NULL)",
+    )
+
+    def __init__(self, db_path, ttl=None):
+        """Open (and create if needed) the cache.
+
+        :param db_path: Path, path to the SQLite database file
+        :param ttl: int or float, number of seconds a cached entry is valid for,
+            entries never expire if None
+        """
+        super().__init__(db_path)
+        self.ttl = ttl
+
+    def get(self, accession):
+        """Retrieve the cached resolution of an assembly accession.
+
+        :param accession: str, assembly accession
+
+        Return dict {'assembly_name': str, 'ftp_path': str or None}, or None if the accession
+        is not cached or its entry has expired.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT assembly_name, ftp_path, cached_at FROM assemblies WHERE accession = ?",
+                (accession,),
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        assembly_name, ftp_path, cached_at = row
+        if self.ttl is not None and time.time() - cached_at > self.ttl:
+            return None
+
+        return {'assembly_name': assembly_name, 'ftp_path': ftp_path}
+
+    def set(self, accession, assembly_name, ftp_path=None):
+        """Add or replace the cached resolution of an assembly accession.
+
+        :param accession: str, assembly accession
+        :param assembly_name: str, name of the assembly
+        :param ftp_path: str, path to the assembly directory on the NCBI FTP server
+
+        Return nothing.
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO assemblies VALUES (?, ?, ?, ?)",
+                (accession, assembly_name, ftp_path, time.time()),
+            )
+
+    def invalidate(self, accessions=None):
+        """Remove entries from the cache.
+
+        :param accessions: iterable of str, accessions to remove, all entries are removed if None
+
+        Return int, number of entries removed.
+        """
+        logger = logging.getLogger(__name__)
+
+        with self.lock, self.connection:
+            if accessions is None:
+                cursor = self.connection.execute("DELETE FROM assemblies")
+            else:
+                cursor = self.connection.executemany(
+                    "DELETE FROM assemblies WHERE accession = ?",
+                    ((accession,) for accession in accessions),
+                )
+
+        logger.info(f"Removed {cursor.rowcount} entries from the assembly cache {self.db_path}")
+
+        return cursor.rowcount
+
+    def purge_expired(self):
+        """Remove all expired entries from the cache.
+
+        Return int, number of entries removed.
+        """
+        if self.ttl is None:
+            return 0
+
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                "DELETE FROM assemblies WHERE cached_at < ?", (time.time() - self.ttl,),
+            )
+
+        return cursor.rowcount
@@ -0,0 +1,466 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) University of St Andrews 2020-2021
+# (c) University of Strathclyde 2020-2021
+# (c) James Hutton Institute 2020-2021
+#
+# Author:
+# Emma E. M. Hobbs
+#
+# Contact
+# eemh1@st-andrews.ac.uk
+#
+# Emma E. M. Hobbs,
+# Biomolecular Sciences Building,
+# University of St Andrews,
+# North Haugh Campus,
+# St Andrews,
+# KY16 9ST
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Download genomic assemblies from NCBI using asyncio"""
+
+
+import asyncio
+import functools
+import logging
+import os
+
+from email.message import Message
+from pathlib import Path
+from socket import timeout
+from urllib.error import HTTPError, URLError
+from urllib.parse import urljoin, urlparse
+
+from Bio import Entrez
+from tqdm import tqdm
+
+from saintBioutils.genbank.get_genomes import (
+    NCBI_GENOMES_STEM,
+    build_url,
+    compile_out_path,
+    get_ftp_path,
+)
+from saintBioutils.genbank.rate_limit import get_download_policy, get_entrez_policy
+
+
+TIMEOUT = 45
+
+
+async def async_get_genomic_assemblies(
+    assembly_accessions,
+    outdir=None,
+    suffix="genomic.gbff.gz",
+    max_concurrency=20,
+    cache=None,
+):
+    """Coordinate resolving and downloading many Genomic assemblies concurrently on the event loop.
+
+    :param assembly_accessions: iterable of str, accessions of the Genomic assemblies to download
+    :param outdir: Path, path to dir to write out downloaded assemblies to, else writes to cwd
+    :param suffix: str, suffix of file
+    :param max_concurrency: int, maximum number of downloads, and of Entrez calls resolving
+        accessions, in flight at the same time
+    :param cache: AssemblyCache, cache of resolved assembly names, NCBI is always queried if None
+
+    Return dict {assembly_accession: {'path': Path or None, 'status': str}}
+    """
+    logger = logging.getLogger(__name__)
+
+    assembly_accessions = list(dict.fromkeys(assembly_accessions))
+    semaphore = asyncio.Semaphore(max_concurrency)
+    # bounds the Entrez calls queued in the default executor, separately from the downloads
+    entrez_semaphore = asyncio.BoundedSemaphore(max_concurrency)
+
+    async def get_assembly(accession):
+        try:
+            genbank_url, filestem = await async_compile_url(
+                accession, suffix, cache=cache, semaphore=entrez_semaphore,
+            )
+        except Exception:
+            logger.error(f"Failed to retrieve genomic assembly {accession}", exc_info=1)
+            return accession, {'path': None, 'status': 'failed'}
+
+        out_file_path = compile_out_path(filestem, suffix, outdir)
+        try:
+            status = await async_download_file(
+                genbank_url, out_file_path, accession, "GenBank file", semaphore=semaphore,
+            )
+        except Exception:
+            logger.error(f"Failed to download genomic assembly {accession}", exc_info=1)
+            return accession, {'path': None, 'status': 'failed'}
+
+        if status == "failed":
+            return accession, {'path': None, 'status': status}
+        return accession, {'path': out_file_path, 'status': status}
+
+    results = {}  # {assembly_accession: {'path': Path, 'status': str}}
+    tasks = [asyncio.ensure_future(get_assembly(accession)) for accession in assembly_accessions]
+
+    with tqdm(total=len(tasks), desc="Downloading genomic assemblies") as pbar:
+        for task in asyncio.as_completed(tasks):
+            accession, result = await task
+            results[accession] = result
+            pbar.update(1)
+
+    return results
+
+
+async def async_entrez_retry(
+    retries, entrez_func, *func_args, policy=None, semaphore=None, **func_kwargs,
+):
+    """Call to NCBI using Entrez, without blocking the event loop.
+
+    Entrez calls are blocking, so are run in the event loop's default executor. Calls are rate
+    limited and retried according to the retry policy.
+
+    :param retries: int, maximum number of retries excepted if network error encountered
+    :param entrez_func: function, call method to NCBI
+    :param *func_args: tuple, arguments passed to Entrez function
+    :param policy: RetryPolicy, defaults to the process-wide Entrez policy
+    :param semaphore: asyncio.Semaphore, limits the number of concurrent calls
+    :param ** func_kwargs: dictionary, keyword arguments passed to Entrez function
+    Returns record.
+    """
+    logger = logging.getLogger(__name__)
+
+    if policy is None:
+        policy = get_entrez_policy()
+    if semaphore is None:
+        semaphore = asyncio.Semaphore()  # not shared, so does not limit concurrency
+
+    loop = asyncio.get_running_loop()
+
+    async def call():
+        return await loop.run_in_executor(
+            None, functools.partial(entrez_func, *func_args, **func_kwargs),
+        )
+
+    try:
+        async with semaphore:
+            record = await policy.async_run(call, retries=retries)
+
+    except policy.retry_on:
+        record = None
+
+    if record is None:
+        logger.error(
+            "Network error encountered too many times. Exiting attempt to call to NCBI"
+        )
+        return
+
+    return record
+
+
+async def async_compile_url(
+    accession_number,
+    suffix,
+    ftpstem=NCBI_GENOMES_STEM,
+    cache=None,
+    semaphore=None,
+):
+    """Retrieve URL for downloading the assembly from NCBI, and create filestem of output file path
+
+    :param accession_number: str, asseccion number of genomic assembly
+    :param suffix: str, suffix of file
+    :param ftpstem: str, root of the NCBI genomes directory tree
+    :param cache: AssemblyCache, cache of resolved assembly names, NCBI is always queried if None
+    :param semaphore: asyncio.Semaphore, limits the number of concurrent calls to Entrez
+
+    Raises IOError if NCBI could not be reached, or ValueError if the accession is not in the
+    NCBI Assembly database.
+    Return str, url required for download and filestem for output file path for the downloaded assembly.
+    """
+    if cache is not None:
+        cached = cache.get(accession_number)
+        if cached is not None:
+            return build_url(accession_number, cached['assembly_name'], suffix, ftpstem)
+
+    loop = asyncio.get_running_loop()
+
+    # search for the ID of the record
+    handle = await async_entrez_retry(
+        10,
+        Entrez.esearch,
+        db="Assembly",
+        term=f"{accession_number}[Assembly Accession]",
+        rettype='uilist',
+        semaphore=semaphore,
+    )
+    if handle is None:
+        raise IOError(f"Failed to search the NCBI Assembly database for {accession_number}")
+    with handle:
+        search_record = await loop.run_in_executor(None, Entrez.read, handle)
+
+    if len(search_record['IdList']) == 0:
+        raise ValueError(f"Assembly {accession_number} not found in the NCBI Assembly database")
+
+    # retrieve record for genomic assembly
+    handle = await async_entrez_retry(
+        10,
+        Entrez.esummary,
+        db="assembly",
+        id=search_record['IdList'][0],
+        report="full",
+        semaphore=semaphore,
+    )
+    if handle is None:
+        raise IOError(f"Failed to retrieve the NCBI Assembly summary of {accession_number}")
+    with handle:
+        record = await loop.run_in_executor(None, Entrez.read, handle)
+
+    if len(record["DocumentSummarySet"]["DocumentSummary"]) == 0:
+        raise ValueError(f"No NCBI Assembly summary retrieved for {accession_number}")
+    summary = record["DocumentSummarySet"]["DocumentSummary"][0]
+    assembly_name = summary["AssemblyName"]
+
+    if cache is not None:
+        cache.set(accession_number, assembly_name, get_ftp_path(accession_number, summary))
+
+    return build_url(accession_number, assembly_name, suffix, ftpstem)
+
+
+async def async_download_file(
+    genbank_url,
+    out_file_path,
+    accession_number,
+    file_type,
+    policy=None,
+    semaphore=None,
+):
+    """Download file over HTTP(S) without blocking the event loop.
+
+    As for download_file(), the file is written to a '.part' file that is resumed after an
+    interruption and renamed to the output file path once complete. Writes to disk are run in
+    the event loop's default executor.
+
+    :param genbank_url: str, http(s) url of file to be downloaded
+    :param out_file_path: path, output directory for file to be written to
+    :param accession_number: str, accession number of genome
+    :param file_type: str, denotes in logger file type downloaded
+    :param policy: RetryPolicy, defaults to the process-wide download policy
+    :param semaphore: asyncio.Semaphore, limits the number of concurrent downloads
+    Return str, status of the download: 'downloaded', 'exists' or 'failed'.
+    """
+    logger = logging.getLogger(__name__)
+    out_file_path = Path(out_file_path)
+
+    if out_file_path.exists():
+        logger.warning(f"Output file {out_file_path} exists, not downloading")
+        return "exists"
+
+    if policy is None:
+        policy = get_download_policy()
+    if semaphore is None:
+        semaphore = asyncio.Semaphore()  # not shared, so does not limit concurrency
+
+    part_file_path = out_file_path.with_name(f"{out_file_path.name}.part")
+
+    try:
+        async with semaphore:
+            await policy.async_run(async_fetch_file, (genbank_url, part_file_path))
+    except policy.retry_on:
+        logger.error(
+            f"Failed to download {file_type} for {accession_number}", exc_info=1,
+        )
+        return "failed"
+
+    os.replace(part_file_path, out_file_path)
+
+    return "downloaded"
+
+
+async def async_fetch_file(url, part_file_path):
+    """Download a file to a '.part' file, resuming from the end of the '.part' file if it exists.
+
+    :param url: str, http(s) url of file to be downloaded
+    :param part_file_path: Path, path of the '.part' file
+
+    Raises IOError if the connection fails or the download is incomplete.
+    Return nothing.
+    """
+    loop = asyncio.get_running_loop()
+
+    offset = part_file_path.stat().st_size if part_file_path.exists() else 0
+
+    reader, writer, headers, file_size, offset = await async_open_url(url, offset)
+
+    bsize = 1_048_576
+    try:
+        with open(part_file_path, "ab" if offset else "wb") as out_handle:
+            buffer = bytearray()
+            async for chunk in iter_body(reader, headers):
+                buffer += chunk
+                if len(buffer) >= bsize:
+                    await loop.run_in_executor(None, out_handle.write, bytes(buffer))
+                    buffer.clear()
+            if buffer:
+                await loop.run_in_executor(None, out_handle.write, bytes(buffer))
+    finally:
+        writer.close()
+
+    downloaded_size = part_file_path.stat().st_size
+    if file_size is not None and downloaded_size != file_size:
+        if downloaded_size > file_size:
+            # the '.part' file cannot be resumed from, so start again on the next try
+            part_file_path.unlink()
+        raise IOError(f"Download of {url} incomplete ({downloaded_size} of {file_size} bytes)")
+
+
+async def async_open_url(url, offset=0, redirects=5):
+    """Send an HTTP(S) GET request for a file, starting from the given byte offset.
+
+    :param url: str, http(s) url of file to be downloaded
+    :param offset: int, number of bytes of the file already downloaded
+    :param redirects: int, maximum number of redirects followed
+
+    Raises HTTPError for error responses, URLError for unsupported URLs, and IOError for
+    malformed responses.
+    Return the stream reader and writer, the response headers (Message), the total size of
+    the file in bytes (int, or None if unknown), and the offset (int) the response starts from.
+    """
+    parsed_url = urlparse(url)
+    if parsed_url.scheme not in ("http", "https"):
+        raise URLError(f"Unsupported URL scheme for asynchronous download: {url}")
+
+    use_ssl = parsed_url.scheme == "https"
+    port = parsed_url.port or (443 if use_ssl else 80)
+
+    reader, writer = await with_timeout(
+        asyncio.open_connection(parsed_url.hostname, port, ssl=use_ssl or None)
+    )
+
+    try:
+        path = parsed_url.path or "/"
+        if parsed_url.query:
+            path = f"{path}?{parsed_url.query}"
+
+        request = [
+            f"GET {path} HTTP/1.1",
+            f"Host: {parsed_url.netloc}",
+            "User-Agent: saintBioutils",
+            "Accept-Encoding: identity",
+            "Connection: close",
+        ]
+        if offset:
+            request.append(f"Range: bytes={offset}-")
+        writer.write(("\r\n".join(request) + "\r\n\r\n").encode("latin-1"))
+        await with_timeout(writer.drain())
+
+        status_line = (await with_timeout(reader.readline())).decode("latin-1").split(" ", 2)
+        if len(status_line) < 2:
+            raise IOError(f"Malformed HTTP response from {url}")
+        status, reason = int(status_line[1]), status_line[-1].strip()
+
+        headers = Message()
+        while True:
+            line = await with_timeout(reader.readline())
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip()] = value.strip()
+
+    except ValueError as err:
+        # e.g. a non-numeric status code, or a line longer than the stream reader's limit
+        writer.close()
+        raise IOError(f"Malformed HTTP response from {url}: {err}") from err
+
+    except BaseException:
+        writer.close()
+        raise
+
+    if status in (301, 302, 303, 307, 308) and redirects > 0 and headers.get("Location"):
+        writer.close()
+        return await async_open_url(urljoin(url, headers["Location"]), offset, redirects - 1)
+
+    if status == 416 and offset:
+        # the offset lies beyond the end of the file, so start again
+        writer.close()
+        return await async_open_url(url, 0, redirects)
+
+    if status >= 400:
+        writer.close()
+        raise HTTPError(url, status, reason, headers, None)
+
+    if offset and status == 206:
+        # Content-Range: bytes <start>-<end>/<total>
+        file_size = headers.get("Content-Range", "").rsplit("/", 1)[-1]
+    else:
+        offset = 0
+        file_size = headers.get("Content-Length")
+
+    try:
+        file_size = int(file_size)
+    except (TypeError, ValueError):
+        file_size = None
+
+    return reader, writer, headers, file_size, offset
+
+
+async def iter_body(reader, headers, bsize=262_144):
+    """Iterate over the body of an HTTP response.
+
+    :param reader: asyncio.StreamReader, positioned at the start of the response body
+    :param headers: Message, response headers
+    :param bsize: int, maximum number of bytes read at a time
+
+    Raises IOError if a chunked body is malformed.
+    Yields bytes.
+    """
+    if headers.get("Transfer-Encoding", "").lower() == "chunked":
+        while True:
+            try:
+                size_line = await with_timeout(reader.readline())
+                chunk_size = int(size_line.split(b";", 1)[0].strip() or b"0", 16)
+            except ValueError as err:
+                raise IOError(f"Malformed chunk in HTTP response: {err}") from err
+            if chunk_size == 0:
+                return
+            yield await with_timeout(reader.readexactly(chunk_size))
+            await with_timeout(reader.readline())  # CRLF terminating the chunk
+
+    remaining = headers.get("Content-Length")
+    remaining = int(remaining) if remaining is not None else None
+
+    while remaining is None or remaining > 0:
+        size = bsize if remaining is None else min(bsize, remaining)
+        chunk = await with_timeout(reader.read(size))
+        if not chunk:
+            return  # connection closed, incomplete downloads are caught by the caller
+        if remaining is not None:
+            remaining -= len(chunk)
+        yield chunk
+
+
+async def with_timeout(awaitable, seconds=TIMEOUT):
+    """Await with a timeout, raising socket.timeout (an IOError) if it is exceeded.
+
+    :param awaitable: awaitable to wait for
+    :param seconds: float, timeout in seconds
+
+    Return the result of the awaitable.
+    """
+    try:
+        return await asyncio.wait_for(awaitable, seconds)
+    except asyncio.TimeoutError:
+        raise timeout(f"Timed out after {seconds}s")
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) University of St Andrews 2020-2021
+# (c) University of Strathclyde 2020-2021
+# (c) James Hutton Institute 2020-2021
+#
+# Author:
+# Emma E. M. Hobbs
+#
+# Contact
+# eemh1@st-andrews.ac.uk
+#
+# Emma E. M. Hobbs,
+# Biomolecular Sciences Building,
+# University of St Andrews,
+# North Haugh Campus,
+# St Andrews,
+# KY16 9ST
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Checkpoints of completed protein extractions, for resumable re-runs"""
+
+
+import time
+
+from pathlib import Path
+
+from saintBioutils.utilities.store import SQLiteStore, get_file_md5
+
+
+class ExtractionCheckpoint(SQLiteStore):
+    """SQLite-backed record of the genomic assemblies whose proteins have been extracted.
+
+    Each entry records the size and modification time (and optionally the MD5 checksum) of
+    the assembly file when it was parsed, so re-runs skip assemblies that are unchanged and
+    whose output is still present, and re-process new or changed assemblies.
+    """
+
+    tables = (
+        "CREATE TABLE IF NOT EXISTS extractions ("
+        "accession TEXT PRIMARY KEY, "
+        "assembly_path TEXT NOT NULL, "
+        "size INTEGER NOT NULL, "
+        "mtime_ns INTEGER NOT NULL, "
+        "md5 TEXT, "
+        "fasta_path TEXT NOT NULL, "
+        "protein_count INTEGER NOT NULL, "
+        "completed_at REAL NOT NULL)",
+    )
+
+    def __init__(self, db_path, checksums=False):
+        """Open (and create if needed) the checkpoint.
+
+        :param db_path: Path, path to the SQLite database file
+        :param checksums: bool, record the MD5 checksum of each assembly file and always compare
+            it when checking if an assembly is unchanged, rather than relying on the size and
+            modification time. Default for record() and is_complete().
+        """
+        super().__init__(db_path)
+        self.checksums = checksums
+
+    def record(self, accession, assembly_path, fasta_path, protein_count, checksums=None):
+        """Record a completed extraction.
+
+        :param accession: str, assembly accession
+        :param assembly_path: Path, genomic assembly the proteins were extracted from
+        :param fasta_path: Path, FASTA file the proteins were written to
+        :param protein_count: int, number of proteins written
+        :param checksums: bool, also record the MD5 checksum of the assembly file, defaults to
+            the checksums option of the checkpoint
+
+        Return nothing.
+        """
+        if checksums is None:
+            checksums = self.checksums
+
+        stat = Path(assembly_path).stat()
+        md5 = get_file_md5(assembly_path) if checksums else None
+
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO extractions VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    accession,
+                    str(assembly_path),
+                    stat.st_size,
+                    stat.st_mtime_ns,
+                    md5,
+                    str(fasta_path),
+                    protein_count,
+                    time.time(),
+                ),
+            )
+
+    def get(self, accession):
+        """Retrieve the checkpoint entry of an assembly.
+
+        :param accession: str, assembly accession
+
+        Return dict of the entry, or None if the assembly is not recorded.
+        """
+        entries = self.fetch_entries(
+            "SELECT * FROM extractions WHERE accession = ?",
+            (accession,),
+            paths=("assembly_path", "fasta_path"),
+        )
+        return entries[0] if entries else None
+
+    def is_complete(self, accession, assembly_path, fasta_path, checksums=None):
+        """Check if the proteins of an assembly were extracted, and the assembly has not changed since.
+
+        The assembly is unchanged if its size and modification time match the checkpoint. If
+        the modification time differs (e.g. the assembly was downloaded again) but an MD5
+        checksum was recorded, the checksum decides. With checksums=True the checksum is
+        always compared, when one was recorded.
+
+        :param accession: str, assembly accession
+        :param assembly_path: Path, genomic assembly
+        :param fasta_path: Path, FASTA file the proteins are written to
+        :param checksums: bool, always compare MD5 checksums, defaults to the checksums option
+            of the checkpoint
+
+        Return bool.
+        """
+        if checksums is None:
+            checksums = self.checksums
+
+        entry = self.get(accession)
+        if entry is None or entry['fasta_path'] != Path(fasta_path) or not entry['fasta_path'].exists():
+            return False
+
+        try:
+            stat = Path(assembly_path).stat()
+        except OSError:
+            return False
+
+        if stat.st_size != entry['size']:
+            return False
+
+        if stat.st_mtime_ns == entry['mtime_ns'] and not checksums:
+            return True
+
+        if entry['md5'] is None:
+            return stat.st_mtime_ns == entry['mtime_ns']
+
+        return get_file_md5(assembly_path) == entry['md5']
+
+    def remove(self, accession):
+        """Remove the checkpoint entry of an assembly, so it is extracted again.
+
+        :param accession: str, assembly accession
+
+        Return nothing.
+        """
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM extractions WHERE accession = ?", (accession,))
+
+    def entries(self):
+        """Return list of dicts, all entries in the checkpoint."""
+        return self.fetch_entries("SELECT * FROM extractions", paths=("assembly_path", "fasta_path"))
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) University of St Andrews 2020-2021
+# (c) University of Strathclyde 2020-2021
+# (c) James Hutton Institute 2020-2021
+#
+# Author:
+# Emma E. M. Hobbs
+#
+# Contact
+# eemh1@st-andrews.ac.uk
+#
+# Emma E. M. Hobbs,
+# Biomolecular Sciences Building,
+# University of St Andrews,
+# North Haugh Campus,
+# St Andrews,
+# KY16 9ST
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Disk-backed deduplication of protein sequences by sequence hash"""
+
+
+import hashlib
+
+from saintBioutils.utilities.store import SQLiteStore
+
+
+def hash_sequence(seq):
+    """Hash a sequence, for identifying identical sequences.
+
+    :param seq: str, sequence
+
+    Return str, 32 character hex digest (128-bit BLAKE2b).
+    """
+    return hashlib.blake2b(seq.encode(), digest_size=16).hexdigest()
+
+
+class SequenceHashSet(SQLiteStore):
+    """SQLite-backed set of sequence hashes, for deduplicating sequences across many assemblies.
+
+    The set is held on disk, so memory use is bounded by the SQLite page cache rather than
+    the number of sequences seen. The accessions of assemblies whose sequences have all been
+    written are recorded alongside the hashes, so re-runs can skip them.
+    """
+
+    tables = (
+        "CREATE TABLE IF NOT EXISTS seen (hash BLOB PRIMARY KEY) WITHOUT ROWID",
+        "CREATE TABLE IF NOT EXISTS assemblies (accession TEXT PRIMARY KEY)",
+    )
+
+    def __init__(self, db_path, cache_size=65536):
+        """Open (and create if needed) the set.
+
+        :param db_path: Path, path to the SQLite database file
+        :param cache_size: int, maximum size of the SQLite page cache in KiB
+        """
+        super().__init__(db_path, pragmas=[f"PRAGMA cache_size = -{int(cache_size)}"])
+
+    def __contains__(self, seq_hash):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT 1 FROM seen WHERE hash = ?", (bytes.fromhex(seq_hash),),
+            ).fetchone()
+        return row is not None
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM seen").fetchone()[0]
+
+    def add(self, seq_hash):
+        """Add a sequence hash to the set.
+
+        :param seq_hash: str, hex digest from hash_sequence()
+
+        Return bool, True if the hash was not already in the set.
+        """
+        return self.add_many([seq_hash])[0]
+
+    def add_many(self, seq_hashes):
+        """Add many sequence hashes to the set in a single transaction.
+
+        :param seq_hashes: iterable of str, hex digests from hash_sequence()
+
+        Return list of bool, True for each hash that was not already in the set (or earlier
+        in seq_hashes).
+        """
+        new = []
+        with self.lock, self.connection:
+            for seq_hash in seq_hashes:
+                cursor = self.connection.execute(
+                    "INSERT OR IGNORE INTO seen VALUES (?)", (bytes.fromhex(seq_hash),),
+                )
+                new.append(cursor.rowcount == 1)
+        return new
+
+    def filter_new(self, seq_hashes, batch_size=500):
+        """Check which sequence hashes are not in the set, without adding them.
+
+        :param seq_hashes: list of str, hex digests from hash_sequence()
+        :param batch_size: int, number of hashes looked up per query
+
+        Return list of bool, True for each hash that is not in the set (and not earlier in
+        seq_hashes).
+        """
+        found = set()
+        with self.lock:
+            for i in range(0, len(seq_hashes), batch_size):
+                batch = [bytes.fromhex(seq_hash) for seq_hash in seq_hashes[i:i + batch_size]]
+                rows = self.connection.execute(
+                    f"SELECT hash FROM seen WHERE hash IN ({', '.join('?' * len(batch))})", batch,
+                ).fetchall()
+                found.update(row[0].hex() for row in rows)
+
+        new = []
+        for seq_hash in seq_hashes:
+            new.append(seq_hash not in found)
+            found.add(seq_hash)
+        return new
+
+    def add_assembly(self, accession, seq_hashes):
+        """Record an assembly as written, with the hashes of its sequences, in a single transaction.
+
+        Call once the assembly's sequences have been written to disk, so a crash before then
+        does not leave hashes in the set for sequences that were never written.
+
+        :param accession: str, assembly accession
+        :param seq_hashes: iterable of str, hex digests of the sequences from the assembly
+
+        Return nothing.
+        """
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO seen VALUES (?)",
+                ((bytes.fromhex(seq_hash),) for seq_hash in seq_hashes),
+            )
+            self.connection.execute("INSERT OR IGNORE INTO assemblies VALUES (?)", (accession,))
+
+    def has_assembly(self, accession):
+        """Check if all sequences of an assembly have been written.
+
+        :param accession: str, assembly accession
+
+        Return bool.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT 1 FROM assemblies WHERE accession = ?", (accession,),
+            ).fetchone()
+        return row is not None
@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) University of St Andrews 2020-2021
+# (c) University of Strathclyde 2020-2021
+# (c) James Hutton Institute 2020-2021
+#
+# Author:
+# Emma E. M. Hobbs
+#
+# Contact
+# eemh1@st-andrews.ac.uk
+#
+# Emma E. M. Hobbs,
+# Biomolecular Sciences Building,
+# University of St Andrews,
+# North Haugh Campus,
+# St Andrews,
+# KY16 9ST
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Single pass extraction of several products (proteins, CDS, rRNA, tRNA, feature table) from genomic assemblies"""
+
+
+import gzip
+import logging
+
+from Bio import SeqIO
+
+from saintBioutils.genbank.parse_genomes import get_record_feature
+from saintBioutils.utilities.file_io.compression import open_gzip
+from saintBioutils.utilities.file_io.fasta import FastaWriter
+
+
+# the feature type each output is built from, the feature table is built from all of TABLE_FEATURE_TYPES
+OUTPUTS = {
+    "protein": "CDS",
+    "cds": "CDS",
+    "rrna": "rRNA",
+    "trna": "tRNA",
+    "feature_table": None,
+}
+TABLE_FEATURE_TYPES = ("gene", "CDS", "rRNA", "tRNA")
+
+# qualifiers written to the attributes column of the feature table
+TABLE_QUALIFIERS = ("locus_tag", "gene", "protein_id", "product")
+
+# prefix of the GFF3 ID of each feature type, as in the GFF3 files of NCBI, other types use their name
+GFF_ID_PREFIXES = {"gene": "gene", "CDS": "cds", "mRNA": "rna", "rRNA": "rna", "tRNA": "rna", "ncRNA": "rna"}
+
+# characters with a reserved meaning in GFF3 attribute values, and their escapes
+GFF_ESCAPES = str.maketrans({
+    "%": "%25", ";": "%3B", "=": "%3D", "&": "%26", ",": "%2C", "\t": "%09", "\n": "%0A", "\r": "%0D",
+})
+
+
+def extract_features(
+    assembly_path,
+    accession,
+    txid,
+    target_dir,
+    outputs=("protein", "cds", "rrna", "trna", "feature_table"),
+    filestem="genbank",
+    compression=None,
+    table_feature_types=TABLE_FEATURE_TYPES,
+):
+    """Write several products of a genomic assembly from a single pass over the assembly.
+
+    The assembly is decompressed and parsed once, and each feature is written to every
+    selected output it belongs to:
+    'protein' - FASTA of CDS translations, identical to the output of extract_protein_seqs()
+    'cds' - FASTA of CDS nucleotide sequences, with the same headers as 'protein'
+    'rrna' - FASTA of rRNA nucleotide sequences
+    'trna' - FASTA of tRNA nucleotide sequences
+    'feature_table' - GFF3 table of the features in table_feature_types, with one row
+        per part of features with compound (e.g. join()) locations. All rows of a feature
+        share its ID, and CDS and RNA features are linked to the gene with the same
+        locus_tag by their Parent attribute.
+
+    :param assembly_path: Path to genomic assembly
+    :param accession: str, accession number of the genomic assembly
+    :param txid: str, NCBI taxonomy id of the host species
+    :param target_dir: Path, directory to write the output files to
+    :param outputs: iterable of str, outputs to write, keys of OUTPUTS
+    :param filestem: str, file name prefix
+    :param compression: str, None, 'gzip' or 'bgzf', compression of the output files ('bgzf'
+        is written as 'gzip' for the feature table)
+    :param table_feature_types: iterable of str, feature types written to the feature table
+
+    Return dict {output: {'path': Path, 'count': int, number of features written}}.
+    """
+    logger = logging.getLogger(__name__)
+
+    outputs = list(dict.fromkeys(outputs))
+    unknown = [output for output in outputs if output not in OUTPUTS]
+    if unknown:
+        raise ValueError(f"Unknown outputs {unknown}, expected any of {list(OUTPUTS)}")
+
+    table_feature_types = set(table_feature_types)
+    feature_types = {OUTPUTS[output] for output in outputs if OUTPUTS[output] is not None}
+    if "feature_table" in outputs:
+        feature_types |= table_feature_types
+
+    results = {}
+    writers = {}
+    suffix = "" if compression is None else ".gz"
+    for output in outputs:
+        if output == "feature_table":
+            path = target_dir / f"{filestem}_features_{txid}_{accession}.gff3{suffix}"
+            open_func = open if compression is None else gzip.open
+            writers[output] = open_func(path, "wt")
+            writers[output].write("##gff-version 3\n")
+        else:
+            path = target_dir / f"{filestem}_{output}_{txid}_{accession}.fasta{suffix}"
+            writers[output] = FastaWriter(path, "w", compression=compression)
+        results[output] = {'path': path, 'count': 0}
+
+    feature_ids = {}  # {GFF3 ID: number of features given the ID}, keeping IDs in the feature table unique
+
+    try:
+        with open_gzip(assembly_path, "rt") as handle:  # unzip the genomic assembly
+            for gb_record in SeqIO.parse(handle, "genbank"):
+                # genes in the feature table, which CDS and RNA features are linked to
+                gene_locus_tags = set()
+                if "feature_table" in outputs and "gene" in table_feature_types:
+                    gene_locus_tags = {
+                        feature.qualifiers["locus_tag"][0]
+                        for feature in gb_record.features
+                        if feature.type == "gene" and "locus_tag" in feature.qualifiers
+                    }
+
+                for feature in gb_record.features:
+                    if feature.type not in feature_types:
+                        continue
+
+                    for output in outputs:
+                        if write_feature(
+                            output,
+                            writers[output],
+                            gb_record,
+                            feature,
+                            accession,
+                            table_feature_types,
+                            gene_locus_tags,
+                            feature_ids,
+                        ):
+                            results[output]['count'] += 1
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    logger.warning(
+        f"Extracted from genomic assembly {accession}: "
+        + ", ".join([f"{results[output]['count']} {output}" for output in outputs])
+    )
+
+    return results
+
+
+def write_feature(
+    output,
+    writer,
+    gb_record,
+    feature,
+    accession,
+    table_feature_types=TABLE_FEATURE_TYPES,
+    gene_locus_tags=None,
+    feature_ids=None,
+):
+    """Write a feature to one of the outputs of extract_features(), if it belongs in the output.
+
+    :param output: str, key of OUTPUTS
+    :param writer: FastaWriter, or text handle for the feature table
+    :param gb_record: BioPython SeqRecord of the contig containing the feature
+    :param feature: BioPython SeqFeature
+    :param accession: str, accession number of the genomic assembly
+    :param table_feature_types: set of str, feature types written to the feature table
+    :param gene_locus_tags: set of str, locus tags of the genes in the feature table, see get_gff_rows()
+    :param feature_ids: dict of GFF3 IDs already used in the feature table, see get_gff_id()
+
+    Return bool, True if the feature was written.
+    """
+    logger = logging.getLogger(__name__)
+
+    if output == "feature_table":
+        if feature.type not in table_feature_types:
+            return False
+        writer.write("".join(get_gff_rows(gb_record.id, feature, accession, gene_locus_tags, feature_ids)))
+        return True
+
+    if feature.type != OUTPUTS[output]:
+        return False
+
+    if output == "protein":
+        seq = get_record_feature(feature, "translation", accession)
+        if seq is None:
+            return False
+        protein_id = get_record_feature(feature, "protein_id", accession)
+        locus_tag = get_record_feature(feature, "locus_tag", accession)
+        writer.write(f"{protein_id} {locus_tag} ", seq)
+        return True
+
+    try:
+        seq = str(feature.extract(gb_record.seq))
+    except ValueError:  # e.g. records without sequence, that only list CONTIG entries
+        logger.warning(
+            f"Sequence of {feature.type} feature on {gb_record.id} is undefined, accession: {accession}"
+        )
+        return False
+
+    locus_tag = get_record_feature(feature, "locus_tag", accession)
+    if output == "cds":
+        protein_id = get_record_feature(feature, "protein_id", accession)
+        writer.write(f"{protein_id} {locus_tag} ", seq)
+    else:
+        product = get_record_feature(feature, "product", accession)
+        writer.write(f"{locus_tag} {product}", seq)
+
+    return True
+
+
+def get_gff_rows(contig, feature, accession, gene_locus_tags=None, feature_ids=None):
+    """Build the GFF3 rows of a feature, one per part of its location.
+
+    Every row of the feature carries the same ID, so the parts of compound (e.g. join())
+    locations are read as a single feature. Features other than genes are given the gene
+    with the same locus_tag as their Parent, if the gene is in the feature table.
+
+    :param contig: str, id of the contig containing the feature
+    :param feature: BioPython SeqFeature
+    :param accession: str, accession number of the genomic assembly
+    :param gene_locus_tags: set of str, locus tags of the genes in the feature table
+    :param feature_ids: dict of GFF3 IDs already used in the feature table, see get_gff_id()
+
+    Return list of str, tab separated rows including the newline.
+    """
+    attributes = [f"ID={get_gff_id(contig, feature, feature_ids).translate(GFF_ESCAPES)}"]
+
+    locus_tag = feature.qualifiers.get("locus_tag", [None])[0]
+    if feature.type != "gene" and gene_locus_tags and locus_tag in gene_locus_tags:
+        attributes.append(f"Parent=gene-{locus_tag.translate(GFF_ESCAPES)}")
+
+    attributes += [
+        f"{qualifier}={get_record_feature(feature, qualifier, accession).translate(GFF_ESCAPES)}"
+        for qualifier in TABLE_QUALIFIERS
+        if qualifier in feature.qualifiers
+    ]
+    attributes = ";".join(attributes)
+
+    # number of bases before the first complete codon, for calculating the phase of each part
+    codon_start = 0
+    if feature.type == "CDS":
+        codon_start = int(feature.qualifiers.get("codon_start", ["1"])[0]) - 1
+
+    rows = []
+    preceding_length = 0  # length of the parts before this part, in the direction of transcription
+    for part in feature.location.parts:
+        strand = {1: "+", -1: "-"}.get(part.strand, ".")
+        phase = "."
+        if feature.type == "CDS":
+            phase = str((3 - (preceding_length - codon_start) % 3) % 3)
+        preceding_length += len(part)
+
+        rows.append(
+            f"{contig}\tGenBank\t{feature.type}\t{int(part.start) + 1}\t{int(part.end)}\t.\t"
+            f"{strand}\t{phase}\t{attributes}\n"
+        )
+
+    return rows
+
+
+def get_gff_id(contig, feature, feature_ids=None):
+    """Build the GFF3 ID of a feature, e.g. 'gene-<locus_tag>' or 'cds-<protein_id>'.
+
+    CDSs are identified by their protein_id and other features by their locus_tag, falling
+    back to the location of the feature if neither is given.
+
+    :param contig: str, id of the contig containing the feature
+    :param feature: BioPython SeqFeature
+    :param feature_ids: dict {ID: number of features given the ID}, IDs already used are made
+        unique by adding a number (e.g. 'cds-ABC123.1-2'), and feature_ids is updated
+
+    Return str, unescaped ID.
+    """
+    prefix = GFF_ID_PREFIXES.get(feature.type, feature.type.lower())
+
+    name = None
+    if feature.type == "CDS":
+        name = feature.qualifiers.get("protein_id", [None])[0]
+    if name is None:
+        name = feature.qualifiers.get("locus_tag", [None])[0]
+    if name is None:
+        name = f"{contig}:{int(feature.location.start) + 1}..{int(feature.location.end)}"
+
+    feature_id = f"{prefix}-{name}"
+
+    if feature_ids is not None:
+        feature_ids[feature_id] = feature_ids.get(feature_id, 0) + 1
+        if feature_ids[feature_id] > 1:
+            feature_id = f"{feature_id}-{feature_ids[feature_id]}"
+
+    return feature_id
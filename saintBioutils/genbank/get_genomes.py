@@ -41,53 +41,231 @@
 """Download genomic assemblies from NCBI"""
 
 
+import ftplib
+import hashlib
 import logging
+import os
 import re
+import threading
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from socket import timeout
 from tqdm import tqdm
-from urllib.error import HTTPError, URLError
-from urllib.request import urlopen
+from urllib.error import HTTPError
+from urllib.parse import urljoin, urlparse
+from urllib.request import Request, urlopen
 
 from Bio import Entrez
 
 from saintBioutils.genbank import entrez_retry
+from saintBioutils.genbank.rate_limit import get_download_policy
+from saintBioutils.genbank.transport import get_connection_pool
+from saintBioutils.misc import get_chunks_gen
+from saintBioutils.utilities.store import get_file_md5, hash_file
 
 
-def get_genomic_assembly(assembly_accession, outdir=None, suffix="genomic.gbff.gz"):
+NCBI_GENOMES_STEM = "https://ftp.ncbi.nlm.nih.gov/genomes/all"
+
+
+def get_genomic_assembly(
+    assembly_accession,
+    outdir=None,
+    suffix="genomic.gbff.gz",
+    cache=None,
+    sources=None,
+):
     """Coordinate downloading Genomic assemmbly from the NCBI Assembly database.
     
     :param assembly_accession: str, accession of the Genomic assembly to be downloaded
     :param outdir: Path, path to dir to write out downloaded assemblies to, else writes to cwd
     :param suffix: str, suffix of file
+    :param cache: AssemblyCache, cache of resolved assembly names, NCBI is always queried if None
+    :param sources: list of sources (e.g. LocalMirrorSource) tried before downloading from NCBI
     
     Return path to downloaded genomic assembly.
     """
     # compile url for download
-    genbank_url, filestem = compile_url(assembly_accession, suffix)
+    genbank_url, filestem = compile_url(assembly_accession, suffix, cache=cache)
 
     # create path to write downloaded Genomic assembly to
-    if outdir is not None:
-        out_file_path = outdir / "_".join([filestem.replace(".", "_"), suffix])
-    else: 
-        out_file_path = "_".join([filestem.replace(".", "_"), suffix])
-    out_file_path = Path(out_file_path)
+    out_file_path = compile_out_path(filestem, suffix, outdir)
 
     # download GenBank file
-    download_file(genbank_url, out_file_path, assembly_accession, "GenBank file")
+    download_file(genbank_url, out_file_path, assembly_accession, "GenBank file", sources=sources)
 
     return out_file_path
 
 
-def compile_url(accession_number, suffix, ftpstem="ftp://ftp.ncbi.nlm.nih.gov/genomes/all"):
+def get_genomic_assemblies(
+    assembly_accessions,
+    outdir=None,
+    suffix="genomic.gbff.gz",
+    max_workers=4,
+    cache=None,
+    batch_size=200,
+    manifest=None,
+    sources=None,
+):
+    """Coordinate downloading many Genomic assemblies from the NCBI Assembly database concurrently.
+
+    The download URLs of all assemblies are resolved in batches using compile_urls(), and the
+    files are then downloaded by a pool of workers. A single aggregate progress bar is shown in
+    place of the per-file progress bars.
+
+    Assemblies recorded as complete in the manifest (and whose files are still present with the
+    recorded size) are skipped before any call to NCBI, and are given the status 'skipped'.
+
+    :param assembly_accessions: iterable of str, accessions of the Genomic assemblies to download
+    :param outdir: Path, path to dir to write out downloaded assemblies to, else writes to cwd
+    :param suffix: str, suffix of file
+    :param max_workers: int, maximum number of assemblies downloaded at the same time
+    :param cache: AssemblyCache, cache of resolved assembly names, NCBI is always queried if None
+    :param batch_size: int, number of accessions resolved per Entrez query
+    :param manifest: DownloadManifest, record of completed downloads, not used if None
+    :param sources: list of sources (e.g. LocalMirrorSource) tried before downloading from NCBI
+
+    Return dict {assembly_accession: {'path': Path or None, 'status': str}}
+    """
+    logger = logging.getLogger(__name__)
+
+    # remove duplicates while retaining the order the accessions were provided in
+    assembly_accessions = list(dict.fromkeys(assembly_accessions))
+
+    results = {}  # {assembly_accession: {'path': Path, 'status': str}}
+
+    if manifest is not None:
+        for accession in assembly_accessions:
+            if manifest.is_complete(accession, suffix):
+                results[accession] = {
+                    'path': manifest.get(accession, suffix)['path'], 'status': 'skipped',
+                }
+        if len(results) != 0:
+            logger.info(f"Skipping {len(results)} assemblies already recorded in the manifest")
+
+    to_download = [accession for accession in assembly_accessions if accession not in results]
+
+    urls = compile_urls(to_download, suffix, cache=cache, batch_size=batch_size)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for accession in to_download:
+            if urls[accession] is None:
+                results[accession] = {'path': None, 'status': 'failed'}
+                continue
+
+            genbank_url, filestem = urls[accession]
+            out_file_path = compile_out_path(filestem, suffix, outdir)
+            future = executor.submit(
+                get_assembly_worker,
+                accession,
+                genbank_url,
+                out_file_path,
+                suffix,
+                manifest,
+                sources,
+            )
+            futures[future] = accession
+
+        with tqdm(total=len(futures), desc="Downloading genomic assemblies") as pbar:
+            for future in as_completed(futures):
+                accession = futures[future]
+                try:
+                    results[accession] = future.result()
+                except Exception:
+                    logger.error(f"Failed to retrieve genomic assembly {accession}", exc_info=1)
+                    results[accession] = {'path': None, 'status': 'failed'}
+                pbar.update(1)
+
+    failed = [acc for acc in results if results[acc]['status'] == 'failed']
+    if len(failed) != 0:
+        logger.warning(f"Failed to download {len(failed)} of {len(results)} genomic assemblies")
+
+    return results
+
+
+def get_assembly_worker(
+    assembly_accession,
+    genbank_url,
+    out_file_path,
+    suffix=None,
+    manifest=None,
+    sources=None,
+):
+    """Download a single genomic assembly, for use by get_genomic_assemblies().
+
+    :param assembly_accession: str, accession of the Genomic assembly to be downloaded
+    :param genbank_url: str, url of file to be downloaded
+    :param out_file_path: Path, path to write the downloaded file to
+    :param suffix: str, suffix of file
+    :param manifest: DownloadManifest, record of completed downloads, not used if None
+    :param sources: list of sources (e.g. LocalMirrorSource) tried before downloading from NCBI
+
+    Return dict {'path': Path or None, 'status': str}
+    """
+    status = download_file(
+        genbank_url,
+        out_file_path,
+        assembly_accession,
+        "GenBank file",
+        show_progress=False,
+        manifest=manifest,
+        suffix=suffix,
+        sources=sources,
+    )
+
+    if status == "failed":
+        return {'path': None, 'status': status}
+
+    return {'path': out_file_path, 'status': status}
+
+
+def compile_out_path(filestem, suffix, outdir=None):
+    """Build the path the downloaded file is written to.
+
+    :param filestem: str, filestem of the assembly, as returned from compile_url()
+    :param suffix: str, suffix of file
+    :param outdir: Path, path to output dir, else the file is written to cwd
+
+    Return Path.
+    """
+    file_name = "_".join([filestem.replace(".", "_"), suffix])
+
+    if outdir is not None:
+        return Path(outdir) / file_name
+
+    return Path(file_name)
+
+
+def compile_url(accession_number, suffix, ftpstem=NCBI_GENOMES_STEM, cache=None):
     """Retrieve URL for downloading the assembly from NCBI, and create filestem of output file path
     :param accession_number: str, asseccion number of genomic assembly
+    :param suffix: str, suffix of file
+    :param ftpstem: str, root of the NCBI genomes directory tree
+    :param cache: AssemblyCache, cache of resolved assembly names, NCBI is always queried if None
     Return str, url required for download and filestem for output file path for the downloaded assembly.
     """
+    assembly_name = get_assembly_name(accession_number, cache)
+
+    return build_url(accession_number, assembly_name, suffix, ftpstem)
+
+
+def get_assembly_name(accession_number, cache=None):
+    """Retrieve the name of the assembly from the cache, else from the NCBI Assembly database.
+
+    :param accession_number: str, asseccion number of genomic assembly
+    :param cache: AssemblyCache, cache of resolved assembly names, NCBI is always queried if None
+
+    Return str, assembly name.
+    """
+    if cache is not None:
+        cached = cache.get(accession_number)
+        if cached is not None:
+            return cached['assembly_name']
+
     # search for the ID of the record
     with entrez_retry(
-        10, Entrez.esearch, db="Assembly", term="GCA_000021645.1[Assembly Accession]", rettype='uilist',
+        10, Entrez.esearch, db="Assembly", term=f"{accession_number}[Assembly Accession]", rettype='uilist',
     ) as handle:
         search_record = Entrez.read(handle)
 
@@ -101,8 +279,167 @@ def compile_url(accession_number, suffix, ftpstem="ftp://ftp.ncbi.nlm.nih.gov/ge
     ) as handle:
         record = Entrez.read(handle)
 
-    assembly_name = record["DocumentSummarySet"]["DocumentSummary"][0]["AssemblyName"]
+    summary = record["DocumentSummarySet"]["DocumentSummary"][0]
+    assembly_name = summary["AssemblyName"]
+
+    if cache is not None:
+        cache.set(accession_number, assembly_name, get_ftp_path(accession_number, summary))
+
+    return assembly_name
+
 
+def compile_urls(
+    accession_numbers,
+    suffix,
+    ftpstem=NCBI_GENOMES_STEM,
+    cache=None,
+    batch_size=200,
+):
+    """Retrieve URLs for downloading many assemblies from NCBI using batched Entrez queries.
+
+    Each batch of accessions is resolved with a single esearch (the accessions are ORed into
+    one search term) and a single esummary call.
+
+    :param accession_numbers: list of str, asseccion numbers of genomic assemblies
+    :param suffix: str, suffix of file
+    :param ftpstem: str, root of the NCBI genomes directory tree
+    :param cache: AssemblyCache, cache of resolved assembly names, NCBI is always queried if None
+    :param batch_size: int, number of accessions resolved per Entrez query
+
+    Return dict {accession: (url, filestem)}, valued by None if the accession could not be resolved.
+    """
+    assembly_names = get_assembly_names(accession_numbers, cache, batch_size)
+
+    urls = {}
+    for accession in accession_numbers:
+        if assembly_names[accession] is None:
+            urls[accession] = None
+        else:
+            urls[accession] = build_url(accession, assembly_names[accession], suffix, ftpstem)
+
+    return urls
+
+
+def get_assembly_names(accession_numbers, cache=None, batch_size=200):
+    """Retrieve the names of many assemblies from the cache, else from the NCBI Assembly database.
+
+    :param accession_numbers: list of str, asseccion numbers of genomic assemblies
+    :param cache: AssemblyCache, cache of resolved assembly names, NCBI is always queried if None
+    :param batch_size: int, number of accessions resolved per Entrez query
+
+    Return dict {accession: assembly name}, valued by None if the accession could not be resolved.
+    """
+    logger = logging.getLogger(__name__)
+
+    assembly_names = {}  # {accession: assembly_name}
+    to_query = []
+
+    for accession in dict.fromkeys(accession_numbers):
+        cached = cache.get(accession) if cache is not None else None
+        if cached is None:
+            to_query.append(accession)
+        else:
+            assembly_names[accession] = cached['assembly_name']
+
+    for batch in tqdm(
+        get_chunks_gen(to_query, batch_size),
+        total=-(-len(to_query) // batch_size),
+        desc="Resolving assembly accessions",
+        disable=len(to_query) <= batch_size,
+    ):
+        summaries = get_assembly_summaries(batch)
+
+        for accession in batch:
+            summary = summaries.get(accession)
+            if summary is None:
+                logger.warning(f"Could not retrieve assembly {accession} from NCBI")
+                assembly_names[accession] = None
+                continue
+
+            assembly_names[accession] = str(summary["AssemblyName"])
+            if cache is not None:
+                cache.set(
+                    accession, assembly_names[accession], get_ftp_path(accession, summary),
+                )
+
+    return assembly_names
+
+
+def get_assembly_summaries(accession_numbers):
+    """Retrieve the NCBI Assembly document summaries for a batch of accessions.
+
+    :param accession_numbers: list of str, asseccion numbers of genomic assemblies
+
+    Return dict {accession: Entrez DocumentSummary}, accessions not found in NCBI are not included.
+    """
+    logger = logging.getLogger(__name__)
+
+    term = " OR ".join([f"{accession}[Assembly Accession]" for accession in accession_numbers])
+
+    handle = entrez_retry(
+        10, Entrez.esearch, db="Assembly", term=term, rettype='uilist', retmax=len(accession_numbers) * 2,
+    )
+    if handle is None:
+        return {}
+    with handle:
+        search_record = Entrez.read(handle)
+
+    if len(search_record['IdList']) == 0:
+        return {}
+
+    handle = entrez_retry(
+        10,
+        Entrez.esummary,
+        db="assembly",
+        id=",".join(search_record['IdList']),
+        report="full",
+    )
+    if handle is None:
+        return {}
+    with handle:
+        record = Entrez.read(handle, validate=False)
+
+    requested = set(accession_numbers)
+    summaries = {}  # {accession: DocumentSummary}
+
+    for summary in record["DocumentSummarySet"]["DocumentSummary"]:
+        # an assembly may have been requested by either its GenBank or RefSeq accession
+        synonyms = summary.get("Synonym", {})
+        for accession in (
+            summary.get("AssemblyAccession"), synonyms.get("Genbank"), synonyms.get("RefSeq"),
+        ):
+            if accession in requested:
+                summaries[str(accession)] = summary
+
+    logger.info(f"Retrieved {len(summaries)} of {len(requested)} assembly summaries from NCBI")
+
+    return summaries
+
+
+def get_ftp_path(accession_number, summary):
+    """Retrieve the FTP path of the assembly directory from an Entrez esummary document summary.
+
+    :param accession_number: str, asseccion number of genomic assembly
+    :param summary: Entrez DocumentSummary for the assembly
+
+    Return str, or None if no FTP path is listed.
+    """
+    if accession_number.startswith("GCF"):
+        ftp_path = summary.get("FtpPath_RefSeq")
+    else:
+        ftp_path = summary.get("FtpPath_GenBank")
+
+    return str(ftp_path) if ftp_path else None
+
+
+def build_url(accession_number, assembly_name, suffix, ftpstem=NCBI_GENOMES_STEM):
+    """Build the URL for downloading the assembly from NCBI, and create filestem of output file path
+    :param accession_number: str, asseccion number of genomic assembly
+    :param assembly_name: str, name of the genomic assembly
+    :param suffix: str, suffix of file
+    :param ftpstem: str, root of the NCBI genomes directory tree
+    Return str, url required for download and filestem for output file path for the downloaded assembly.
+    """
     escape_characters = re.compile(r"[\s/,#\(\)]")
     escape_name = re.sub(escape_characters, "_", assembly_name)
 
@@ -126,47 +463,429 @@ def compile_url(accession_number, suffix, ftpstem="ftp://ftp.ncbi.nlm.nih.gov/ge
     )
 
 
-def download_file(genbank_url, out_file_path, accession_number, file_type):
+def download_file(
+    genbank_url,
+    out_file_path,
+    accession_number,
+    file_type,
+    show_progress=True,
+    policy=None,
+    verify=True,
+    manifest=None,
+    suffix=None,
+    sources=None,
+):
     """Download file.
+
+    The file is downloaded to a '.part' file alongside the output file, which is only renamed
+    to the output file path once the full file has been retrieved. If a '.part' file is
+    already present, e.g. from an interrupted download, the download is resumed from the end
+    of the '.part' file. Interrupted downloads are retried and resumed according to the retry
+    policy.
+
+    If verify is True, the MD5 checksum of the file is calculated as it is downloaded and checked
+    against the checksum listed in the md5checksums.txt file of the assembly directory. A file
+    that fails the check is deleted and downloaded again.
+
+    If sources are given (e.g. a LocalMirrorSource), they are tried in order and the file is
+    only downloaded from NCBI if none of them holds the file.
+
     :param genbank_url: str, url of file to be downloaded
     :param out_file_path: path, output directory for file to be written to
     :param accession_number: str, accession number of genome
     :param file_type: str, denotes in logger file type downloaded
-    Return nothing.
+    :param show_progress: bool, show a progress bar for the download of this file
+    :param policy: RetryPolicy, defaults to the process-wide download policy
+    :param verify: bool, verify the MD5 checksum of the downloaded file
+    :param manifest: DownloadManifest, completed downloads are recorded in the manifest if given.
+        Existing output files not yet in the manifest are only recorded if verify is True and
+        they match the checksum in the md5checksums.txt file.
+    :param suffix: str, suffix the download is recorded under in the manifest, defaults to the
+        file name in the url
+    :param sources: list of objects with a fetch(url, out_file_path) method, e.g.
+        LocalMirrorSource, tried in order before downloading from NCBI. fetch() returns True
+        if it wrote the file to out_file_path and False if the source does not hold the file,
+        and may raise OSError, in which case the next source is tried
+    Return str, status of the download: 'downloaded', 'mirrored', 'exists' or 'failed'.
     """
     logger = logging.getLogger(__name__)
-    # Try URL connection
+    out_file_path = Path(out_file_path)
+
+    if suffix is None:
+        suffix = genbank_url.rsplit("/", 1)[-1]
+
+    if out_file_path.exists():
+        logger.warning(f"Output file {out_file_path} exists, not downloading")
+        # keep the checksum of a file already recorded when it was downloaded
+        if verify and manifest is not None and manifest.get(accession_number, suffix) is None:
+            record_existing_file(
+                genbank_url, out_file_path, accession_number, manifest, suffix, policy,
+            )
+        return "exists"
+
+    for source in sources or []:
+        try:
+            if source.fetch(genbank_url, out_file_path):
+                logger.info(f"Retrieved {file_type} for {accession_number} from {type(source).__name__}")
+                if manifest is not None:
+                    manifest.record(accession_number, suffix, genbank_url, out_file_path)
+                return "mirrored"
+        except OSError:
+            logger.warning(
+                f"Failed to retrieve {file_type} for {accession_number} from {type(source).__name__}",
+                exc_info=1,
+            )
+
+    if policy is None:
+        policy = get_download_policy()
+
+    part_file_path = out_file_path.with_name(f"{out_file_path.name}.part")
+
+    expected_md5 = None
+    if verify:
+        expected_md5 = get_expected_md5(genbank_url, policy)
+        if expected_md5 is None:
+            logger.warning(
+                f"No MD5 checksum retrieved for {file_type} for {accession_number}, "
+                "the download will not be verified"
+            )
+
     try:
-        response = urlopen(genbank_url, timeout=45)
-    except (HTTPError, URLError, timeout) as e:
+        md5 = policy.run(
+            fetch_file,
+            (genbank_url, part_file_path, f"Downloading {accession_number} {file_type}", show_progress),
+            {'expected_md5': expected_md5},
+        )
+    except policy.retry_on:
         logger.error(
             f"Failed to download {file_type} for {accession_number}", exc_info=1,
         )
-        return
+        return "failed"
 
-    if out_file_path.exists():
-        logger.warning(f"Output file {out_file_path} exists, not downloading")
-        return
+    os.replace(part_file_path, out_file_path)
+
+    if manifest is not None:
+        manifest.record(accession_number, suffix, genbank_url, out_file_path, md5)
+
+    return "downloaded"
+
+
+def record_existing_file(genbank_url, out_file_path, accession_number, manifest, suffix, policy=None):
+    """Record a file downloaded before the manifest was used, if it matches its expected checksum.
+
+    Files that may be incomplete (e.g. left by an interrupted download) are not recorded, so
+    the manifest does not skip them.
+
+    :param genbank_url: str, url the file was downloaded from
+    :param out_file_path: Path, path of the existing file
+    :param accession_number: str, accession number of genome
+    :param manifest: DownloadManifest
+    :param suffix: str, suffix the file is recorded under in the manifest
+    :param policy: RetryPolicy, defaults to the process-wide download policy
+
+    Return bool, True if the file was recorded.
+    """
+    logger = logging.getLogger(__name__)
+
+    expected_md5 = get_expected_md5(genbank_url, policy)
+    if expected_md5 is None:
+        logger.warning(f"No MD5 checksum retrieved for {out_file_path}, not recording it in the manifest")
+        return False
+
+    md5 = get_file_md5(out_file_path)
+    if md5 != expected_md5:
+        logger.warning(
+            f"{out_file_path} does not match its expected MD5 checksum, not recording it in the manifest"
+        )
+        return False
+
+    manifest.record(accession_number, suffix, genbank_url, out_file_path, md5)
+    return True
+
+
+def fetch_file(url, part_file_path, desc, show_progress=True, expected_md5=None):
+    """Download a file to a '.part' file, resuming from the end of the '.part' file if it exists.
+
+    The MD5 checksum is calculated from the bytes as they are written.
+
+    :param url: str, url of file to be downloaded
+    :param part_file_path: Path, path of the '.part' file
+    :param desc: str, description shown on the progress bar
+    :param show_progress: bool, show a progress bar for the download of this file
+    :param expected_md5: str, expected MD5 hex digest of the file, not checked if None
+
+    Raises IOError if the connection fails or the download is incomplete, and ChecksumError
+    (deleting the '.part' file) if the file does not match the expected checksum.
+    Return str, MD5 hex digest of the downloaded file.
+    """
+    logger = logging.getLogger(__name__)
+
+    offset = part_file_path.stat().st_size if part_file_path.exists() else 0
+
+    # Try URL connection
+    response, file_size, offset = open_url(url, offset)
+
+    md5 = hashlib.md5()
+    if offset != 0:
+        logger.info(f"Resuming download of {url} from byte {offset}")
+        # bring the checksum up to date with the bytes already downloaded
+        hash_file(part_file_path, md5)
 
     # Download file
-    file_size = int(response.info().get("Content-length"))
     bsize = 1_048_576
     try:
-        with open(out_file_path, "wb") as out_handle:
+        with open(part_file_path, "ab" if offset else "wb") as out_handle:
             # Using leave=False as this will be an internally-nested progress bar
             with tqdm(
                 total=file_size,
+                initial=offset,
                 leave=False,
-                desc=f"Downloading {accession_number} {file_type}",
+                desc=desc,
+                disable=not show_progress,
             ) as pbar:
                 while True:
                     buffer = response.read(bsize)
                     if not buffer:
                         break
                     pbar.update(len(buffer))
+                    md5.update(buffer)
                     out_handle.write(buffer)
-    except IOError:
-        logger.error(f"Download failed for {accession_number}", exc_info=1)
-        return
+    finally:
+        response.close()
+
+    downloaded_size = part_file_path.stat().st_size
+    if file_size is not None and downloaded_size != file_size:
+        if downloaded_size > file_size:
+            # the '.part' file cannot be resumed from, so start again on the next try
+            part_file_path.unlink()
+        raise IOError(f"Download of {url} incomplete ({downloaded_size} of {file_size} bytes)")
+
+    digest = md5.hexdigest()
+    if expected_md5 is not None and digest != expected_md5:
+        part_file_path.unlink()
+        raise ChecksumError(f"MD5 checksum of {url} is {digest}, expected {expected_md5}")
+
+    return digest
+
+
+class ChecksumError(IOError):
+    """A downloaded file does not match its expected checksum."""
+
+
+# least recently used assembly directories are evicted once MD5_CHECKSUMS_MAX are cached
+MD5_CHECKSUMS = OrderedDict()  # {assembly directory url: {file name: md5}}
+MD5_CHECKSUMS_MAX = 256
+MD5_CHECKSUMS_LOCK = threading.Lock()
+
+
+def get_expected_md5(url, policy=None):
+    """Retrieve the expected MD5 checksum of a file from the md5checksums.txt file of its directory.
+
+    The md5checksums.txt file is retrieved once per assembly directory, and the checksums of the
+    MD5_CHECKSUMS_MAX most recently used directories are cached.
+
+    :param url: str, url of file to be downloaded
+    :param policy: RetryPolicy, defaults to the process-wide download policy
+
+    Return str, MD5 hex digest, or None if the checksum could not be retrieved.
+    """
+    logger = logging.getLogger(__name__)
+
+    directory_url, file_name = url.rsplit("/", 1)
+
+    with MD5_CHECKSUMS_LOCK:
+        checksums = MD5_CHECKSUMS.get(directory_url)
+        if checksums is not None:
+            MD5_CHECKSUMS.move_to_end(directory_url)
+
+    if checksums is None:
+        if policy is None:
+            policy = get_download_policy()
+
+        try:
+            checksums = policy.run(fetch_md5_checksums, (f"{directory_url}/md5checksums.txt",))
+        except policy.retry_on:
+            logger.warning(f"Failed to retrieve MD5 checksums for {directory_url}", exc_info=1)
+            return None
+
+        with MD5_CHECKSUMS_LOCK:
+            MD5_CHECKSUMS[directory_url] = checksums
+            MD5_CHECKSUMS.move_to_end(directory_url)
+            while len(MD5_CHECKSUMS) > MD5_CHECKSUMS_MAX:
+                MD5_CHECKSUMS.popitem(last=False)
+
+    return checksums.get(file_name)
+
+
+def fetch_md5_checksums(url):
+    """Download and parse an NCBI md5checksums.txt file.
+
+    :param url: str, url of the md5checksums.txt file
+
+    Return dict {file name: md5 hex digest}.
+    """
+    response, _, _ = open_url(url)
+    try:
+        content = response.read().decode("utf-8")
+    finally:
+        response.close()
+
+    checksums = {}
+    for line in content.splitlines():
+        try:
+            digest, file_name = line.split(maxsplit=1)
+        except ValueError:
+            continue
+        file_name = file_name.strip()
+        if file_name.startswith("./"):
+            file_name = file_name[2:]
+        checksums[file_name] = digest.lower()
+
+    return checksums
+
+
+def open_url(url, offset=0):
+    """Open a connection to download a file, starting from the given byte offset.
+
+    HTTP(S) downloads use the pooled keep-alive connections of genbank.transport and are resumed
+    using a byte-range request, and FTP downloads are resumed using a REST offset. If the server
+    does not honour the offset the download restarts from the beginning of the file.
+
+    :param url: str, url of file to be downloaded
+    :param offset: int, number of bytes of the file already downloaded
+
+    Return the response (a file-like object), the total size of the file in bytes (int, or None
+    if unknown), and the offset (int) the response starts from.
+    """
+    scheme = urlparse(url).scheme
+
+    if scheme == "ftp":
+        return open_ftp_url(url, offset)
+
+    if scheme in ("http", "https"):
+        return open_pooled_url(url, offset)
+
+    request = Request(url)
+    if offset:
+        request.add_header("Range", f"bytes={offset}-")
+
+    try:
+        response = urlopen(request, timeout=45)
+    except HTTPError as err:
+        if err.code != 416 or not offset:
+            raise
+        # the offset lies beyond the end of the file, so start again
+        return open_url(url, 0)
+
+    if offset and response.status == 206:
+        # Content-Range: bytes <start>-<end>/<total>
+        file_size = response.headers.get("Content-Range", "").rsplit("/", 1)[-1]
+    else:
+        offset = 0
+        file_size = response.headers.get("Content-length")
+
+    try:
+        file_size = int(file_size)
+    except (TypeError, ValueError):
+        file_size = None
+
+    return response, file_size, offset
+
+
+def open_pooled_url(url, offset=0, redirects=5):
+    """Send an HTTP(S) GET request for a file over a pooled connection, starting from the given offset.
+
+    :param url: str, http(s) url of file to be downloaded
+    :param offset: int, number of bytes of the file already downloaded
+    :param redirects: int, maximum number of redirects followed
+
+    Raises HTTPError for error responses.
+    Return the response (a file-like object), the total size of the file in bytes (int, or None
+    if unknown), and the offset (int) the response starts from.
+    """
+    parsed_url = urlparse(url)
+    pool = get_connection_pool(parsed_url.scheme, parsed_url.hostname, parsed_url.port)
+
+    path = parsed_url.path or "/"
+    if parsed_url.query:
+        path = f"{path}?{parsed_url.query}"
+
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    response = pool.request("GET", path, headers)
+
+    if response.status in (301, 302, 303, 307, 308) or response.status >= 400:
+        # read the (small) body so that the connection can be reused
+        response.read()
+        response.close()
+
+        location = response.headers.get("Location")
+        if response.status < 400 and location and redirects > 0:
+            redirect_url = urljoin(url, location)
+            if urlparse(redirect_url).scheme in ("http", "https"):
+                return open_pooled_url(redirect_url, offset, redirects - 1)
+            return open_url(redirect_url, offset)
+
+        if response.status == 416 and offset:
+            # the offset lies beyond the end of the file, so start again
+            return open_pooled_url(url, 0, redirects)
+
+        raise HTTPError(url, response.status, response.reason, response.headers, None)
+
+    if offset and response.status == 206:
+        # Content-Range: bytes <start>-<end>/<total>
+        file_size = response.headers.get("Content-Range", "").rsplit("/", 1)[-1]
+    else:
+        offset = 0
+        file_size = response.headers.get("Content-length")
+
+    try:
+        file_size = int(file_size)
+    except (TypeError, ValueError):
+        file_size = None
+
+    return response, file_size, offset
+
+
+def open_ftp_url(url, offset=0):
+    """Open an FTP connection to download a file, starting from the given byte offset.
+
+    :param url: str, ftp url of the file to be downloaded
+    :param offset: int, number of bytes of the file already downloaded
+
+    Return the response (a file-like object), the total size of the file in bytes (int, or None
+    if unknown), and the offset (int) the response starts from.
+    """
+    parsed_url = urlparse(url)
+
+    ftp = ftplib.FTP(parsed_url.hostname, timeout=45)
+    try:
+        ftp.login()
+        ftp.voidcmd("TYPE I")
+        file_size = ftp.size(parsed_url.path)
+
+        if file_size is not None and offset >= file_size:
+            offset = 0
+
+        connection = ftp.transfercmd(f"RETR {parsed_url.path}", rest=offset or None)
+    except ftplib.all_errors:
+        ftp.close()
+        raise
+
+    return FTPResponse(ftp, connection), file_size, offset
+
+
+class FTPResponse:
+    """File-like wrapper around an FTP data connection, closing the control connection on close."""
+
+    def __init__(self, ftp, connection):
+        self.ftp = ftp
+        self.connection = connection
+        self.handle = connection.makefile("rb")
+
+    def read(self, size=-1):
+        return self.handle.read(size)
 
-    return
+    def close(self):
+        self.handle.close()
+        self.connection.close()
+        self.ftp.close()
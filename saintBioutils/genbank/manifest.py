@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) University of St Andrews 2020-2021
+# (c) University of Strathclyde 2020-2021
+# (c) James Hutton Institute 2020-2021
+#
+# Author:
+# Emma E. M. Hobbs
+#
+# Contact
+# eemh1@st-andrews.ac.uk
+#
+# Emma E. M. Hobbs,
+# Biomolecular Sciences Building,
+# University of St Andrews,
+# North Haugh Campus,
+# St Andrews,
+# KY16 9ST
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Local manifest of completed downloads"""
+
+
+import logging
+import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from tqdm import tqdm
+
+from saintBioutils.utilities.store import SQLiteStore, get_file_md5
+
+
+class DownloadManifest(SQLiteStore):
+    """SQLite-backed record of completed downloads, keyed by assembly accession and file suffix.
+
+    Lets batch downloads skip files that were already downloaded, without any network traffic.
+    """
+
+    tables = (
+        "CREATE TABLE IF NOT EXISTS downloads ("
+        "accession TEXT NOT NULL, "
+        "suffix TEXT NOT NULL, "
+        "url TEXT NOT NULL, "
+        "path TEXT NOT NULL, "
+        "size INTEGER NOT NULL, "
+        "md5 TEXT, "
+        "completed_at REAL NOT NULL, "
+        "PRIMARY KEY (accession, suffix))",
+    )
+
+    def record(self, accession, suffix, url, path, md5=None):
+        """Record a completed download.
+
+        :param accession: str, assembly accession
+        :param suffix: str, suffix of the downloaded file
+        :param url: str, url the file was downloaded from
+        :param path: Path, path the file was written to
+        :param md5: str, MD5 hex digest of the file
+
+        Return nothing.
+        """
+        path = Path(path)
+        size = path.stat().st_size
+
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO downloads VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (accession, suffix, url, str(path), size, md5, time.time()),
+            )
+
+    def get(self, accession, suffix):
+        """Retrieve the manifest entry of a download.
+
+        :param accession: str, assembly accession
+        :param suffix: str, suffix of the downloaded file
+
+        Return dict of the entry, or None if the download is not recorded.
+        """
+        entries = self.fetch_entries(
+            "SELECT * FROM downloads WHERE accession = ? AND suffix = ?", (accession, suffix), paths=("path",),
+        )
+        return entries[0] if entries else None
+
+    def is_complete(self, accession, suffix):
+        """Check if a download is recorded as complete and the file is still present with the same size.
+
+        Only the local file system is checked.
+
+        :param accession: str, assembly accession
+        :param suffix: str, suffix of the downloaded file
+
+        Return bool.
+        """
+        entry = self.get(accession, suffix)
+        if entry is None:
+            return False
+
+        try:
+            return entry['path'].stat().st_size == entry['size']
+        except OSError:
+            return False
+
+    def remove(self, accession, suffix=None):
+        """Remove entries from the manifest, the downloaded files are not removed.
+
+        :param accession: str, assembly accession
+        :param suffix: str, suffix of the downloaded file, all suffixes are removed if None
+
+        Return nothing.
+        """
+        with self.lock, self.connection:
+            if suffix is None:
+                self.connection.execute("DELETE FROM downloads WHERE accession = ?", (accession,))
+            else:
+                self.connection.execute(
+                    "DELETE FROM downloads WHERE accession = ? AND suffix = ?", (accession, suffix),
+                )
+
+    def entries(self):
+        """Return list of dicts, all entries in the manifest."""
+        return self.fetch_entries("SELECT * FROM downloads", paths=("path",))
+
+    def verify(self, checksums=True, max_workers=4, remove_invalid=False):
+        """Recheck the downloaded files listed in the manifest.
+
+        :param checksums: bool, recalculate MD5 checksums, else only file sizes are checked
+        :param max_workers: int, number of files checked in parallel
+        :param remove_invalid: bool, delete files that fail the check, and their manifest entries,
+            so that they are downloaded again
+
+        Return dict {(accession, suffix): status}, status is 'ok', 'missing', 'size_mismatch'
+        or 'checksum_mismatch'.
+        """
+        logger = logging.getLogger(__name__)
+
+        entries = self.entries()
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            statuses = list(tqdm(
+                executor.map(lambda entry: verify_entry(entry, checksums), entries),
+                total=len(entries),
+                desc="Verifying downloads",
+            ))
+
+        results = {}
+        for entry, status in zip(entries, statuses):
+            results[(entry['accession'], entry['suffix'])] = status
+            if status == 'ok':
+                continue
+
+            logger.warning(f"{entry['path']} failed verification: {status}")
+            if remove_invalid:
+                if status != 'missing':
+                    os.remove(entry['path'])
+                self.remove(entry['accession'], entry['suffix'])
+
+        return results
+
+
+def verify_entry(entry, checksums=True):
+    """Check a downloaded file against its manifest entry.
+
+    :param entry: dict, manifest entry
+    :param checksums: bool, recalculate the MD5 checksum, else only the file size is checked
+
+    Return str, 'ok', 'missing', 'size_mismatch' or 'checksum_mismatch'.
+    """
+    try:
+        size = entry['path'].stat().st_size
+    except OSError:
+        return 'missing'
+
+    if size != entry['size']:
+        return 'size_mismatch'
+
+    if checksums and entry['md5'] is not None and get_file_md5(entry['path']) != entry['md5']:
+        return 'checksum_mismatch'
+
+    return 'ok'
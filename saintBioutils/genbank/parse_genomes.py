@@ -43,11 +43,56 @@
 
 import gzip
 import logging
+import os
+import re
+import traceback
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from Bio import SeqIO
+from tqdm import tqdm
+
+from saintBioutils.genbank.dedup import SequenceHashSet, hash_sequence
+from saintBioutils.genbank.protein_table import open_protein_table
+from saintBioutils.utilities.file_io.compression import open_gzip
+from saintBioutils.utilities.file_io.fasta import FastaWriter
+
+
+ENGINES = ("biopython", "scan")
+
+# column at which locations and qualifiers start in the GenBank feature table
+FEATURE_QUALIFIER_INDENT = 21
+FEATURE_QUALIFIER_SPACER = " " * FEATURE_QUALIFIER_INDENT
 
 
-def extract_protein_seqs(assembly_path, accession, txid, target_dir, filestem="genbank_proteins"):
+# Lightweight stand-in for a BioPython SeqFeature, as built by scan_features()
+# qualifiers is a dict keyed by qualifier name and valued by lists of values, as for SeqFeature
+ScannedFeature = namedtuple("ScannedFeature", ["type", "location", "qualifiers"])
+
+# Protein yielded by iter_assembly_proteins()
+# location is a tuple (start, end, strand), see get_feature_location()
+ProteinRecord = namedtuple(
+    "ProteinRecord", ["protein_id", "locus_tag", "translation", "contig", "location"],
+)
+
+# positions, ranges and brackets in a GenBank feature location
+LOCATION_TOKEN = re.compile(
+    r"complement\(|\(|\)|(?P<ref>[A-Za-z][\w.]*:)?[<>]?(?P<first>\d+)(?:(?P<sep>\.\.|\^)[<>]?(?P<last>\d+))?"
+)
+
+
+def extract_protein_seqs(
+    assembly_path,
+    accession,
+    txid,
+    target_dir,
+    filestem="genbank_proteins",
+    engine="biopython",
+    compression=None,
+    index=False,
+    checkpoint=None,
+):
     """Retrieve annoated protein sequences from genomic assembly and write to a single FASTA file.
 
     :param assemly_path: Path to genomic assembly
@@ -55,45 +100,620 @@ def extract_protein_seqs(assembly_path, accession, txid, target_dir, filestem="g
     :param txid: str, NCBI taxonomy id of the host species
     :param target_dir: Path, directory to write out FASTA of extract protein seqs to
     :param filestem: str, file name prefix
+    :param engine: str, 'biopython' to parse the assembly with BioPython SeqIO, or 'scan' to
+        use the faster scan_features(), which only reads the feature tables. Both engines
+        write identical FASTA files.
+    :param compression: str, None to write plain text FASTA, or 'gzip' or 'bgzf' to write a
+        compressed FASTA file (with the suffix '.fasta.gz')
+    :param index: bool, also write a samtools faidx compatible index (.fai, plus .gzi for
+        'bgzf'), so proteins can be retrieved with FastaIndex(fasta_path).fetch(protein_id).
+        Not supported for 'gzip' compression.
+    :param checkpoint: ExtractionCheckpoint, skip the assembly if the checkpoint records it
+        as extracted and it is unchanged. Otherwise the FASTA file is written atomically,
+        replacing any existing file rather than appending to it, and recorded in the checkpoint.
 
     Return path to FASTA file containing the protein sequences from the assembly.
     """
     logger = logging.getLogger(__name__)
 
     # build path to the output FASTA file
-    fasta_path = target_dir / f"{filestem}_{txid}_{accession}.fasta"
+    fasta_path = get_fasta_path(target_dir, filestem, txid, accession, compression)
+
+    if checkpoint is not None and checkpoint.is_complete(accession, assembly_path, fasta_path):
+        logger.info(f"Proteins from genomic assembly {accession} already extracted, skipping")
+        return fasta_path
+
+    protein_count = write_protein_fasta(
+        assembly_path, accession, fasta_path, engine, compression, index, atomic=checkpoint is not None,
+    )
+
+    if checkpoint is not None:
+        checkpoint.record(accession, assembly_path, fasta_path, protein_count)
+
+    logger.warning(f"{protein_count} proteins in genomic assembly {accession}")
+
+    return fasta_path
+
+
+def extract_protein_seqs_batch(
+    assemblies,
+    target_dir,
+    filestem="genbank_proteins",
+    engine="biopython",
+    max_workers=None,
+    compression=None,
+    index=False,
+    checkpoint=None,
+):
+    """Extract the protein sequences from many genomic assemblies using a pool of processes.
+
+    Each assembly is written to its own FASTA file, as for extract_protein_seqs(). An error
+    while parsing one assembly is logged and recorded in the summary, and does not stop the
+    other assemblies being parsed.
+
+    :param assemblies: list of tuples (Path to genomic assembly, assembly accession, txid)
+    :param target_dir: Path, directory to write out FASTA files of extract protein seqs to
+    :param filestem: str, file name prefix
+    :param engine: str, 'biopython' or 'scan', see extract_protein_seqs()
+    :param max_workers: int, number of worker processes, defaults to the number of CPUs
+    :param compression: str, None, 'gzip' or 'bgzf', see extract_protein_seqs()
+    :param index: bool, write a .fai (and .gzi) index for each FASTA file, see extract_protein_seqs()
+    :param checkpoint: ExtractionCheckpoint, skip unchanged assemblies that were already
+        extracted, and write and record the others atomically, see extract_protein_seqs()
+
+    Return dict {accession: {'fasta_path': Path, 'protein_count': int or None, 'error': str or None,
+    'skipped': bool}}, in the same order as the assemblies were given.
+    """
+    logger = logging.getLogger(__name__)
+
+    results = {}  # {accession: {'fasta_path': Path, 'protein_count': int, 'error': str, 'skipped': bool}}
+    assembly_paths = {}  # {accession: Path to genomic assembly}
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for assembly_path, accession, txid in assemblies:
+            fasta_path = get_fasta_path(target_dir, filestem, txid, accession, compression)
+            results[accession] = {
+                'fasta_path': fasta_path, 'protein_count': None, 'error': None, 'skipped': False,
+            }
+
+            if checkpoint is not None and checkpoint.is_complete(accession, assembly_path, fasta_path):
+                results[accession]['protein_count'] = checkpoint.get(accession)['protein_count']
+                results[accession]['skipped'] = True
+                continue
+
+            future = executor.submit(
+                extract_protein_seqs_worker,
+                assembly_path,
+                accession,
+                fasta_path,
+                engine,
+                compression,
+                index,
+                checkpoint is not None,
+            )
+            futures[future] = accession
+            assembly_paths[accession] = assembly_path
+
+        with tqdm(total=len(futures), desc="Extracting protein sequences") as pbar:
+            for future in as_completed(futures):
+                accession = futures[future]
+                try:
+                    protein_count, error = future.result()
+                except Exception as err:  # e.g. the worker process died
+                    protein_count, error = None, repr(err)
+
+                results[accession]['protein_count'] = protein_count
+                results[accession]['error'] = error
+                if error is not None:
+                    logger.error(f"Failed to extract protein sequences from {accession}:\n{error}")
+                elif checkpoint is not None:
+                    checkpoint.record(
+                        accession, assembly_paths[accession], results[accession]['fasta_path'], protein_count,
+                    )
+                pbar.update(1)
+
+    failed = [acc for acc in results if results[acc]['error'] is not None]
+    skipped = [acc for acc in results if results[acc]['skipped']]
+    logger.warning(
+        f"Extracted {sum(r['protein_count'] or 0 for r in results.values())} proteins from "
+        f"{len(results) - len(failed)} genomic assemblies ({len(skipped)} already extracted), "
+        f"{len(failed)} assemblies failed"
+    )
+
+    return results
+
+
+def extract_unique_protein_seqs(
+    assemblies,
+    fasta_path,
+    mapping_path,
+    seen,
+    engine="biopython",
+    compression=None,
+    index=False,
+    batch_size=10000,
+):
+    """Write each distinct protein sequence from many genomic assemblies to a FASTA file once.
+
+    Sequences are identified by their hash (see hash_sequence()). Each unique sequence is
+    written once, with the header '<hash> <protein_id> <locus_tag>' of the first protein
+    found with the sequence. Every protein, including duplicates, is written to a tab
+    separated mapping table with the columns: sequence_hash, protein_id, locus_tag,
+    assembly, txid.
+
+    The hashes of sequences already written are kept in a disk-backed SequenceHashSet, so
+    memory use does not grow with the number of proteins, and further assemblies can be
+    added to the same output in later runs by reusing the same set and output files.
+
+    Each assembly is committed to the set only once its FASTA records and mapping rows have
+    been written to disk, and assemblies already committed are skipped, so an interrupted run
+    can be resumed with the same arguments. Sequences from the assembly being processed when
+    the run was interrupted may be written to the FASTA file twice, but none are lost.
+
+    :param assemblies: list of tuples (Path to genomic assembly, assembly accession, txid)
+    :param fasta_path: Path, FASTA file to append unique protein sequences to
+    :param mapping_path: Path, mapping table to append to, gzip compressed if the path ends in '.gz'
+    :param seen: SequenceHashSet, or Path to its SQLite database
+    :param engine: str, 'biopython' or 'scan', see extract_protein_seqs()
+    :param compression: str, None, 'gzip' or 'bgzf', compression of the FASTA file
+    :param index: bool, write a .fai (and .gzi) index of the FASTA file, with the
+        sequence hashes as the sequence names
+    :param batch_size: int, number of proteins hashed and checked against the set per query
+
+    Return dict {'proteins': int, total number of proteins, 'unique': int, number of
+    sequences written to the FASTA file, 'skipped': int, number of assemblies already in the set}.
+    """
+    logger = logging.getLogger(__name__)
+
+    counts = {'proteins': 0, 'unique': 0, 'skipped': 0}
+
+    close_seen = not isinstance(seen, SequenceHashSet)
+    if close_seen:
+        seen = SequenceHashSet(seen)
+
+    write_header = not os.path.isfile(mapping_path) or os.path.getsize(mapping_path) == 0
+    open_func = gzip.open if str(mapping_path).endswith(".gz") else open
+
+    try:
+        with FastaWriter(fasta_path, "a", compression=compression, index=index) as writer, \
+                open_func(mapping_path, "at") as mapping:
+            if write_header:
+                mapping.write("sequence_hash\tprotein_id\tlocus_tag\tassembly\ttxid\n")
+
+            def write_batch(batch, new_hashes, mapping_lines):
+                hashes = [hash_sequence(protein[2]) for protein in batch]
+                for seq_hash, is_new, (protein_id, locus_tag, seq, accession, txid) in zip(
+                    hashes, seen.filter_new(hashes), batch,
+                ):
+                    if is_new and seq_hash not in new_hashes:
+                        writer.write(f"{seq_hash} {protein_id} {locus_tag}", seq)
+                        new_hashes.add(seq_hash)
+                        counts['unique'] += 1
+                    mapping_lines.append(
+                        f"{seq_hash}\t{protein_id}\t{locus_tag}\t{accession}\t{txid}\n"
+                    )
+                counts['proteins'] += len(batch)
+
+            for assembly_path, accession, txid in tqdm(assemblies, desc="Deduplicating protein sequences"):
+                if seen.has_assembly(accession):
+                    logger.info(f"Proteins from genomic assembly {accession} already deduplicated, skipping")
+                    counts['skipped'] += 1
+                    continue
+
+                new_hashes = set()  # hashes of the sequences from this assembly written to the FASTA file
+                mapping_lines = []  # written once the whole assembly is parsed
+
+                batch = []
+                for protein in iter_assembly_proteins(assembly_path, accession, engine):
+                    batch.append(
+                        (protein.protein_id, protein.locus_tag, protein.translation, accession, txid)
+                    )
+                    if len(batch) >= batch_size:
+                        write_batch(batch, new_hashes, mapping_lines)
+                        batch = []
+
+                if batch:
+                    write_batch(batch, new_hashes, mapping_lines)
+
+                mapping.write("".join(mapping_lines))
+
+                # only commit the hashes once the records they stand for are on disk
+                writer.sync()
+                mapping.flush()
+                os.fsync(mapping.fileno())
+                seen.add_assembly(accession, new_hashes)
+    finally:
+        if close_seen:
+            seen.close()
+
+    logger.warning(
+        f"Wrote {counts['unique']} unique protein sequences of {counts['proteins']} proteins "
+        f"from {len(assemblies) - counts['skipped']} genomic assemblies "
+        f"({counts['skipped']} already deduplicated)"
+    )
+
+    return counts
+
+
+def extract_protein_table(
+    assemblies,
+    table_path,
+    backend="sqlite",
+    engine="biopython",
+    batch_size=10000,
+):
+    """Write the protein sequences from many genomic assemblies, with their metadata, to a table.
+
+    Unlike the FASTA output of extract_protein_seqs(), the assembly accession, txid,
+    protein_id, locus_tag, length and sequence of each protein are stored in separate
+    columns, so proteins can be filtered (e.g. with query_protein_table()) without parsing
+    FASTA headers.
+
+    :param assemblies: list of tuples (Path to genomic assembly, assembly accession, txid)
+    :param table_path: Path, SQLite database (appended to if it exists) or Parquet file
+    :param backend: str, 'sqlite' or 'parquet' (requires pyarrow)
+    :param engine: str, 'biopython' or 'scan', see extract_protein_seqs()
+    :param batch_size: int, number of proteins per batched insert or Parquet row group
+
+    Return int, number of proteins written.
+    """
+    logger = logging.getLogger(__name__)
 
     protein_count = 0
 
-    with open(fasta_path, "a") as fh:
-        with gzip.open(assembly_path, "rt") as handle:  # unzip the genomic assembly
-            # parse proteins in the genomic assembly
-            for gb_record in SeqIO.parse(handle, "genbank"):
-                for (index, feature) in enumerate(gb_record.features):
-                    # Parse over only protein encoding features (type = 'CDS')
-                    if feature.type == "CDS":
-                        # retrieve data from protein feature record
-                        protein_id = get_record_feature(feature, "protein_id", accession)
-                        locus_tag = get_record_feature(feature, "locus_tag", accession)
-                        # extract protein sequence
-                        seq = get_record_feature(feature, "translation", accession)
-                        if seq is None:
-                            continue
+    with open_protein_table(table_path, backend, batch_size) as table:
+        for assembly_path, accession, txid in tqdm(assemblies, desc="Extracting protein sequences"):
+            for protein in iter_assembly_proteins(assembly_path, accession, engine):
+                table.write(
+                    accession, txid, protein.protein_id, protein.locus_tag, protein.translation,
+                )
+                protein_count += 1
 
-                        # create file content for writing protein to fasta file
-                        # FASTA sequences have 60 characters per line
-                        seq = "\n".join([seq[i : i + 60] for i in range(0, len(seq), 60)])
-                        protein_id = protein_id + " " + locus_tag
+    logger.warning(f"Wrote {protein_count} proteins from {len(assemblies)} genomic assemblies to {table_path}")
 
-                        file_content = f">{protein_id} \n{seq}\n"
+    return protein_count
 
-                        fh.write(file_content)
 
-                        protein_count += 1
+def extract_protein_seqs_worker(
+    assembly_path, accession, fasta_path, engine, compression=None, index=False, atomic=False,
+):
+    """Extract the protein sequences from one genomic assembly, for use by extract_protein_seqs_batch().
 
-    logger.warning(f"{protein_count} proteins in genomic assembly {accession}")
+    :param assembly_path: Path to genomic assembly
+    :param accession: str, accession number of the genomic assembly
+    :param fasta_path: Path, FASTA file to write the protein sequences to
+    :param engine: str, 'biopython' or 'scan', see extract_protein_seqs()
+    :param compression: str, None, 'gzip' or 'bgzf', see extract_protein_seqs()
+    :param index: bool, write a .fai (and .gzi) index, see extract_protein_seqs()
+    :param atomic: bool, replace the FASTA file atomically instead of appending to it,
+        see write_protein_fasta()
 
-    return fasta_path
+    Return tuple (number of proteins written (int) or None, formatted traceback (str) or None)
+    """
+    try:
+        protein_count = write_protein_fasta(
+            assembly_path, accession, fasta_path, engine, compression, index, atomic,
+        )
+        return protein_count, None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+def get_fasta_path(target_dir, filestem, txid, accession, compression=None):
+    """Build the path to the FASTA file the proteins from an assembly are written to.
+
+    :param target_dir: Path, directory to write out FASTA of extract protein seqs to
+    :param filestem: str, file name prefix
+    :param txid: str, NCBI taxonomy id of the host species
+    :param accession: str, accession number of the genomic assembly
+    :param compression: str, None, 'gzip' or 'bgzf'
+
+    Return Path.
+    """
+    suffix = ".fasta" if compression is None else ".fasta.gz"
+    return target_dir / f"{filestem}_{txid}_{accession}{suffix}"
+
+
+def write_protein_fasta(
+    assembly_path,
+    accession,
+    fasta_path,
+    engine="biopython",
+    compression=None,
+    index=False,
+    atomic=False,
+):
+    """Append the annotated protein sequences from a genomic assembly to a FASTA file.
+
+    :param assembly_path: Path to genomic assembly
+    :param accession: str, accession number of the genomic assembly
+    :param fasta_path: Path, FASTA file to write the protein sequences to
+    :param engine: str, 'biopython' or 'scan', see extract_protein_seqs()
+    :param compression: str, None, 'gzip' or 'bgzf', see extract_protein_seqs()
+    :param index: bool, write a .fai (and .gzi) index, see extract_protein_seqs()
+    :param atomic: bool, write to a temporary '.part' file which then replaces the FASTA file
+        (and its index), so the FASTA file is never left partially written and proteins
+        from a failed run are never duplicated
+
+    Return int, number of proteins written.
+    """
+    protein_count = 0
+
+    out_path = f"{fasta_path}.part" if atomic else fasta_path
+    mode = "w" if atomic else "a"
+
+    try:
+        with FastaWriter(out_path, mode, compression=compression, index=index) as writer:
+            for protein in iter_assembly_proteins(assembly_path, accession, engine):
+                # FastaWriter wraps sequences to 60 characters per line
+                writer.write(f"{protein.protein_id} {protein.locus_tag} ", protein.translation)
+
+                protein_count += 1
+    except Exception:
+        if atomic:
+            for path in (out_path, f"{out_path}.fai", f"{out_path}.gzi"):
+                if os.path.isfile(path):
+                    os.remove(path)
+        raise
+
+    if atomic:
+        # replace the index along with the FASTA file, removing an index of the old file
+        for index_suffix in (".fai", ".gzi"):
+            if os.path.isfile(f"{out_path}{index_suffix}"):
+                os.replace(f"{out_path}{index_suffix}", f"{fasta_path}{index_suffix}")
+            elif os.path.isfile(f"{fasta_path}{index_suffix}"):
+                os.remove(f"{fasta_path}{index_suffix}")
+        os.replace(out_path, fasta_path)
+
+    return protein_count
+
+
+def iter_assembly_proteins(assembly_path, accession=None, engine="biopython"):
+    """Iterate over the annotated proteins in a genomic assembly, without writing any files.
+
+    :param assembly_path: Path to genomic assembly
+    :param accession: str, accession number of the genomic assembly, used in log messages
+    :param engine: str, 'biopython' or 'scan', see extract_protein_seqs()
+
+    Yields ProteinRecord. CDS features without a translation are skipped. Both engines
+    yield identical records.
+    """
+    with open_gzip(assembly_path, "rt") as handle:  # unzip the genomic assembly
+        # parse proteins in the genomic assembly
+        # Parse over only protein encoding features (type = 'CDS')
+        for contig, feature in iter_features(handle, engine, feature_types={"CDS"}):
+            # extract protein sequence
+            seq = get_record_feature(feature, "translation", accession)
+            if seq is None:
+                continue
+
+            yield ProteinRecord(
+                get_record_feature(feature, "protein_id", accession),
+                get_record_feature(feature, "locus_tag", accession),
+                seq,
+                contig,
+                get_feature_location(feature),
+            )
+
+
+def get_feature_location(feature):
+    """Retrieve the span of a feature on its contig.
+
+    :param feature: BioPython SeqFeature or ScannedFeature
+
+    Return tuple (start, end, strand), with 0-based start and exclusive end as for BioPython.
+    Strand is 1 or -1, or None if the parts of a compound location are on different strands.
+    All values are None if the location cannot be parsed.
+    """
+    if isinstance(feature, ScannedFeature):
+        return parse_location(feature.location)
+
+    location = feature.location
+    if location is None:
+        return None, None, None
+    return int(location.start), int(location.end), location.strand
+
+
+def parse_location(location):
+    """Parse a GenBank feature location string, e.g. 'complement(join(1..100,200..>300))'.
+
+    As for BioPython, parts of the location on other sequences (e.g. 'J00194.1:100..202') are
+    included in the span, so 'join(J00194.1:100..202,1..5)' spans 0 to 202.
+
+    :param location: str, GenBank location
+
+    Return tuple (start, end, strand), see get_feature_location().
+    """
+    starts, ends, strands = [], [], []
+    complements = []  # for each open bracket, if it opens a complement()
+
+    for match in LOCATION_TOKEN.finditer(location):
+        token = match.group(0)
+        if token == "complement(":
+            complements.append(True)
+        elif token == "(":
+            complements.append(False)
+        elif token == ")":
+            if complements:
+                complements.pop()
+        else:
+            first = int(match.group("first"))
+            if match.group("sep") == "..":
+                start, end = first - 1, int(match.group("last"))
+            elif match.group("sep") == "^":
+                start, end = first, first  # site between two bases
+            else:
+                start, end = first - 1, first
+            starts.append(start)
+            ends.append(end)
+            strands.append(-1 if sum(complements) % 2 else 1)
+
+    if not starts:
+        return None, None, None
+
+    strand = strands[0] if len(set(strands)) == 1 else None
+    return min(starts), max(ends), strand
+
+
+def iter_features(handle, engine="biopython", feature_types=None):
+    """Iterate over the features in a GenBank file.
+
+    :param handle: open text handle of a GenBank file
+    :param engine: str, 'biopython' to parse with BioPython SeqIO, 'scan' to use scan_features()
+    :param feature_types: set of str, feature types to retrieve (e.g. {'CDS'}), all if None
+
+    Yields tuple (contig id, feature), the feature is a BioPython SeqFeature or ScannedFeature.
+    """
+    if engine == "biopython":
+        for gb_record in SeqIO.parse(handle, "genbank"):
+            for feature in gb_record.features:
+                if feature_types is None or feature.type in feature_types:
+                    yield gb_record.id, feature
+
+    elif engine == "scan":
+        yield from scan_features(handle, feature_types)
+
+    else:
+        raise ValueError(f"Unknown engine '{engine}', expected one of {ENGINES}")
+
+
+def scan_features(handle, feature_types=None):
+    """Scan the feature tables of a GenBank file line by line, without building SeqRecords.
+
+    Only the LOCUS, VERSION and FEATURES sections are read; sequence data (ORIGIN) is skipped.
+    Qualifier values are cleaned in the same way as by BioPython, so get_record_feature()
+    returns the same values for a ScannedFeature as for the equivalent BioPython SeqFeature.
+
+    :param handle: open text handle of a GenBank file
+    :param feature_types: set of str, feature types to retrieve (e.g. {'CDS'}), all if None
+
+    Yields tuple (contig id, ScannedFeature).
+    """
+    contig = None
+    in_features, in_sequence = False, False
+    feature = None  # [type, list of lines]
+
+    for line in handle:
+        if in_sequence:
+            # skip the sequence to the end of the record
+            if line.startswith("//"):
+                in_sequence = False
+            continue
+
+        if not in_features:
+            if line.startswith("LOCUS"):
+                fields = line.split()
+                contig = fields[1] if len(fields) > 1 else None
+            elif line.startswith("VERSION"):
+                fields = line.split()
+                if len(fields) > 1:
+                    contig = fields[1]
+            elif line.startswith("FEATURES"):
+                in_features = True
+            continue
+
+        if line.startswith(FEATURE_QUALIFIER_SPACER):
+            # location or qualifier line of the current feature
+            if feature is not None:
+                feature[1].append(line[FEATURE_QUALIFIER_INDENT:].strip())
+            continue
+
+        if not line.strip():
+            continue  # blank lines within a feature
+
+        if feature is not None:
+            yield contig, build_scanned_feature(*feature)
+            feature = None
+
+        if line.startswith("     "):
+            # start of a new feature
+            feature_type = line[5:FEATURE_QUALIFIER_INDENT].strip()
+            if feature_types is None or feature_type in feature_types:
+                feature = [feature_type, [line[FEATURE_QUALIFIER_INDENT:].strip()]]
+        else:
+            # end of the feature table, e.g. ORIGIN, CONTIG or '//'
+            in_features = False
+            in_sequence = not line.startswith("//")
+
+    if feature is not None:
+        yield contig, build_scanned_feature(*feature)
+
+
+def build_scanned_feature(feature_type, lines):
+    """Build a ScannedFeature from the lines of a feature in a GenBank feature table.
+
+    :param feature_type: str, feature type, e.g. 'CDS'
+    :param lines: list of str, location and qualifier lines, stripped of their indentation
+
+    Return ScannedFeature.
+    """
+    lines = [line for line in lines if line]
+
+    # locations can be wrapped over multiple lines
+    location, index = lines[0], 1
+    while index < len(lines) and (
+        location.endswith(",") or location.count("(") > location.count(")")
+    ):
+        location += lines[index]
+        index += 1
+
+    qualifiers = {}
+    key, parts, open_quote = None, None, False
+
+    for line in lines[index:]:
+        if open_quote or line[0] != "/":
+            # continuation of the current qualifier value
+            if parts is not None:
+                parts.append(line)
+                if open_quote and line.endswith('"'):
+                    open_quote = False
+            continue
+
+        if key is not None:
+            add_qualifier(qualifiers, key, parts)
+
+        equals = line.find("=")
+        if equals == -1:
+            key, parts = line[1:], None  # qualifiers without a value, e.g. /pseudo
+            continue
+
+        key, value = line[1:equals], line[equals + 1:]
+        if value.lstrip().startswith('"'):
+            value = value.lstrip()
+        parts = [value]
+        open_quote = value.startswith('"') and (len(value) == 1 or not value.endswith('"'))
+
+    if key is not None:
+        add_qualifier(qualifiers, key, parts)
+
+    return ScannedFeature(feature_type, location, qualifiers)
+
+
+def add_qualifier(qualifiers, key, parts):
+    """Clean a qualifier value in the same way as BioPython and add it to the qualifiers.
+
+    :param qualifiers: dict, {qualifier: [values]}
+    :param key: str, qualifier name
+    :param parts: list of str, lines of the qualifier value, None for qualifiers without a value
+
+    Return nothing.
+    """
+    if parts is None:
+        qualifiers.setdefault(key, [""])
+        return
+
+    value = " ".join(parts)
+
+    # remove enclosing quotation marks and undo NCBI escaping of quotes
+    if len(value) > 1 and value[0] == '"' and value[-1] == '"':
+        value = value[1:-1]
+    value = value.replace('""', '"')
+
+    if key == "translation":
+        value = "".join(value.split())
+
+    qualifiers.setdefault(key, []).append(value)
 
 
 def get_record_feature(feature, qualifier, accession):
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) University of St Andrews 2020-2021
+# (c) University of Strathclyde 2020-2021
+# (c) James Hutton Institute 2020-2021
+#
+# Author:
+# Emma E. M. Hobbs
+#
+# Contact
+# eemh1@st-andrews.ac.uk
+#
+# Emma E. M. Hobbs,
+# Biomolecular Sciences Building,
+# University of St Andrews,
+# North Haugh Campus,
+# St Andrews,
+# KY16 9ST
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Tabular (SQLite or Parquet) output of extracted protein sequences and their metadata"""
+
+
+import sqlite3
+
+from pathlib import Path
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+BACKENDS = ("sqlite", "parquet")
+COLUMNS = ("assembly", "txid", "protein_id", "locus_tag", "length", "sequence")
+
+
+def open_protein_table(path, backend="sqlite", batch_size=10000):
+    """Open a protein table for writing.
+
+    :param path: Path to the SQLite database or Parquet file
+    :param backend: str, 'sqlite' or 'parquet'
+    :param batch_size: int, number of proteins buffered before each batched write
+
+    Return SqliteProteinTable or ParquetProteinTable.
+    """
+    if backend == "sqlite":
+        return SqliteProteinTable(path, batch_size=batch_size)
+    if backend == "parquet":
+        return ParquetProteinTable(path, batch_size=batch_size)
+    raise ValueError(f"Unknown protein table backend '{backend}', expected one of {BACKENDS}")
+
+
+class SqliteProteinTable:
+    """SQLite table of protein sequences, with the assembly, txid, protein_id, locus_tag and length of each.
+
+    Proteins are inserted in batches. The table is indexed by txid, assembly and
+    protein_id, so filtered queries do not scan the whole table. Opening an existing
+    database appends to it.
+    """
+
+    def __init__(self, db_path, batch_size=10000):
+        """Open (and create if needed) the database.
+
+        :param db_path: Path, path to the SQLite database file
+        :param batch_size: int, number of proteins buffered before each batched insert
+        """
+        self.db_path = Path(db_path)
+        self.batch_size = batch_size
+        self.batch = []
+
+        self.connection = sqlite3.connect(str(self.db_path))
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS proteins ("
+                "assembly TEXT NOT NULL, "
+                "txid TEXT, "
+                "protein_id TEXT, "
+                "locus_tag TEXT, "
+                "length INTEGER NOT NULL, "
+                "sequence TEXT NOT NULL)"
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, assembly, txid, protein_id, locus_tag, seq):
+        """Add a protein to the table.
+
+        :param assembly: str, accession of the genomic assembly
+        :param txid: str, NCBI taxonomy id of the host species
+        :param protein_id: str
+        :param locus_tag: str
+        :param seq: str, protein sequence
+
+        Return nothing.
+        """
+        self.batch.append((assembly, txid, protein_id, locus_tag, len(seq), seq))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Insert all buffered proteins.
+
+        Return nothing.
+        """
+        if self.batch:
+            with self.connection:
+                self.connection.executemany(
+                    "INSERT INTO proteins VALUES (?, ?, ?, ?, ?, ?)", self.batch,
+                )
+            self.batch = []
+
+    def close(self):
+        """Insert all buffered proteins, build the indexes and close the database.
+
+        The indexes are built once all proteins are inserted, which is faster than
+        updating them on every insert.
+
+        Return nothing.
+        """
+        self.flush()
+        with self.connection:
+            for column in ("txid", "assembly", "protein_id"):
+                self.connection.execute(
+                    f"CREATE INDEX IF NOT EXISTS proteins_{column} ON proteins ({column})"
+                )
+        self.connection.close()
+
+    def query(self, txid=None, assembly=None, protein_id=None):
+        """Retrieve proteins from the table.
+
+        :param txid: str, only retrieve proteins from this taxonomy id
+        :param assembly: str, only retrieve proteins from this genomic assembly
+        :param protein_id: str, only retrieve proteins with this protein_id
+
+        Return list of dicts, keyed by COLUMNS.
+        """
+        return query_protein_table(self.db_path, txid, assembly, protein_id, self.connection)
+
+
+def query_protein_table(db_path, txid=None, assembly=None, protein_id=None, connection=None):
+    """Retrieve proteins from a SQLite protein table.
+
+    :param db_path: Path, path to the SQLite database file
+    :param txid: str, only retrieve proteins from this taxonomy id
+    :param assembly: str, only retrieve proteins from this genomic assembly
+    :param protein_id: str, only retrieve proteins with this protein_id
+    :param connection: sqlite3.Connection, open connection to use instead of connecting to db_path
+
+    Return list of dicts, keyed by COLUMNS.
+    """
+    filters = {'txid': txid, 'assembly': assembly, 'protein_id': protein_id}
+    filters = {column: value for column, value in filters.items() if value is not None}
+
+    sql = f"SELECT {', '.join(COLUMNS)} FROM proteins"
+    if filters:
+        sql += " WHERE " + " AND ".join([f"{column} = ?" for column in filters])
+
+    close_connection = connection is None
+    if close_connection:
+        connection = sqlite3.connect(str(db_path))
+    try:
+        rows = connection.execute(sql, tuple(filters.values())).fetchall()
+    finally:
+        if close_connection:
+            connection.close()
+
+    return [dict(zip(COLUMNS, row)) for row in rows]
+
+
+class ParquetProteinTable:
+    """Parquet file of protein sequences, with the assembly, txid, protein_id, locus_tag and length of each.
+
+    Each batch of proteins is written as a row group. Requires pyarrow. Parquet files
+    cannot be appended to, so an existing file is overwritten.
+    """
+
+    def __init__(self, path, batch_size=10000, compression="zstd"):
+        """Open the Parquet file for writing.
+
+        :param path: Path to the Parquet file
+        :param batch_size: int, number of proteins per row group
+        :param compression: str, Parquet compression codec
+        """
+        if pyarrow is None:
+            raise ImportError("pyarrow is required to write Parquet files, install it with 'pip install pyarrow'")
+
+        self.path = Path(path)
+        self.batch_size = batch_size
+        self.batch = []
+        self.schema = pyarrow.schema([
+            ("assembly", pyarrow.string()),
+            ("txid", pyarrow.string()),
+            ("protein_id", pyarrow.string()),
+            ("locus_tag", pyarrow.string()),
+            ("length", pyarrow.int32()),
+            ("sequence", pyarrow.string()),
+        ])
+        self.writer = pyarrow.parquet.ParquetWriter(str(self.path), self.schema, compression=compression)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, assembly, txid, protein_id, locus_tag, seq):
+        """Add a protein to the table.
+
+        :param assembly: str, accession of the genomic assembly
+        :param txid: str, NCBI taxonomy id of the host species
+        :param protein_id: str
+        :param locus_tag: str
+        :param seq: str, protein sequence
+
+        Return nothing.
+        """
+        self.batch.append((assembly, None if txid is None else str(txid), protein_id, locus_tag, len(seq), seq))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write all buffered proteins as a row group.
+
+        Return nothing.
+        """
+        if self.batch:
+            columns = list(zip(*self.batch))
+            self.writer.write_table(pyarrow.Table.from_arrays(
+                [pyarrow.array(column, type=field.type) for column, field in zip(columns, self.schema)],
+                schema=self.schema,
+            ))
+            self.batch = []
+
+    def close(self):
+        """Write all buffered proteins and close the file.
+
+        Return nothing.
+        """
+        self.flush()
+        self.writer.close()
@@ -0,0 +1,431 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) University of St Andrews 2020-2021
+# (c) University of Strathclyde 2020-2021
+# (c) James Hutton Institute 2020-2021
+#
+# Author:
+# Emma E. M. Hobbs
+#
+# Contact
+# eemh1@st-andrews.ac.uk
+#
+# Emma E. M. Hobbs,
+# Biomolecular Sciences Building,
+# University of St Andrews,
+# North Haugh Campus,
+# St Andrews,
+# KY16 9ST
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Rate limiting and retry policies for calls to NCBI"""
+
+
+import asyncio
+import ftplib
+import logging
+import os
+import random
+import threading
+import time
+
+from email.utils import parsedate_to_datetime
+from urllib.error import HTTPError
+
+from Bio import Entrez
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+
+class TokenBucket:
+    """Token bucket rate limiter, shared between threads and optionally between processes.
+
+    When a lock_path is given, the bucket state is stored in that file and guarded with an
+    exclusive file lock, so that all processes using the same lock_path share one bucket.
+    """
+
+    def __init__(self, rate, capacity=None, lock_path=None):
+        """Build the rate limiter.
+
+        :param rate: float, number of tokens (requests) added to the bucket per second
+        :param capacity: float, maximum number of tokens in the bucket, defaults to rate
+        :param lock_path: Path, file used to share the bucket between processes
+        """
+        logger = logging.getLogger(__name__)
+
+        self.rate = rate
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.tokens = None
+        self.last = None
+
+        if lock_path is not None and fcntl is None:
+            logger.warning("File locking is not available, rate limit is shared between threads only")
+            lock_path = None
+        self.lock_path = lock_path
+
+    def get_rate(self):
+        """Return float, number of tokens added to the bucket per second."""
+        return self.rate
+
+    def get_capacity(self):
+        """Return float, maximum number of tokens held by the bucket."""
+        return self.capacity if self.capacity is not None else self.get_rate()
+
+    def acquire(self):
+        """Block until a token is available, and take it.
+
+        Return nothing.
+        """
+        while True:
+            wait = self.try_acquire()
+            if wait <= 0:
+                return
+
+            time.sleep(wait)
+
+    def try_acquire(self):
+        """Take a token if one is available, without blocking.
+
+        Return float, 0 if a token was taken, else the number of seconds until one is available.
+        """
+        with self.lock:
+            if self.lock_path is None:
+                return self.take_token()
+            return self.take_shared_token()
+
+    def take_token(self):
+        """Take a token from the in-process bucket.
+
+        Return float, 0 if a token was taken, else the number of seconds until one is available.
+        """
+        self.tokens, self.last, wait = self.refill(self.tokens, self.last)
+        return wait
+
+    def take_shared_token(self):
+        """Take a token from the bucket stored in the lock file.
+
+        Return float, 0 if a token was taken, else the number of seconds until one is available.
+        """
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            state = os.read(fd, 64).split()
+            try:
+                tokens, last = float(state[0]), float(state[1])
+            except (IndexError, ValueError):
+                tokens, last = None, None
+
+            tokens, last, wait = self.refill(tokens, last)
+
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            os.write(fd, f"{tokens} {last}".encode())
+        finally:
+            os.close(fd)  # also releases the lock
+
+        return wait
+
+    def refill(self, tokens, last):
+        """Add the tokens accrued since the last update to the bucket, and try to take one.
+
+        :param tokens: float, tokens in the bucket at the last update, None if never updated
+        :param last: float, time of the last update
+
+        Return the new token count (float), the time of this update (float) and the number of
+        seconds until a token is available (float, 0 if a token was taken).
+        """
+        now = time.time()
+        rate, capacity = self.get_rate(), self.get_capacity()
+
+        if tokens is None:
+            tokens = capacity
+        else:
+            tokens = min(capacity, tokens + max(0, now - last) * rate)
+
+        if tokens >= 1:
+            return tokens - 1, now, 0
+
+        return tokens, now, (1 - tokens) / rate
+
+
+class EntrezRateLimiter(TokenBucket):
+    """Token bucket following NCBI's E-utilities limits: 3 requests/s, or 10 with an API key.
+
+    The rate is checked on every request, so setting Entrez.api_key at any time takes effect.
+    """
+
+    def __init__(self, lock_path=None):
+        super().__init__(rate=None, capacity=1, lock_path=lock_path)
+
+    def get_rate(self):
+        return 10 if Entrez.api_key else 3
+
+
+class RetryPolicy:
+    """Retry failed network calls using exponential backoff with full jitter.
+
+    A Retry-After header on an HTTP error response is honoured in place of the backoff. If a
+    limiter is given, it is acquired before every attempt.
+    """
+
+    def __init__(
+        self,
+        retries=10,
+        backoff_base=1,
+        backoff_max=60,
+        limiter=None,
+        retry_on=(IOError, EOFError, ftplib.Error),
+    ):
+        """Build the retry policy.
+
+        :param retries: int, maximum number of attempts made
+        :param backoff_base: float, seconds of the backoff ceiling after the first failure
+        :param backoff_max: float, maximum number of seconds waited between attempts
+        :param limiter: TokenBucket, rate limiter acquired before every attempt
+        :param retry_on: tuple of exception classes, errors that are retried
+        """
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.limiter = limiter
+        self.retry_on = retry_on
+
+    def wait(self):
+        """Block until the rate limiter, if any, allows another request.
+
+        Return nothing.
+        """
+        if self.limiter is not None:
+            self.limiter.acquire()
+
+    def get_delay(self, tries, error=None):
+        """Retrieve the number of seconds to wait before the next attempt.
+
+        :param tries: int, number of attempts made so far
+        :param error: Exception, the error raised by the last attempt
+
+        Return float.
+        """
+        retry_after = get_retry_after(error)
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (tries - 1)))
+
+    def is_retryable(self, error):
+        """Check if the error is transient and worth retrying.
+
+        Client errors (HTTP 4xx other than 408 and 429, and permanent FTP errors) are not retried.
+
+        :param error: Exception, the error raised by the last attempt
+
+        Return bool.
+        """
+        if not isinstance(error, self.retry_on):
+            return False
+
+        if isinstance(error, HTTPError):
+            return error.code >= 500 or error.code in (408, 429)
+
+        return not isinstance(error, ftplib.error_perm)
+
+    def run(self, func, func_args=(), func_kwargs=None, retries=None):
+        """Call the function, retrying transient errors.
+
+        :param func: function, network call to make
+        :param func_args: tuple, arguments passed to the function
+        :param func_kwargs: dict, keyword arguments passed to the function
+        :param retries: int, maximum number of attempts, overrides the policy's retries
+
+        Raises the last error if all attempts fail.
+        Return the value returned by the function.
+        """
+        logger = logging.getLogger(__name__)
+
+        if func_kwargs is None:
+            func_kwargs = {}
+        if retries is None:
+            retries = self.retries
+
+        tries = 0
+        while True:
+            self.wait()
+            try:
+                return func(*func_args, **func_kwargs)
+
+            except self.retry_on as err:
+                tries += 1
+                if tries >= retries or not self.is_retryable(err):
+                    raise
+
+                delay = self.get_delay(tries, err)
+                logger.warning(
+                    f"Network error encountered during try no.{tries}.\nRetrying in {delay:.1f}s",
+                    exc_info=1,
+                )
+                time.sleep(delay)
+
+
+    async def async_wait(self):
+        """Wait, without blocking the event loop, until the rate limiter allows another request.
+
+        Return nothing.
+        """
+        if self.limiter is None:
+            return
+
+        while True:
+            wait = self.limiter.try_acquire()
+            if wait <= 0:
+                return
+
+            await asyncio.sleep(wait)
+
+    async def async_run(self, coro_func, func_args=(), func_kwargs=None, retries=None):
+        """Await the coroutine function, retrying transient errors.
+
+        :param coro_func: coroutine function, network call to make
+        :param func_args: tuple, arguments passed to the function
+        :param func_kwargs: dict, keyword arguments passed to the function
+        :param retries: int, maximum number of attempts, overrides the policy's retries
+
+        Raises the last error if all attempts fail.
+        Return the value returned by the coroutine.
+        """
+        logger = logging.getLogger(__name__)
+
+        if func_kwargs is None:
+            func_kwargs = {}
+        if retries is None:
+            retries = self.retries
+
+        tries = 0
+        while True:
+            await self.async_wait()
+            try:
+                return await coro_func(*func_args, **func_kwargs)
+
+            except self.retry_on as err:
+                tries += 1
+                if tries >= retries or not self.is_retryable(err):
+                    raise
+
+                delay = self.get_delay(tries, err)
+                logger.warning(
+                    f"Network error encountered during try no.{tries}.\nRetrying in {delay:.1f}s",
+                    exc_info=1,
+                )
+                await asyncio.sleep(delay)
+
+
+def get_retry_after(error):
+    """Retrieve the number of seconds given in the Retry-After header of an HTTP error.
+
+    :param error: Exception, error raised by a network call
+
+    Return float, or None if no usable Retry-After header is present.
+    """
+    headers = getattr(error, "headers", None)
+    if headers is None:
+        return None
+
+    retry_after = headers.get("Retry-After")
+    if retry_after is None:
+        return None
+
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+
+    try:
+        return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+ENTREZ_POLICY = None
+DOWNLOAD_POLICY = None
+POLICY_LOCK = threading.Lock()
+
+
+def get_entrez_policy():
+    """Retrieve the process-wide retry policy used for calls to NCBI Entrez.
+
+    The policy is rate limited according to NCBI's E-utilities limits. Set the environment
+    variable SAINTBIOUTILS_NCBI_LOCK to a file path to share the limit between processes.
+
+    Return RetryPolicy.
+    """
+    global ENTREZ_POLICY
+
+    with POLICY_LOCK:
+        if ENTREZ_POLICY is None:
+            limiter = EntrezRateLimiter(lock_path=os.environ.get("SAINTBIOUTILS_NCBI_LOCK"))
+            ENTREZ_POLICY = RetryPolicy(retries=10, limiter=limiter)
+
+    return ENTREZ_POLICY
+
+
+def get_download_policy():
+    """Retrieve the process-wide retry policy used for downloading files from NCBI.
+
+    Return RetryPolicy.
+    """
+    global DOWNLOAD_POLICY
+
+    with POLICY_LOCK:
+        if DOWNLOAD_POLICY is None:
+            DOWNLOAD_POLICY = RetryPolicy(retries=3, backoff_base=2)
+
+    return DOWNLOAD_POLICY
+
+
+def set_entrez_policy(policy):
+    """Replace the process-wide retry policy used for calls to NCBI Entrez.
+
+    :param policy: RetryPolicy
+
+    Return nothing.
+    """
+    global ENTREZ_POLICY
+
+    with POLICY_LOCK:
+        ENTREZ_POLICY = policy
+
+
+def set_download_policy(policy):
+    """Replace the process-wide retry policy used for downloading files from NCBI.
+
+    :param policy: RetryPolicy
+
+    Return nothing.
+    """
+    global DOWNLOAD_POLICY
+
+    with POLICY_LOCK:
+        DOWNLOAD_POLICY = policy
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) University of St Andrews 2020-2021
+# (c) University of Strathclyde 2020-2021
+# (c) James Hutton Institute 2020-2021
+#
+# Author:
+# Emma E. M. Hobbs
+#
+# Contact
+# eemh1@st-andrews.ac.uk
+#
+# Emma E. M. Hobbs,
+# Biomolecular Sciences Building,
+# University of St Andrews,
+# North Haugh Campus,
+# St Andrews,
+# KY16 9ST
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Sources that can serve files from the NCBI genomes tree without downloading them"""
+
+
+import logging
+import os
+import shutil
+
+from pathlib import Path
+from urllib.parse import urlparse
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+
+FICLONE = 0x40049409  # Linux ioctl to reflink (copy-on-write clone) a file
+
+
+class LocalMirrorSource:
+    """Local (e.g. rsync) mirror of the NCBI genomes/all directory tree.
+
+    The path of the file under 'genomes/all/' in the NCBI url is looked up under the mirror
+    root, e.g. <root>/GCA/000/021/645/GCA_000021645.1_ASM2164v1/...
+    """
+
+    def __init__(self, root, method="link"):
+        """Build the mirror source.
+
+        :param root: Path, local directory corresponding to genomes/all on NCBI
+        :param method: str, how files are materialised: 'link' (hard link, falling back to
+            reflink then copy, e.g. across file systems), 'reflink' (falling back to copy)
+            or 'copy'
+        """
+        if method not in ("link", "reflink", "copy"):
+            raise ValueError(f"Unknown mirror method '{method}', expected 'link', 'reflink' or 'copy'")
+
+        self.root = Path(root)
+        self.method = method
+
+    def get_mirror_path(self, url):
+        """Retrieve the path of the file in the local mirror.
+
+        :param url: str, NCBI url of the file
+
+        Return Path, or None if the url is not within the genomes/all tree.
+        """
+        url_path = urlparse(url).path
+        _, sep, relative_path = url_path.partition("/genomes/all/")
+        if not sep:
+            return None
+
+        return self.root / relative_path
+
+    def fetch(self, url, out_file_path):
+        """Write the file at the url to out_file_path, if the mirror holds the file.
+
+        :param url: str, NCBI url of the file
+        :param out_file_path: Path, path to write the file to
+
+        Return bool, True if the file was written, False if the mirror does not hold the file.
+        """
+        logger = logging.getLogger(__name__)
+
+        mirror_path = self.get_mirror_path(url)
+        if mirror_path is None or not mirror_path.is_file():
+            return False
+
+        out_file_path = Path(out_file_path)
+
+        if self.method == "link":
+            try:
+                os.link(mirror_path, out_file_path)
+                return True
+            except OSError:
+                logger.info(f"Could not hard link {mirror_path}, copying instead")
+
+        # write to a '.part' file so an interrupted copy is never mistaken for a complete file
+        part_file_path = out_file_path.with_name(f"{out_file_path.name}.part")
+
+        if self.method in ("link", "reflink") and reflink(mirror_path, part_file_path):
+            os.replace(part_file_path, out_file_path)
+            return True
+
+        # shutil.copyfile uses zero-copy os.sendfile() where the platform supports it
+        shutil.copyfile(mirror_path, part_file_path)
+        os.replace(part_file_path, out_file_path)
+
+        return True
+
+
+def reflink(src_path, dst_path):
+    """Create a copy-on-write clone of a file, on file systems that support it (e.g. btrfs, XFS).
+
+    :param src_path: Path, file to clone
+    :param dst_path: Path, path of the clone
+
+    Return bool, True if the clone was created.
+    """
+    if fcntl is None:
+        return False
+
+    with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return True
+        except OSError:
+            pass
+
+    os.remove(dst_path)
+    return False
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) University of St Andrews 2020-2021
+# (c) University of Strathclyde 2020-2021
+# (c) James Hutton Institute 2020-2021
+#
+# Author:
+# Emma E. M. Hobbs
+#
+# Contact
+# eemh1@st-andrews.ac.uk
+#
+# Emma E. M. Hobbs,
+# Biomolecular Sciences Building,
+# University of St Andrews,
+# North Haugh Campus,
+# St Andrews,
+# KY16 9ST
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Pooled keep-alive HTTP(S) connections for downloading files from NCBI"""
+
+
+import http.client
+import logging
+import queue
+import threading
+
+
+NCBI_HOST = "ftp.ncbi.nlm.nih.gov"
+
+
+class ConnectionPool:
+    """Pool of persistent keep-alive HTTP(S) connections to a single host, shared between threads.
+
+    Connections are handed back to the pool once a response has been read to the end, so
+    consecutive requests (e.g. several files from the same assembly directory) reuse the same
+    connection instead of paying for TCP and TLS setup each time.
+    """
+
+    def __init__(self, host=NCBI_HOST, scheme="https", port=None, maxsize=8, timeout=45):
+        """Build the connection pool.
+
+        :param host: str, host name
+        :param scheme: str, 'https' or 'http'
+        :param port: int, port, defaults to the default port of the scheme
+        :param maxsize: int, maximum number of idle connections kept in the pool
+        :param timeout: float, socket timeout in seconds
+        """
+        self.host = host
+        self.scheme = scheme
+        self.port = port
+        self.timeout = timeout
+        self.idle = queue.LifoQueue(maxsize=maxsize)
+
+    def new_connection(self):
+        """Return a new (not yet connected) http.client connection to the host."""
+        if self.scheme == "https":
+            return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def get_connection(self):
+        """Return an idle connection from the pool, else a new connection, and whether it is reused."""
+        try:
+            return self.idle.get_nowait(), True
+        except queue.Empty:
+            return self.new_connection(), False
+
+    def release(self, connection):
+        """Return a connection to the pool, closing it if the pool is full.
+
+        :param connection: http.client connection whose last response has been fully read
+
+        Return nothing.
+        """
+        try:
+            self.idle.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def request(self, method, path, headers=None):
+        """Send a request using a pooled connection.
+
+        A reused connection may have been closed by the server while idle, in which case the
+        request is sent again on a new connection. Other http.client errors (e.g. a malformed
+        status line) are raised as IOError, so they are retried by the download policy, and
+        the connection is discarded.
+
+        :param method: str, HTTP method
+        :param path: str, path (and query) of the resource
+        :param headers: dict, request headers
+
+        Return PooledResponse.
+        """
+        logger = logging.getLogger(__name__)
+
+        headers = dict(headers or {})
+        headers.setdefault("User-Agent", "saintBioutils")
+        headers.setdefault("Accept-Encoding", "identity")
+
+        connection, reused = self.get_connection()
+        try:
+            connection.request(method, path, headers=headers)
+            response = connection.getresponse()
+
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            connection.close()
+            if not reused:
+                raise
+            logger.info(f"Idle connection to {self.host} was closed, reconnecting")
+            connection = self.new_connection()
+            try:
+                connection.request(method, path, headers=headers)
+                response = connection.getresponse()
+            except http.client.HTTPException as err:
+                connection.close()
+                raise IOError(f"Request for {path} to {self.host} failed: {err!r}") from err
+            except BaseException:
+                connection.close()
+                raise
+
+        except http.client.HTTPException as err:
+            connection.close()
+            raise IOError(f"Request for {path} to {self.host} failed: {err!r}") from err
+
+        except BaseException:
+            connection.close()
+            raise
+
+        return PooledResponse(self, connection, response)
+
+    def close(self):
+        """Close all idle connections in the pool.
+
+        Return nothing.
+        """
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class PooledResponse:
+    """File-like wrapper of an http.client response, returning its connection to the pool on close."""
+
+    def __init__(self, pool, connection, response):
+        self.pool = pool
+        self.connection = connection
+        self.response = response
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+
+    def read(self, size=-1):
+        """Read from the response body.
+
+        If reading fails the connection is discarded rather than reused, and http.client
+        errors (e.g. IncompleteRead) are raised as IOError.
+
+        :param size: int, maximum number of bytes read, all remaining bytes if negative or None
+
+        Return bytes.
+        """
+        try:
+            if size is None or size < 0:
+                return self.response.read()
+            return self.response.read(size)
+
+        except http.client.HTTPException as err:
+            self.discard()
+            raise IOError(f"Failed to read the response from {self.pool.host}: {err!r}") from err
+
+        except BaseException:
+            self.discard()
+            raise
+
+    def info(self):
+        return self.headers
+
+    def close(self):
+        """Close the response, and reuse the connection if the response was read to the end."""
+        if self.connection is None:
+            return
+
+        if self.response.isclosed() and not self.response.will_close:
+            self.pool.release(self.connection)
+        else:
+            self.response.close()
+            self.connection.close()
+
+        self.connection = None
+
+    def discard(self):
+        """Close the response and its connection, without returning the connection to the pool."""
+        if self.connection is None:
+            return
+
+        self.response.close()
+        self.connection.close()
+        self.connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+POOLS = {}  # {(scheme, host, port): ConnectionPool}
+POOLS_LOCK = threading.Lock()
+
+
+def get_connection_pool(scheme, host, port=None):
+    """Retrieve the process-wide connection pool for a host, creating it if needed.
+
+    :param scheme: str, 'https' or 'http'
+    :param host: str, host name
+    :param port: int, port, defaults to the default port of the scheme
+
+    Return ConnectionPool.
+    """
+    key = (scheme, host, port)
+
+    with POOLS_LOCK:
+        if key not in POOLS:
+            POOLS[key] = ConnectionPool(host=host, scheme=scheme, port=port)
+        return POOLS[key]
@@ -41,18 +41,27 @@
 """Functions relating to UniProt and its API"""
 
 
+import http.client
+import io
 import logging
+import time
 import urllib.parse
 import urllib.request
 
-from urllib.error import HTTPError
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 from tqdm import tqdm
 
-from saintBioutils.misc import get_chunks_list
+from saintBioutils.genbank.rate_limit import RetryPolicy
+from saintBioutils.misc import get_chunks_gen, get_chunks_list
 
 
-def get_uniprot_accessions(genbank_dict, args):
+UNIPROT_UPLOADLISTS_URL = 'https://www.uniprot.org/uploadlists/'
+TIMEOUT = 120
+
+
+def get_uniprot_accessions(genbank_dict, args, multi=False, failed_accessions=None):
     """Retrieve UniProt accessions for the GenBank accessions from UniProt REST API.
     
     UniProt requests batch queries of no larger than 20,000, athough queries longer than 500
@@ -60,11 +69,19 @@ def get_uniprot_accessions(genbank_dict, args):
 
     :param genbank_dict: dict, keyed by GenBank accessions and valued by local CAZyme db record id (int)
     :param args: cmd-line args parser
+    :param multi: bool, keep every GenBank accession mapped to each UniProt accession, see
+        add_uniprot_mapping()
+    :param failed_accessions: list, GenBank accessions of queries that still failed after
+        args.retries attempts are added to it. A query fails if the request fails, or if the
+        response cannot be read in full (e.g. it times out or is cut short).
 
-    Return dict of {uniprot_accession: {'gbk_acc': str, 'db_id': int}}
+    Return dict of {uniprot_accession: {'gbk_acc': str, 'db_id': int}}, or with multi=True
+    {uniprot_accession: [{'gbk_acc': str, 'db_id': int}]}
     """
     logger = logging.getLogger(__name__)
-    uniprot_url = 'https://www.uniprot.org/uploadlists/'
+
+    if failed_accessions is None:
+        failed_accessions = []
 
     genbank_accessions = list(genbank_dict.keys())
 
@@ -77,28 +94,17 @@ def get_uniprot_accessions(genbank_dict, args):
         uniprot_rest_queries,
         desc='Batch retrieving UniProt IDs',
     ):
+        query = query_chunk
         if type(query_chunk) != str:
             # convert the set of gbk accessions into str format
             query = ' '.join(query_chunk)
 
-        params = {
-            'from': 'EMBL',
-            'to': 'ACC',
-            'format': 'tab',
-            'query': query
-        }
-
-        # submit query data
-        data = urllib.parse.urlencode(params)
-        data = data.encode('utf-8')
-        req = urllib.request.Request(uniprot_url, data)
-
-        # retrieve UniProt response
+        # retrieve and parse the UniProt response, failures while reading it are retried the
+        # same way as failed requests
         try:
-            with urllib.request.urlopen(req) as f:
-                response = f.read()
-                
-        except HTTPError:
+            mappings = fetch_uniprot_batch(query)
+
+        except IOError:
             try:
                 failed_queries[query] += 1
             except KeyError:
@@ -106,22 +112,330 @@ def get_uniprot_accessions(genbank_dict, args):
 
             if failed_queries[query] > args.retries:
                 del failed_queries[query]
+                failed_accessions.extend(query.split())
             else:  # try again later
                 uniprot_rest_queries.append(query)
             
             continue  # do not proceeed processing the request because request failed
 
-        uniprot_batch_response = response.decode('utf-8')
+        for genbank_accession, uniprot_accession in mappings:
+            add_uniprot_mapping(
+                uniprot_gbk_dict, uniprot_accession, genbank_accession, genbank_dict.get(genbank_accession), multi,
+            )
+
+    logger.info(
+        f"Retrieved {len(genbank_accessions)} gbk accessions from the local db\n"
+        f"{len(list(uniprot_gbk_dict.keys()))} were assoicated with records in UniProt"
+    )
+
+    return uniprot_gbk_dict
+
+
+def query_uniprot_batch(genbank_accessions, uniprot_url=UNIPROT_UPLOADLISTS_URL, timeout=TIMEOUT):
+    """Submit a single batch of GenBank accessions to the UniProt ID mapping service.
+
+    :param genbank_accessions: list of str, or str of space separated GenBank accessions
+    :param uniprot_url: str, URL of the UniProt ID mapping service
+    :param timeout: int, seconds to wait for the server to respond
+
+    Raises HTTPError (or another IOError) if the request fails.
+    Return bytes, tab separated table of GenBank accessions and their UniProt accessions.
+    """
+    with open_uniprot_batch(genbank_accessions, uniprot_url, timeout) as f:
+        return f.read()
+
+
+def fetch_uniprot_batch(genbank_accessions, uniprot_url=UNIPROT_UPLOADLISTS_URL, timeout=TIMEOUT):
+    """Submit a single batch of GenBank accessions to the UniProt ID mapping service, and parse the response in full.
+
+    :param genbank_accessions: list of str, or str of space separated GenBank accessions
+    :param uniprot_url: str, URL of the UniProt ID mapping service
+    :param timeout: int, seconds to wait for the server to respond
+
+    Raises IOError if the request fails, or the response could not be read in full (including
+    if it times out or is cut short).
+    Return list of tuples (GenBank accession, UniProt accession).
+    """
+    try:
+        with open_uniprot_batch(genbank_accessions, uniprot_url, timeout) as response:
+            return list(iter_uniprot_mapping(response))
+    except (ValueError, http.client.HTTPException) as err:
+        raise IOError(f"Failed to read the UniProt response: {err!r}") from err
+
+
+def open_uniprot_batch(genbank_accessions, uniprot_url=UNIPROT_UPLOADLISTS_URL, timeout=TIMEOUT):
+    """Submit a single batch of GenBank accessions to the UniProt ID mapping service, without reading the response.
+
+    :param genbank_accessions: list of str, or str of space separated GenBank accessions
+    :param uniprot_url: str, URL of the UniProt ID mapping service
+    :param timeout: int, seconds to wait for the server to respond
+
+    Raises HTTPError (or another IOError) if the request fails.
+    Return http.client.HTTPResponse, for streaming the response, e.g. with iter_uniprot_mapping().
+    """
+    query = genbank_accessions
+    if type(genbank_accessions) != str:
+        query = ' '.join(genbank_accessions)
+
+    params = {
+        'from': 'EMBL',
+        'to': 'ACC',
+        'format': 'tab',
+        'query': query
+    }
+
+    # submit query data
+    data = urllib.parse.urlencode(params)
+    data = data.encode('utf-8')
+    req = urllib.request.Request(uniprot_url, data)
+
+    return urllib.request.urlopen(req, timeout=timeout)
+
+
+def parse_uniprot_response(response, genbank_dict, uniprot_gbk_dict, multi=False):
+    """Parse the response to a UniProt ID mapping batch query.
+
+    :param response: bytes from query_uniprot_batch(), or a file-like object (e.g. from
+        open_uniprot_batch()) which is parsed line by line as it is read
+    :param genbank_dict: dict, keyed by GenBank accessions and valued by local CAZyme db record id (int)
+    :param uniprot_gbk_dict: dict, {uniprot_accession: {'gbk_acc': str, 'db_id': int}}, the
+        mapped accessions are added to this dict
+    :param multi: bool, keep every GenBank accession mapped to each UniProt accession, see
+        add_uniprot_mapping()
+
+    Raises http.client.IncompleteRead if the response was cut short, in which case no
+    mappings are added to uniprot_gbk_dict.
+    Return int, number of mappings parsed.
+    """
+    if isinstance(response, bytes):
+        response = io.BytesIO(response)
+
+    # parse the whole response before adding any mapping, so a truncated response adds nothing
+    mappings = list(iter_uniprot_mapping(response))
+
+    for genbank_accession, uniprot_accession in mappings:
+        db_id = genbank_dict.get(genbank_accession)
+        add_uniprot_mapping(uniprot_gbk_dict, uniprot_accession, genbank_accession, db_id, multi)
+
+    return len(mappings)
+
+
+def iter_uniprot_mapping(lines):
+    """Iterate over the mappings in a tab separated UniProt ID mapping table.
+
+    Lines are read and split one at a time, so the table is never held in memory in full.
+    Reading a response line by line does not raise an error if the connection is closed
+    before the end of the response, so the table is checked to end with a complete line,
+    and a response is checked to have been read up to its Content-Length.
+
+    :param lines: iterable of bytes or str lines, e.g. an open response, the first line
+        is the column titles
+
+    Raises http.client.IncompleteRead if the table is cut short, a line without its
+    trailing newline is never yielded.
+    Yields tuple (GenBank accession, UniProt accession).
+    """
+    response = lines
+    lines = iter(lines)
+
+    for line_number, line in enumerate(lines):
+        # only the last line can lack its newline, if the table was cut short (checked before
+        # decoding, as the line may also end part-way through a multi-byte character)
+        if not line.endswith(b'\n' if isinstance(line, bytes) else '\n'):
+            raise http.client.IncompleteRead(line if isinstance(line, bytes) else line.encode('utf-8'))
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        if line_number == 0:
+            continue  # the first line includes the titles
+        fields = line.rstrip('\r\n').split('\t', 2)
+        if len(fields) > 1:  # skip blank lines
+            yield fields[0], fields[1]
 
-        uniprot_batch_response = uniprot_batch_response.split('\n')
+    # bytes of the response left unread (None if the length is unknown, e.g. chunked responses)
+    remaining = getattr(response, 'length', None)
+    if remaining:
+        raise http.client.IncompleteRead(b'', remaining)
 
-        for line in tqdm(uniprot_batch_response[1:], "Parsing retrieved UniProt query"):  # the first line includes the titles, last line is an empty str
-            if line == '':  # add check incase last line is not an empty str 
-                continue
-            uniprot_accession = line.split('\t')[1]
-            genbank_accession = line.split('\t')[0]
-            db_id = genbank_dict[genbank_accession]
-            uniprot_gbk_dict[uniprot_accession] = {'gbk_acc': genbank_accession, 'db_id': db_id}
+
+def add_uniprot_mapping(uniprot_gbk_dict, uniprot_accession, genbank_accession, db_id, multi=False):
+    """Add a mapping to the dict of retrieved UniProt accessions.
+
+    A GenBank accession mapped to several UniProt accessions is added under each UniProt
+    accession. By default, if several GenBank accessions map to the same UniProt accession,
+    only the last one is kept; with multi=True the value of each UniProt accession is a list
+    of all mapped GenBank accessions.
+
+    :param uniprot_gbk_dict: dict, {uniprot_accession: {'gbk_acc': str, 'db_id': int}}, or
+        {uniprot_accession: [{'gbk_acc': str, 'db_id': int}]} if multi
+    :param uniprot_accession: str
+    :param genbank_accession: str
+    :param db_id: int, local CAZyme db record id of the GenBank accession
+    :param multi: bool, store lists of GenBank accessions
+
+    Return nothing.
+    """
+    entry = {'gbk_acc': genbank_accession, 'db_id': db_id}
+    if multi:
+        uniprot_gbk_dict.setdefault(uniprot_accession, []).append(entry)
+    else:
+        uniprot_gbk_dict[uniprot_accession] = entry
+
+
+class AimdBatchSizer:
+    """Additive increase, multiplicative decrease (AIMD) tuning of the query batch size.
+
+    The batch size grows by a fixed step after each successful batch, and is cut by a
+    factor after each failed batch, so it settles just below the size the server
+    currently accepts.
+    """
+
+    def __init__(self, size=500, min_size=50, max_size=5000, increase=50, decrease=0.5):
+        """Set the starting batch size and its limits.
+
+        :param size: int, starting batch size
+        :param min_size: int, smallest batch size
+        :param max_size: int, largest batch size (UniProt accepts at most 20,000)
+        :param increase: int, number of accessions added to the batch size after a success
+        :param decrease: float, factor the batch size is multiplied by after a failure
+        """
+        self.min_size = min_size
+        self.max_size = max_size
+        self.increase = increase
+        self.decrease = decrease
+        self.size = max(min_size, min(size, max_size))
+
+    def get_size(self):
+        """Return int, the current batch size."""
+        return self.size
+
+    def on_success(self):
+        """Grow the batch size after a successful batch.
+
+        Return nothing.
+        """
+        self.size = min(self.max_size, self.size + self.increase)
+
+    def on_failure(self):
+        """Shrink the batch size after a failed batch.
+
+        Return nothing.
+        """
+        self.size = max(self.min_size, int(self.size * self.decrease))
+
+
+def get_uniprot_accessions_concurrent(
+    genbank_dict,
+    max_workers=4,
+    batch_size=500,
+    min_batch_size=50,
+    max_batch_size=5000,
+    policy=None,
+    uniprot_url=UNIPROT_UPLOADLISTS_URL,
+    timeout=TIMEOUT,
+    failed_accessions=None,
+    multi=False,
+):
+    """Retrieve UniProt accessions for the GenBank accessions, keeping several batch queries in flight.
+
+    The batch size is tuned while querying (see AimdBatchSizer): it shrinks when a batch
+    fails (HTTP 4xx/5xx errors, timeouts and dropped connections, whether while sending the
+    query or reading the response, and responses cut short) and grows back after
+    successful batches. The accessions of a failed batch are split into batches of the
+    reduced size and retried after a backoff delay, until an accession has failed
+    policy.retries times.
+
+    :param genbank_dict: dict, keyed by GenBank accessions and valued by local CAZyme db record id (int)
+    :param max_workers: int, number of batches queried at the same time
+    :param batch_size: int, starting batch size
+    :param min_batch_size: int, smallest batch size
+    :param max_batch_size: int, largest batch size
+    :param policy: RetryPolicy, backoff delays, number of attempts and rate limiter,
+        defaults to 10 attempts with up to 30 seconds between attempts
+    :param uniprot_url: str, URL of the UniProt ID mapping service
+    :param timeout: int, seconds to wait for the server to respond to each batch
+    :param failed_accessions: list, GenBank accessions that could not be queried are added to it
+    :param multi: bool, keep every GenBank accession mapped to each UniProt accession, see
+        add_uniprot_mapping()
+
+    Return dict of {uniprot_accession: {'gbk_acc': str, 'db_id': int}}, as get_uniprot_accessions()
+    """
+    logger = logging.getLogger(__name__)
+
+    if policy is None:
+        policy = RetryPolicy(retries=10, backoff_base=1, backoff_max=30)
+    if failed_accessions is None:
+        failed_accessions = []
+
+    genbank_accessions = list(genbank_dict.keys())
+
+    sizer = AimdBatchSizer(batch_size, min_batch_size, max_batch_size)
+    pending = deque(genbank_accessions)
+    retry_batches = deque()  # [(accessions, seconds to wait before querying)]
+    failures = {}  # {gbk_acc: number of failed attempts}
+
+    uniprot_gbk_dict = {}  # {uniprot_accession: {'gbk_acc': str, 'db_id': int}}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        with tqdm(total=len(genbank_accessions), desc='Batch retrieving UniProt IDs') as pbar:
+            in_flight = {}  # {future: batch of gbk accessions}
+
+            while pending or retry_batches or in_flight:
+                while (pending or retry_batches) and len(in_flight) < max_workers:
+                    if retry_batches:
+                        batch, delay = retry_batches.popleft()
+                    else:
+                        batch = [pending.popleft() for _ in range(min(sizer.get_size(), len(pending)))]
+                        delay = 0
+                    future = executor.submit(
+                        query_uniprot_batch_worker, batch, policy, delay, uniprot_url, timeout,
+                    )
+                    in_flight[future] = batch
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    batch = in_flight.pop(future)
+                    try:
+                        mappings = future.result()
+                    except IOError as err:
+                        sizer.on_failure()
+
+                        retry = []
+                        for accession in batch:
+                            failures[accession] = failures.get(accession, 0) + 1
+                            if failures[accession] < policy.retries:
+                                retry.append(accession)
+                            else:
+                                failed_accessions.append(accession)
+
+                        logger.warning(
+                            f"UniProt batch of {len(batch)} accessions failed ({err}), "
+                            f"batch size reduced to {sizer.get_size()}"
+                        )
+
+                        delay = policy.get_delay(max(failures[accession] for accession in batch), err)
+                        for retry_batch in get_chunks_gen(retry, sizer.get_size()):
+                            retry_batches.append((retry_batch, delay))
+
+                        pbar.update(len(batch) - len(retry))
+                        continue
+
+                    sizer.on_success()
+                    for genbank_accession, uniprot_accession in mappings:
+                        add_uniprot_mapping(
+                            uniprot_gbk_dict,
+                            uniprot_accession,
+                            genbank_accession,
+                            genbank_dict.get(genbank_accession),
+                            multi,
+                        )
+                    pbar.update(len(batch))
+
+    if failed_accessions:
+        logger.error(
+            f"Failed to query UniProt for {len(failed_accessions)} GenBank accessions "
+            f"after {policy.retries} attempts"
+        )
 
     logger.info(
         f"Retrieved {len(genbank_accessions)} gbk accessions from the local db\n"
@@ -129,4 +443,22 @@ def get_uniprot_accessions(genbank_dict, args):
     )
 
     return uniprot_gbk_dict
- 
+
+
+def query_uniprot_batch_worker(genbank_accessions, policy, delay=0, uniprot_url=UNIPROT_UPLOADLISTS_URL, timeout=TIMEOUT):
+    """Wait for the backoff delay and the rate limiter, then query and parse a batch of accessions.
+
+    :param genbank_accessions: list of str, GenBank accessions
+    :param policy: RetryPolicy, its rate limiter (if any) is acquired before the query
+    :param delay: float, seconds to wait before querying, after a failed attempt
+    :param uniprot_url: str, URL of the UniProt ID mapping service
+    :param timeout: int, seconds to wait for the server to respond
+
+    Raises IOError if the query fails, see fetch_uniprot_batch().
+    Return list of tuples (GenBank accession, UniProt accession).
+    """
+    if delay:
+        time.sleep(delay)
+    policy.wait()
+
+    return fetch_uniprot_batch(genbank_accessions, uniprot_url, timeout)
@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) University of St Andrews 2020-2021
+# (c) University of Strathclyde 2020-2021
+# (c) James Hutton Institute 2020-2021
+#
+# Author:
+# Emma E. M. Hobbs
+#
+# Contact
+# eemh1@st-andrews.ac.uk
+#
+# Emma E. M. Hobbs,
+# Biomolecular Sciences Building,
+# University of St Andrews,
+# North Haugh Campus,
+# St Andrews,
+# KY16 9ST
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Client for the job-based UniProt ID mapping service (rest.uniprot.org/idmapping)"""
+
+
+import gzip
+import http.client
+import io
+import json
+import logging
+import re
+import time
+import urllib.parse
+import urllib.request
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from tqdm import tqdm
+
+from saintBioutils.genbank.rate_limit import RetryPolicy
+from saintBioutils.misc import get_chunks_list
+from saintBioutils.uniprot import add_uniprot_mapping, iter_uniprot_mapping
+
+
+UNIPROT_REST_URL = "https://rest.uniprot.org"
+TIMEOUT = 120
+
+# statuses of a job that has not finished yet
+RUNNING_STATUSES = ("NEW", "RUNNING")
+
+LINK_NEXT = re.compile(r'<([^>]+)>;\s*rel="next"')
+
+
+class IdMappingError(Exception):
+    """UniProt reported that an ID mapping job failed."""
+
+
+def get_uniprot_accessions_jobs(
+    genbank_dict,
+    job_size=100000,
+    max_jobs=4,
+    from_db="EMBL-GenBank-DDBJ_CDS",
+    to_db="UniProtKB",
+    base_url=UNIPROT_REST_URL,
+    policy=None,
+    page_size=500,
+    timeout=TIMEOUT,
+    multi=False,
+    failed_accessions=None,
+):
+    """Retrieve UniProt accessions for the GenBank accessions using UniProt ID mapping jobs.
+
+    The accessions are split into jobs of up to job_size accessions, and up to max_jobs
+    jobs are submitted, polled and their results retrieved at the same time. Results are
+    retrieved page by page, and the mappings of a job are only added once all of its pages
+    were retrieved, so the accessions of a failed job are only reported in failed_accessions.
+
+    :param genbank_dict: dict, keyed by GenBank accessions and valued by local CAZyme db record id (int)
+    :param job_size: int, number of accessions per job (UniProt accepts at most 100,000)
+    :param max_jobs: int, number of jobs run in parallel
+    :param from_db: str, UniProt ID mapping database the accessions are from
+    :param to_db: str, UniProt ID mapping database to map the accessions to
+    :param base_url: str, URL of the UniProt REST API, e.g. of a local server for testing
+    :param policy: RetryPolicy, for retrying failed requests, defaults to 5 attempts
+    :param page_size: int, number of results retrieved per page
+    :param timeout: int, seconds to wait for the server to respond to each request
+    :param multi: bool, keep every GenBank accession mapped to each UniProt accession, see
+        add_uniprot_mapping()
+    :param failed_accessions: list, GenBank accessions of failed jobs are added to it
+
+    Return dict of {uniprot_accession: {'gbk_acc': str, 'db_id': int}}, as get_uniprot_accessions()
+    """
+    logger = logging.getLogger(__name__)
+
+    if failed_accessions is None:
+        failed_accessions = []
+
+    if policy is None:
+        policy = RetryPolicy(retries=5, backoff_base=1, backoff_max=30)
+
+    genbank_accessions = list(genbank_dict.keys())
+    jobs = get_chunks_list(genbank_accessions, job_size)
+
+    uniprot_gbk_dict = {}  # {uniprot_accession: {'gbk_acc': str, 'db_id': int}}
+    failed_jobs = 0
+
+    with ThreadPoolExecutor(max_workers=max_jobs) as executor:
+        futures = {}
+        for job_accessions in jobs:
+            job_mappings = []
+            future = executor.submit(
+                run_id_mapping_job,
+                job_accessions,
+                lambda from_accession, to_accession, job_mappings=job_mappings: job_mappings.append(
+                    (from_accession, to_accession)
+                ),
+                from_db,
+                to_db,
+                base_url,
+                policy,
+                page_size,
+                timeout,
+            )
+            futures[future] = (job_accessions, job_mappings)
+
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Running UniProt ID mapping jobs"):
+            job_accessions, job_mappings = futures.pop(future)
+            try:
+                future.result()
+            except (IOError, EOFError, ValueError, http.client.HTTPException, IdMappingError) as err:
+                failed_jobs += 1
+                failed_accessions.extend(job_accessions)
+                logger.error(f"UniProt ID mapping job of {len(job_accessions)} accessions failed: {err}")
+                continue
+
+            for genbank_accession, uniprot_accession in job_mappings:
+                add_uniprot_mapping(
+                    uniprot_gbk_dict, uniprot_accession, genbank_accession, genbank_dict.get(genbank_accession), multi,
+                )
+
+    logger.info(
+        f"Retrieved {len(genbank_accessions)} gbk accessions from the local db\n"
+        f"{len(list(uniprot_gbk_dict.keys()))} were assoicated with records in UniProt\n"
+        f"{failed_jobs} of {len(jobs)} ID mapping jobs failed"
+    )
+
+    return uniprot_gbk_dict
+
+
+def run_id_mapping_job(
+    accessions,
+    callback,
+    from_db="EMBL-GenBank-DDBJ_CDS",
+    to_db="UniProtKB",
+    base_url=UNIPROT_REST_URL,
+    policy=None,
+    page_size=500,
+    timeout=TIMEOUT,
+):
+    """Submit an ID mapping job, wait for it to finish and stream its results.
+
+    :param accessions: list of str, accessions to map
+    :param callback: function, called with (from accession, to accession) for each mapping
+    :param from_db: str, UniProt ID mapping database the accessions are from
+    :param to_db: str, UniProt ID mapping database to map the accessions to
+    :param base_url: str, URL of the UniProt REST API
+    :param policy: RetryPolicy, for retrying failed requests
+    :param page_size: int, number of results retrieved per page
+    :param timeout: int, seconds to wait for the server to respond to each request
+
+    Return int, number of mappings retrieved.
+    """
+    job_id = submit_id_mapping_job(accessions, from_db, to_db, base_url, policy, timeout)
+    wait_for_id_mapping_job(job_id, base_url, policy, timeout=timeout)
+    results_url = get_id_mapping_results_url(job_id, base_url, policy, timeout)
+
+    count = 0
+    for from_accession, to_accession in iter_id_mapping_results(results_url, page_size, policy, timeout):
+        callback(from_accession, to_accession)
+        count += 1
+
+    return count
+
+
+def submit_id_mapping_job(
+    accessions,
+    from_db="EMBL-GenBank-DDBJ_CDS",
+    to_db="UniProtKB",
+    base_url=UNIPROT_REST_URL,
+    policy=None,
+    timeout=TIMEOUT,
+):
+    """Submit an ID mapping job.
+
+    :param accessions: list of str, accessions to map
+    :param from_db: str, UniProt ID mapping database the accessions are from
+    :param to_db: str, UniProt ID mapping database to map the accessions to
+    :param base_url: str, URL of the UniProt REST API
+    :param policy: RetryPolicy, for retrying failed requests
+    :param timeout: int, seconds to wait for the server to respond
+
+    Return str, job id.
+    """
+    data = urllib.parse.urlencode({'from': from_db, 'to': to_db, 'ids': ",".join(accessions)})
+
+    response = get_json(f"{base_url}/idmapping/run", data.encode('utf-8'), policy, timeout)
+
+    return response['jobId']
+
+
+def wait_for_id_mapping_job(
+    job_id,
+    base_url=UNIPROT_REST_URL,
+    policy=None,
+    poll_interval=1,
+    poll_max=30,
+    timeout=TIMEOUT,
+):
+    """Poll the status of an ID mapping job until it has finished.
+
+    The wait between polls starts at poll_interval seconds and grows by half after each
+    poll, up to poll_max seconds.
+
+    :param job_id: str, job id
+    :param base_url: str, URL of the UniProt REST API
+    :param policy: RetryPolicy, for retrying failed requests
+    :param poll_interval: float, seconds to wait before the second poll
+    :param poll_max: float, maximum seconds to wait between polls
+    :param timeout: int, seconds to wait for the server to respond
+
+    Raises IdMappingError if the job failed.
+    Return nothing.
+    """
+    while True:
+        # once finished, the status request may be redirected to the results
+        status = get_json(f"{base_url}/idmapping/status/{job_id}", policy=policy, timeout=timeout)
+
+        job_status = status.get('jobStatus')
+        if job_status is None or job_status == "FINISHED":
+            return
+        if job_status not in RUNNING_STATUSES:
+            raise IdMappingError(f"ID mapping job {job_id} {job_status}: {status.get('errors')}")
+
+        time.sleep(poll_interval)
+        poll_interval = min(poll_max, poll_interval * 1.5)
+
+
+def get_id_mapping_results_url(job_id, base_url=UNIPROT_REST_URL, policy=None, timeout=TIMEOUT):
+    """Retrieve the URL of the results of a finished ID mapping job.
+
+    :param job_id: str, job id
+    :param base_url: str, URL of the UniProt REST API
+    :param policy: RetryPolicy, for retrying failed requests
+    :param timeout: int, seconds to wait for the server to respond
+
+    Return str.
+    """
+    details = get_json(f"{base_url}/idmapping/details/{job_id}", policy=policy, timeout=timeout)
+
+    return details.get('redirectURL') or f"{base_url}/idmapping/results/{job_id}"
+
+
+def iter_id_mapping_results(results_url, page_size=500, policy=None, timeout=TIMEOUT):
+    """Retrieve the results of a finished ID mapping job page by page, following the pagination links.
+
+    Results are requested as gzip compressed TSV. Each page is retrieved with
+    get_id_mapping_results_page(), so a page that fails or is cut short part-way through
+    is retrieved again, and only complete pages are yielded.
+
+    :param results_url: str, URL from get_id_mapping_results_url()
+    :param page_size: int, number of results per page
+    :param policy: RetryPolicy, for retrying failed requests
+    :param timeout: int, seconds to wait for the server to respond
+
+    Yields tuple (from accession, to accession).
+    """
+    params = {'format': 'tsv', 'size': page_size, 'compressed': 'true'}
+    if "/uniprotkb/" in results_url:
+        params['fields'] = 'accession'
+
+    separator = "&" if "?" in results_url else "?"
+    url = f"{results_url}{separator}{urllib.parse.urlencode(params)}"
+
+    while url is not None:
+        if policy is None:
+            mappings, url = get_id_mapping_results_page(url, timeout)
+        else:
+            mappings, url = policy.run(get_id_mapping_results_page, (url, timeout))
+
+        yield from mappings
+
+
+def get_id_mapping_results_page(url, timeout=TIMEOUT):
+    """Retrieve and parse one page of the results of an ID mapping job.
+
+    :param url: str, URL of the page
+    :param timeout: int, seconds to wait for the server to respond
+
+    Raises IOError if the page could not be retrieved in full, including if it was cut short.
+    Return tuple, list of (from accession, to accession) tuples and str URL of the next page
+        (None if this is the last page).
+    """
+    try:
+        with open_url(url, timeout=timeout) as response:
+            stream = response
+            if response.peek(2)[:2] == b"\x1f\x8b":
+                stream = gzip.GzipFile(fileobj=response)
+
+            # iter_uniprot_mapping() checks the table was not cut short, and gzip the
+            # compressed stream, but a body cut at a line boundary is only caught here
+            mappings = list(iter_uniprot_mapping(io.TextIOWrapper(stream, encoding="utf-8")))
+            if response.length:
+                raise http.client.IncompleteRead(b'', response.length)
+
+            match = LINK_NEXT.search(response.headers.get('Link') or "")
+    except (EOFError, ValueError, http.client.HTTPException) as err:
+        raise IOError(f"Failed to retrieve ID mapping results from {url}: {err!r}") from err
+
+    return mappings, match.group(1) if match else None
+
+
+def get_json(url, data=None, policy=None, timeout=TIMEOUT):
+    """Make a request and parse the JSON response.
+
+    The request and reading the response are retried together, so a response that fails
+    part-way through is requested again.
+
+    :param url: str
+    :param data: bytes, form data to POST, or None to GET
+    :param policy: RetryPolicy, for retrying failed requests
+    :param timeout: int, seconds to wait for the server to respond
+
+    Return dict.
+    """
+    if policy is None:
+        return read_json(url, data, timeout)
+
+    return policy.run(read_json, (url, data, timeout))
+
+
+def read_json(url, data=None, timeout=TIMEOUT):
+    """Make a single request and parse the JSON response.
+
+    :param url: str
+    :param data: bytes, form data to POST, or None to GET
+    :param timeout: int, seconds to wait for the server to respond
+
+    Raises IOError if the response could not be read in full or is not valid JSON.
+    Return dict.
+    """
+    try:
+        with open_url(url, data, timeout=timeout) as response:
+            return json.load(response)
+    except (ValueError, http.client.HTTPException) as err:
+        raise IOError(f"Failed to read JSON response from {url}: {err!r}") from err
+
+
+def open_url(url, data=None, policy=None, timeout=TIMEOUT):
+    """Open a URL, retrying transient failures.
+
+    :param url: str
+    :param data: bytes, form data to POST, or None to GET
+    :param policy: RetryPolicy, for retrying failed requests, no retries if None
+    :param timeout: int, seconds to wait for the server to respond
+
+    Return http.client.HTTPResponse.
+    """
+    request = urllib.request.Request(url, data)
+
+    if policy is None:
+        return urllib.request.urlopen(request, timeout=timeout)
+
+    return policy.run(urllib.request.urlopen, (request,), {'timeout': timeout})
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) University of St Andrews 2020-2021
+# (c) University of Strathclyde 2020-2021
+# (c) James Hutton Institute 2020-2021
+#
+# Author:
+# Emma E. M. Hobbs
+#
+# Contact
+# eemh1@st-andrews.ac.uk
+#
+# Emma E. M. Hobbs,
+# Biomolecular Sciences Building,
+# University of St Andrews,
+# North Haugh Campus,
+# St Andrews,
+# KY16 9ST
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Persistent on-disk cache of GenBank to UniProt accession mappings"""
+
+
+import logging
+import time
+import urllib.request
+
+from saintBioutils.uniprot import (
+    add_uniprot_mapping,
+    get_uniprot_accessions,
+    get_uniprot_accessions_concurrent,
+)
+from saintBioutils.uniprot.id_mapping import TIMEOUT, UNIPROT_REST_URL, get_uniprot_accessions_jobs
+from saintBioutils.utilities.store import SQLiteStore
+
+
+# mappers that report the accessions they could not query through a failed_accessions list,
+# including batches whose response was cut short, and only return mappings from responses
+# that were read in full
+FAILURE_REPORTING_MAPPERS = (
+    get_uniprot_accessions,
+    get_uniprot_accessions_concurrent,
+    get_uniprot_accessions_jobs,
+)
+
+
+class UniProtMappingCache(SQLiteStore):
+    """SQLite-backed cache of GenBank accession to UniProt accession mappings.
+
+    GenBank accessions that have no UniProt entry are cached as well, so they are not
+    queried again. Each entry records when it was cached and the UniProt release it was
+    retrieved from; entries older than the TTL, or from a different release than the
+    cache's release, are treated as missing.
+    """
+
+    # uniprot_acc is '' for GenBank accessions without a UniProt entry
+    tables = (
+        "CREATE TABLE IF NOT EXISTS mappings ("
+        "gbk_acc TEXT NOT NULL, "
+        "uniprot_acc TEXT NOT NULL, "
+        "release TEXT, "
+        "cached_at REAL NOT NULL, "
+        "PRIMARY KEY (gbk_acc, uniprot_acc))",
+    )
+
+    def __init__(self, db_path, ttl=None, release=None):
+        """Open (and create if needed) the cache.
+
+        :param db_path: Path, path to the SQLite database file
+        :param ttl: int or float, number of seconds a cached entry is valid for,
+            entries never expire if None
+        :param release: str, current UniProt release (e.g. from get_uniprot_release()),
+            entries from other releases are not used. Entries from any release are used if None.
+        """
+        super().__init__(db_path)
+        self.ttl = ttl
+        self.release = release
+
+    def get(self, genbank_accessions, batch_size=500):
+        """Retrieve the cached mappings of GenBank accessions.
+
+        :param genbank_accessions: iterable of str, GenBank accessions
+        :param batch_size: int, number of accessions looked up per query
+
+        Return tuple (dict {gbk_acc: [uniprot_acc]}, an empty list if the accession has no
+        UniProt entry, list of str GenBank accessions that are not cached or have expired).
+        """
+        genbank_accessions = list(dict.fromkeys(genbank_accessions))
+        oldest = None if self.ttl is None else time.time() - self.ttl
+
+        cached = {}  # {gbk_acc: [uniprot_acc]}
+        with self.lock:
+            for i in range(0, len(genbank_accessions), batch_size):
+                batch = genbank_accessions[i:i + batch_size]
+                rows = self.connection.execute(
+                    "SELECT gbk_acc, uniprot_acc, release, cached_at FROM mappings "
+                    f"WHERE gbk_acc IN ({', '.join('?' * len(batch))})",
+                    batch,
+                ).fetchall()
+
+                for gbk_acc, uniprot_acc, release, cached_at in rows:
+                    if oldest is not None and cached_at < oldest:
+                        continue
+                    if self.release is not None and release != self.release:
+                        continue
+                    uniprot_accs = cached.setdefault(gbk_acc, [])
+                    if uniprot_acc:
+                        uniprot_accs.append(uniprot_acc)
+
+        misses = [gbk_acc for gbk_acc in genbank_accessions if gbk_acc not in cached]
+
+        return cached, misses
+
+    def set_many(self, mappings):
+        """Add or replace the cached mappings of GenBank accessions.
+
+        :param mappings: dict {gbk_acc: [uniprot_acc]}, with an empty list for GenBank
+            accessions that have no UniProt entry
+
+        Return nothing.
+        """
+        now = time.time()
+        rows = [
+            (gbk_acc, uniprot_acc, self.release, now)
+            for gbk_acc, uniprot_accs in mappings.items()
+            for uniprot_acc in (uniprot_accs or [''])
+        ]
+
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "DELETE FROM mappings WHERE gbk_acc = ?", ((gbk_acc,) for gbk_acc in mappings),
+            )
+            self.connection.executemany("INSERT OR REPLACE INTO mappings VALUES (?, ?, ?, ?)", rows)
+
+    def invalidate(self, genbank_accessions=None):
+        """Remove entries from the cache.
+
+        :param genbank_accessions: iterable of str, GenBank accessions to remove, all entries
+            are removed if None
+
+        Return int, number of rows removed.
+        """
+        logger = logging.getLogger(__name__)
+
+        with self.lock, self.connection:
+            if genbank_accessions is None:
+                cursor = self.connection.execute("DELETE FROM mappings")
+            else:
+                cursor = self.connection.executemany(
+                    "DELETE FROM mappings WHERE gbk_acc = ?",
+                    ((gbk_acc,) for gbk_acc in genbank_accessions),
+                )
+
+        logger.info(f"Removed {cursor.rowcount} entries from the UniProt mapping cache {self.db_path}")
+
+        return cursor.rowcount
+
+    def purge_expired(self):
+        """Remove all expired entries, and entries from other UniProt releases, from the cache.
+
+        Return int, number of rows removed.
+        """
+        with self.lock, self.connection:
+            removed = 0
+            if self.ttl is not None:
+                removed += self.connection.execute(
+                    "DELETE FROM mappings WHERE cached_at < ?", (time.time() - self.ttl,),
+                ).rowcount
+            if self.release is not None:
+                removed += self.connection.execute(
+                    "DELETE FROM mappings WHERE release IS NOT ?", (self.release,),
+                ).rowcount
+
+        return removed
+
+
+def get_uniprot_accessions_cached(genbank_dict, cache, mapper=None, multi=False, **mapper_kwargs):
+    """Retrieve UniProt accessions for the GenBank accessions, only querying UniProt for cache misses.
+
+    :param genbank_dict: dict, keyed by GenBank accessions and valued by local CAZyme db record id (int)
+    :param cache: UniProtMappingCache
+    :param mapper: function, called with a genbank_dict of the cache misses, multi=True (and
+        mapper_kwargs) to query UniProt, and returning
+        {uniprot_accession: [{'gbk_acc': str, 'db_id': int}]}, defaults to
+        get_uniprot_accessions_concurrent()
+    :param multi: bool, keep every GenBank accession mapped to each UniProt accession, see
+        add_uniprot_mapping()
+    :param **mapper_kwargs: keyword arguments passed to the mapper
+
+    The mapper is always called with multi=True, so every GenBank accession mapped to a
+    UniProt accession is cached. For the mappers in FAILURE_REPORTING_MAPPERS, cache misses
+    not found by the mapper are cached as having no UniProt entry, and accessions that could
+    not be queried (e.g. after repeated HTTP errors, or responses that were cut short) are not
+    cached, so accessions are only cached as having no UniProt entry from responses that were
+    read in full. Other mappers cannot report failed queries, so only the mappings they find
+    are cached.
+
+    Return dict of {uniprot_accession: {'gbk_acc': str, 'db_id': int}}, as get_uniprot_accessions()
+    """
+    logger = logging.getLogger(__name__)
+
+    if mapper is None:
+        mapper = get_uniprot_accessions_concurrent
+
+    cached, misses = cache.get(genbank_dict.keys())
+
+    logger.info(
+        f"{len(cached)} of {len(genbank_dict)} GenBank accessions found in the UniProt mapping cache, "
+        f"querying UniProt for {len(misses)}"
+    )
+
+    if misses:
+        failed_accessions = []
+        mapper_kwargs['multi'] = True
+        reports_failures = mapper in FAILURE_REPORTING_MAPPERS
+        if reports_failures:
+            mapper_kwargs['failed_accessions'] = failed_accessions
+
+        retrieved = mapper({gbk_acc: genbank_dict[gbk_acc] for gbk_acc in misses}, **mapper_kwargs)
+
+        failed_accessions = set(failed_accessions)
+        new_mappings = {gbk_acc: [] for gbk_acc in misses if gbk_acc not in failed_accessions}
+        for uniprot_acc, entries in retrieved.items():
+            for entry in entries if isinstance(entries, list) else [entries]:
+                if entry['gbk_acc'] in new_mappings:
+                    new_mappings[entry['gbk_acc']].append(uniprot_acc)
+
+        if not reports_failures:
+            # a miss without a mapping may have failed to be queried, so is not cached
+            new_mappings = {gbk_acc: accs for gbk_acc, accs in new_mappings.items() if accs}
+
+        cache.set_many(new_mappings)
+        cached.update(new_mappings)
+
+    uniprot_gbk_dict = {}  # {uniprot_accession: {'gbk_acc': str, 'db_id': int}}
+    for gbk_acc, uniprot_accs in cached.items():
+        for uniprot_acc in uniprot_accs:
+            add_uniprot_mapping(uniprot_gbk_dict, uniprot_acc, gbk_acc, genbank_dict[gbk_acc], multi)
+
+    return uniprot_gbk_dict
+
+
+def get_uniprot_release(base_url=UNIPROT_REST_URL, timeout=TIMEOUT):
+    """Retrieve the current UniProt release from the X-UniProt-Release header of the REST API.
+
+    :param base_url: str, URL of the UniProt REST API
+    :param timeout: int, seconds to wait for the server to respond
+
+    Return str, e.g. '2024_01', or None if the release is not reported.
+    """
+    url = f"{base_url}/uniprotkb/search?query=*&size=1&fields=accession"
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        return response.headers.get('X-UniProt-Release')
@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) University of St Andrews 2020-2021
+# (c) University of Strathclyde 2020-2021
+# (c) James Hutton Institute 2020-2021
+#
+# Author:
+# Emma E. M. Hobbs
+#
+# Contact
+# eemh1@st-andrews.ac.uk
+#
+# Emma E. M. Hobbs,
+# Biomolecular Sciences Building,
+# University of St Andrews,
+# North Haugh Campus,
+# St Andrews,
+# KY16 9ST
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Offline GenBank to UniProt mapping, using an index built from the UniProt bulk ID mapping files"""
+
+
+import heapq
+import logging
+import mmap
+import os
+import struct
+import tempfile
+
+from bisect import bisect_left
+from pathlib import Path
+
+from tqdm import tqdm
+
+from saintBioutils.uniprot import add_uniprot_mapping
+from saintBioutils.utilities.file_io.compression import open_gzip
+
+
+# column of EMBL-CDS protein ids in idmapping_selected.tab, values are separated by '; '
+EMBL_CDS_COLUMN = 17
+
+INDEX_MAGIC = b"SBUPIDX1"
+# magic, key width, value width, number of records
+INDEX_HEADER = struct.Struct("<8sIIQ")
+
+
+def build_idmapping_index(source_path, index_path, source_format=None, chunk_size=2_000_000, tmp_dir=None):
+    """Build a sorted, memory-mappable index of EMBL-CDS protein ids to UniProt accessions.
+
+    The source file is streamed once. Mappings are sorted in chunks of chunk_size, which
+    are written to temporary files and merged (an external merge sort), so memory use
+    does not depend on the size of the source file. The index is a header followed by
+    fixed-width records of the protein id and UniProt accession, sorted by protein id.
+
+    :param source_path: Path, UniProt idmapping_selected.tab.gz or idmapping.dat.gz
+        (gzip compressed or plain text)
+    :param index_path: Path, index file to write
+    :param source_format: str, 'selected' for idmapping_selected.tab or 'dat' for
+        idmapping.dat, identified from the file name if None
+    :param chunk_size: int, number of mappings sorted in memory at a time
+    :param tmp_dir: Path, directory for the temporary files, defaults to the directory of index_path
+
+    Return int, number of mappings in the index.
+    """
+    logger = logging.getLogger(__name__)
+
+    if source_format is None:
+        source_format = "dat" if ".dat" in Path(source_path).name else "selected"
+    if source_format not in ("selected", "dat"):
+        raise ValueError(f"Unknown ID mapping file format '{source_format}', expected 'selected' or 'dat'")
+
+    if tmp_dir is None:
+        tmp_dir = Path(index_path).parent
+
+    run_paths = []
+    key_width, value_width = 1, 1
+
+    try:
+        chunk = []
+        for protein_id, uniprot_accession in iter_idmapping_file(source_path, source_format):
+            chunk.append((protein_id, uniprot_accession))
+            if len(chunk) >= chunk_size:
+                widths = write_sorted_run(chunk, tmp_dir, run_paths)
+                key_width, value_width = max(key_width, widths[0]), max(value_width, widths[1])
+                chunk = []
+        if chunk:
+            widths = write_sorted_run(chunk, tmp_dir, run_paths)
+            key_width, value_width = max(key_width, widths[0]), max(value_width, widths[1])
+        del chunk
+
+        count = merge_runs(run_paths, index_path, key_width, value_width)
+
+    finally:
+        for run_path in run_paths:
+            if os.path.isfile(run_path):
+                os.remove(run_path)
+
+    logger.warning(f"Wrote {count} EMBL-CDS to UniProt mappings to {index_path}")
+
+    return count
+
+
+def iter_idmapping_file(source_path, source_format="selected"):
+    """Iterate over the EMBL-CDS protein id to UniProt accession mappings in a UniProt ID mapping file.
+
+    :param source_path: Path, UniProt idmapping_selected.tab.gz or idmapping.dat.gz
+    :param source_format: str, 'selected' or 'dat'
+
+    Yields tuple (EMBL-CDS protein id, UniProt accession).
+    """
+    with open_gzip(source_path, "rt") as handle:
+        for line in tqdm(handle, desc="Reading UniProt ID mapping file", unit=" lines"):
+            if source_format == "dat":
+                fields = line.rstrip("\n").split("\t", 2)
+                if len(fields) == 3 and fields[1] == "EMBL-CDS" and fields[2] != "-":
+                    yield fields[2], fields[0]
+                continue
+
+            fields = line.split("\t", EMBL_CDS_COLUMN + 1)
+            if len(fields) <= EMBL_CDS_COLUMN:
+                continue
+            embl_cds = fields[EMBL_CDS_COLUMN].rstrip("\n")
+            if not embl_cds:
+                continue
+            for protein_id in embl_cds.split("; "):
+                if protein_id and protein_id != "-":
+                    yield protein_id, fields[0]
+
+
+def write_sorted_run(chunk, tmp_dir, run_paths):
+    """Sort a chunk of mappings and write it to a temporary file, for merge_runs().
+
+    :param chunk: list of tuples (protein id, UniProt accession)
+    :param tmp_dir: Path, directory to write the temporary file to
+    :param run_paths: list, the path of the temporary file is appended to it
+
+    Return tuple (longest protein id, longest UniProt accession), in bytes.
+    """
+    chunk.sort()
+
+    fd, run_path = tempfile.mkstemp(suffix=".run", dir=tmp_dir)
+    run_paths.append(run_path)
+
+    with os.fdopen(fd, "w") as fh:
+        fh.write("".join([f"{key}\t{value}\n" for key, value in chunk]))
+
+    return (
+        max(len(key.encode()) for key, _ in chunk),
+        max(len(value.encode()) for _, value in chunk),
+    )
+
+
+def merge_runs(run_paths, index_path, key_width, value_width):
+    """Merge sorted temporary files into the fixed-width index file, removing duplicate mappings.
+
+    :param run_paths: list of Paths, sorted temporary files from write_sorted_run()
+    :param index_path: Path, index file to write
+    :param key_width: int, width of the protein id field in bytes
+    :param value_width: int, width of the UniProt accession field in bytes
+
+    Return int, number of records written.
+    """
+    handles = [open(run_path) for run_path in run_paths]
+    part_path = f"{index_path}.part"
+
+    count = 0
+    try:
+        with open(part_path, "wb") as fh:
+            fh.write(INDEX_HEADER.pack(INDEX_MAGIC, key_width, value_width, 0))
+
+            records, previous = [], None
+            for line in heapq.merge(*handles):
+                if line == previous:
+                    continue
+                previous = line
+
+                key, value = line.rstrip("\n").split("\t", 1)
+                records.append(key.encode().ljust(key_width, b"\0") + value.encode().ljust(value_width, b"\0"))
+                count += 1
+
+                if len(records) >= 100000:
+                    fh.write(b"".join(records))
+                    records = []
+            fh.write(b"".join(records))
+
+            # the number of records is only known once they are written
+            fh.seek(0)
+            fh.write(INDEX_HEADER.pack(INDEX_MAGIC, key_width, value_width, count))
+    finally:
+        for handle in handles:
+            handle.close()
+
+    os.replace(part_path, index_path)
+
+    return count
+
+
+class UniProtMappingIndex:
+    """Look up UniProt accessions in an index built by build_idmapping_index().
+
+    The index file is memory mapped, rather than loaded. Every sample_interval-th protein id
+    is held in memory, so each lookup is a bisect of the samples followed by a short binary
+    search of the mapped records.
+    """
+
+    def __init__(self, index_path, sample_interval=256):
+        """Open the index.
+
+        :param index_path: Path, index file written by build_idmapping_index()
+        :param sample_interval: int, number of records between protein ids held in memory
+        """
+        self.index_path = Path(index_path)
+        self.sample_interval = sample_interval
+
+        self.handle = open(self.index_path, "rb")
+        self.data = mmap.mmap(self.handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.key_width, self.value_width, self.count = INDEX_HEADER.unpack_from(self.data)
+        if magic != INDEX_MAGIC:
+            self.close()
+            raise ValueError(f"{index_path} is not a UniProt mapping index")
+
+        self.record_width = self.key_width + self.value_width
+        self.samples = [self.get_key(i) for i in range(0, self.count, sample_interval)]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        """Close the index file."""
+        self.data.close()
+        self.handle.close()
+
+    def get_key(self, position):
+        """Return bytes, the (padded) protein id of the record at the position."""
+        offset = INDEX_HEADER.size + position * self.record_width
+        return self.data[offset:offset + self.key_width]
+
+    def lookup(self, protein_id):
+        """Retrieve the UniProt accessions of an EMBL-CDS protein id.
+
+        :param protein_id: str, e.g. a GenBank protein accession 'AAA12345.1'
+
+        Return list of str, UniProt accessions, empty if the protein id is not in the index.
+        """
+        key = protein_id.encode()
+        if len(key) > self.key_width or self.count == 0:
+            return []
+        key = key.ljust(self.key_width, b"\0")
+
+        # the first record with the key lies between the samples either side of the key
+        sample = bisect_left(self.samples, key)
+        low = max(0, (sample - 1) * self.sample_interval)
+        high = min(self.count, sample * self.sample_interval + 1)
+
+        # binary search inlined, as lookups of millions of keys are dominated by this loop
+        data, record_width, key_width = self.data, self.record_width, self.key_width
+        start = INDEX_HEADER.size
+        while low < high:
+            middle = (low + high) // 2
+            offset = start + middle * record_width
+            if data[offset:offset + key_width] < key:
+                low = middle + 1
+            else:
+                high = middle
+
+        uniprot_accessions = []
+        offset = start + low * record_width
+        while low < self.count and data[offset:offset + key_width] == key:
+            uniprot_accessions.append(data[offset + key_width:offset + record_width].rstrip(b"\0").decode())
+            low += 1
+            offset += record_width
+
+        return uniprot_accessions
+
+
+def get_uniprot_accessions_offline(genbank_dict, index, multi=False):
+    """Retrieve UniProt accessions for the GenBank accessions from a local index, without any network traffic.
+
+    :param genbank_dict: dict, keyed by GenBank accessions and valued by local CAZyme db record id (int)
+    :param index: UniProtMappingIndex, or Path to an index built by build_idmapping_index()
+    :param multi: bool, keep every GenBank accession mapped to each UniProt accession, see
+        add_uniprot_mapping()
+
+    Return dict of {uniprot_accession: {'gbk_acc': str, 'db_id': int}}, as get_uniprot_accessions()
+    """
+    logger = logging.getLogger(__name__)
+
+    close_index = not isinstance(index, UniProtMappingIndex)
+    if close_index:
+        index = UniProtMappingIndex(index)
+
+    uniprot_gbk_dict = {}  # {uniprot_accession: {'gbk_acc': str, 'db_id': int}}
+
+    try:
+        # looking up the accessions in order keeps the reads of the mapped file sequential
+        for genbank_accession in sorted(genbank_dict):
+            for uniprot_accession in index.lookup(genbank_accession):
+                add_uniprot_mapping(
+                    uniprot_gbk_dict, uniprot_accession, genbank_accession, genbank_dict[genbank_accession], multi,
+                )
+    finally:
+        if close_index:
+            index.close()
+
+    logger.info(
+        f"Retrieved {len(genbank_dict)} gbk accessions from the local db\n"
+        f"{len(list(uniprot_gbk_dict.keys()))} were assoicated with records in UniProt"
+    )
+
+    return uniprot_gbk_dict
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) University of St Andrews 2020-2021
+# (c) University of Strathclyde 2020-2021
+# (c) James Hutton Institute 2020-2021
+#
+# Author:
+# Emma E. M. Hobbs
+#
+# Contact
+# eemh1@st-andrews.ac.uk
+#
+# Emma E. M. Hobbs,
+# Biomolecular Sciences Building,
+# University of St Andrews,
+# North Haugh Campus,
+# St Andrews,
+# KY16 9ST
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Submodule for reading gzip compressed files using the fastest available decompression backend"""
+
+
+import gzip
+import io
+import logging
+import mmap
+import os
+import shutil
+import struct
+import subprocess
+import zlib
+
+try:
+    from isal import igzip
+except ImportError:
+    igzip = None
+
+try:
+    from zlib_ng import gzip_ng
+except ImportError:
+    gzip_ng = None
+
+
+BACKENDS = ("isal", "zlib-ng", "pigz", "gzip")
+BUFFER_SIZE = 1_048_576
+
+# maximum uncompressed bytes per BGZF block, as used by samtools/htslib
+BGZF_BLOCK_SIZE = 65280
+# empty BGZF block marking the end of a BGZF file
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+
+def get_gzip_backend(backend=None):
+    """Retrieve the gzip decompression backend to use.
+
+    The backend can be forced by passing its name or setting the environment variable
+    SAINTBIOUTILS_GZIP_BACKEND. Otherwise the first available backend is used, in order:
+    'isal' (python-isal), 'zlib-ng' (zlib-ng python bindings), 'pigz' (a 'pigz -dc'
+    subprocess) and then 'gzip' (the standard library).
+
+    :param backend: str, name of the backend, None to select automatically
+
+    Raises ValueError if the requested backend is unknown or not available.
+    Return str, name of the backend.
+    """
+    if backend is None:
+        backend = os.environ.get("SAINTBIOUTILS_GZIP_BACKEND")
+
+    available = {
+        "isal": igzip is not None,
+        "zlib-ng": gzip_ng is not None,
+        "pigz": shutil.which("pigz") is not None,
+        "gzip": True,
+    }
+
+    if backend is None:
+        return next(name for name in BACKENDS if available[name])
+
+    if backend not in available:
+        raise ValueError(f"Unknown gzip backend '{backend}', expected one of {BACKENDS}")
+    if not available[backend]:
+        raise ValueError(f"The gzip backend '{backend}' is not installed")
+
+    return backend
+
+
+def open_gzip(path, mode="rt", backend=None, buffer_size=BUFFER_SIZE, encoding="utf-8"):
+    """Open a gzip compressed file for reading, with a large read buffer.
+
+    :param path: Path to the gzip compressed file
+    :param mode: str, 'rt' for text or 'rb' for binary
+    :param backend: str, name of the decompression backend, see get_gzip_backend()
+    :param buffer_size: int, size of the read buffer in bytes
+    :param encoding: str, text encoding, used in text mode
+
+    Return file handle.
+    """
+    logger = logging.getLogger(__name__)
+
+    if mode not in ("rt", "rb"):
+        raise ValueError(f"Unsupported mode '{mode}', expected 'rt' or 'rb'")
+
+    backend = get_gzip_backend(backend)
+    logger.debug(f"Opening {path} using the '{backend}' gzip backend")
+
+    if backend == "isal":
+        raw = igzip.open(path, "rb")
+    elif backend == "zlib-ng":
+        raw = gzip_ng.open(path, "rb")
+    elif backend == "pigz":
+        raw = PigzReader(path, buffer_size)
+    else:
+        raw = gzip.open(path, "rb")
+
+    handle = io.BufferedReader(raw, buffer_size=buffer_size)
+
+    if mode == "rb":
+        return handle
+
+    return io.TextIOWrapper(handle, encoding=encoding)
+
+
+class PigzReader(io.RawIOBase):
+    """Readable stream of the output of a 'pigz -dc' subprocess."""
+
+    def __init__(self, path, buffer_size=BUFFER_SIZE):
+        self.path = path
+        self.process = subprocess.Popen(
+            ["pigz", "-dc", str(path)],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            bufsize=buffer_size,
+        )
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.process.stdout.read1(len(buffer))
+        if not data:
+            self.check_exit()
+        buffer[:len(data)] = data
+        return len(data)
+
+    def check_exit(self):
+        """Raise OSError if pigz exited with an error."""
+        return_code = self.process.wait()
+        if return_code != 0:
+            stderr = self.process.stderr.read().decode(errors="replace").strip()
+            raise OSError(f"pigz failed to decompress {self.path} (exit code {return_code}): {stderr}")
+
+    def close(self):
+        if not self.closed:
+            if self.process.poll() is None:
+                self.process.kill()
+            self.process.stdout.close()
+            self.process.stderr.close()
+            self.process.wait()
+        super().close()
+
+
+class BgzfWriter:
+    """Write BGZF (blocked gzip) compressed files, which are valid gzip files that support random access.
+
+    The compressed and uncompressed offsets of the start of each block are recorded in
+    block_offsets, e.g. for writing a .gzi index.
+    """
+
+    def __init__(self, path, mode="wb", compresslevel=6, uncompressed_offset=0):
+        """Open the BGZF file for writing.
+
+        :param path: Path to the output file
+        :param mode: str, 'wb' to write a new file or 'ab' to append to an existing BGZF file
+        :param compresslevel: int, zlib compression level
+        :param uncompressed_offset: int, uncompressed size of the existing file when appending,
+            used as the starting uncompressed offset in block_offsets
+        """
+        if mode not in ("wb", "ab"):
+            raise ValueError(f"Unsupported mode '{mode}', expected 'wb' or 'ab'")
+
+        self.handle = open(path, mode)
+        self.compresslevel = compresslevel
+        self.buffer = bytearray()
+        self.compressed_offset = self.handle.tell()
+        self.uncompressed_offset = uncompressed_offset
+        self.block_offsets = []  # [(compressed offset, uncompressed offset)]
+
+    def write(self, data):
+        """Write bytes to the file.
+
+        :param data: bytes
+
+        Return nothing.
+        """
+        self.buffer += data
+        while len(self.buffer) >= BGZF_BLOCK_SIZE:
+            self.write_block(bytes(self.buffer[:BGZF_BLOCK_SIZE]))
+            del self.buffer[:BGZF_BLOCK_SIZE]
+
+    def write_block(self, data):
+        """Compress and write a single BGZF block.
+
+        :param data: bytes, at most BGZF_BLOCK_SIZE bytes
+
+        Return nothing.
+        """
+        compressor = zlib.compressobj(self.compresslevel, zlib.DEFLATED, -15)
+        compressed = compressor.compress(data) + compressor.flush()
+
+        # header with the BC extra subfield giving the total block size minus one
+        header = struct.pack(
+            "<4BI2BH2BHH",
+            0x1F, 0x8B, 8, 4, 0, 0, 0xFF, 6, ord("B"), ord("C"), 2, len(compressed) + 25,
+        )
+        trailer = struct.pack("<II", zlib.crc32(data), len(data))
+
+        self.block_offsets.append((self.compressed_offset, self.uncompressed_offset))
+        self.handle.write(header + compressed + trailer)
+
+        self.compressed_offset += len(header) + len(compressed) + len(trailer)
+        self.uncompressed_offset += len(data)
+
+    def flush(self):
+        """Write any buffered data as a (possibly short) block.
+
+        Return nothing.
+        """
+        if self.buffer:
+            self.write_block(bytes(self.buffer))
+            self.buffer.clear()
+        self.handle.flush()
+
+    def fileno(self):
+        """Return int, file descriptor of the underlying file."""
+        return self.handle.fileno()
+
+    def close(self):
+        """Flush buffered data, write the BGZF end-of-file marker and close the file.
+
+        Return nothing.
+        """
+        if self.handle.closed:
+            return
+        self.flush()
+        self.handle.write(BGZF_EOF)
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_bgzf_blocks(handle, start=0):
+    """Iterate over the blocks of a BGZF file.
+
+    :param handle: binary file handle, or a bytes-like object such as an mmap
+    :param start: int, compressed offset of the first block to read
+
+    Yields tuple (compressed offset of the block, decompressed data of the block).
+    """
+    if isinstance(handle, (bytes, bytearray, memoryview, mmap.mmap)):
+        data, offset = handle, start
+        read = lambda position, size: data[position:position + size]
+    else:
+        offset = start
+        def read(position, size):
+            handle.seek(position)
+            return handle.read(size)
+
+    while True:
+        header = read(offset, 18)
+        if len(header) < 18:
+            return
+        if header[:4] != b"\x1f\x8b\x08\x04" or header[12:14] != b"BC":
+            raise ValueError(f"Not a BGZF block at offset {offset}")
+
+        block_size = struct.unpack("<H", header[16:18])[0] + 1
+        block = read(offset, block_size)
+        yield offset, zlib.decompress(block[18:-8], -15)
+        offset += block_size
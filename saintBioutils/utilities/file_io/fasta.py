@@ -0,0 +1,464 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) University of St Andrews 2020-2021
+# (c) University of Strathclyde 2020-2021
+# (c) James Hutton Institute 2020-2021
+#
+# Author:
+# Emma E. M. Hobbs
+#
+# Contact
+# eemh1@st-andrews.ac.uk
+#
+# Emma E. M. Hobbs,
+# Biomolecular Sciences Building,
+# University of St Andrews,
+# North Haugh Campus,
+# St Andrews,
+# KY16 9ST
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Submodule for writing FASTA files, and indexing them for random access"""
+
+
+import gzip
+import mmap
+import os
+import struct
+
+from bisect import bisect_right
+
+from saintBioutils.utilities.file_io.compression import BUFFER_SIZE, BgzfWriter, read_bgzf_blocks
+
+
+COMPRESSIONS = (None, "gzip", "bgzf")
+
+
+class FastaWriter:
+    """Buffered FASTA writer, with optional gzip or BGZF compressed output.
+
+    Records are collected in memory and written out in large blocks, rather than with one
+    small write per record.
+    """
+
+    def __init__(
+        self,
+        path,
+        mode="w",
+        compression=None,
+        line_length=60,
+        buffer_size=BUFFER_SIZE,
+        compresslevel=6,
+        index=False,
+    ):
+        """Open the FASTA file for writing.
+
+        :param path: Path to the output FASTA file
+        :param mode: str, 'w' to write a new file, or 'a' to append to an existing file
+        :param compression: str, None for plain text, 'gzip' or 'bgzf'
+        :param line_length: int, number of sequence characters per line, 0 to not wrap sequences
+        :param buffer_size: int, number of bytes buffered before writing to the file
+        :param compresslevel: int, compression level used for gzip and BGZF output
+        :param index: bool, write a samtools faidx compatible index (.fai), and for BGZF output
+            a .gzi index, alongside the FASTA file
+
+        When appending to an indexed FASTA file, new records are added to the existing index.
+        If the file to append to is not yet indexed, it is indexed before writing. Otherwise
+        any existing index of the file is removed, as it would no longer match the file.
+        """
+        if mode not in ("w", "a"):
+            raise ValueError(f"Unsupported mode '{mode}', expected 'w' or 'a'")
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown compression '{compression}', expected one of {COMPRESSIONS}")
+        if index and compression == "gzip":
+            raise ValueError("Only plain text and BGZF compressed FASTA files can be indexed")
+
+        self.path = path
+        self.compression = compression
+        self.line_length = line_length
+        self.buffer_size = buffer_size
+        self.index = index
+
+        # uncompressed offset of the end of the file, and the index entries of new records
+        self.offset = 0
+        self.fai_entries = []
+        self.gzi_entries = []
+
+        appending = mode == "a" and os.path.isfile(path) and os.path.getsize(path) > 0
+        self.appending = appending
+        if index and appending:
+            if not os.path.isfile(f"{path}.fai"):
+                index_fasta(path)
+            if compression == "bgzf":
+                self.gzi_entries = read_gzi(f"{path}.gzi")
+                self.offset = get_bgzf_size(path, self.gzi_entries)
+            else:
+                self.offset = os.path.getsize(path)
+        else:
+            for index_path in (f"{path}.fai", f"{path}.gzi"):
+                if os.path.isfile(index_path):
+                    os.remove(index_path)
+
+        if compression == "gzip":
+            self.handle = gzip.open(path, f"{mode}b", compresslevel=compresslevel)
+        elif compression == "bgzf":
+            self.handle = BgzfWriter(
+                path, f"{mode}b", compresslevel=compresslevel, uncompressed_offset=self.offset,
+            )
+        else:
+            self.handle = open(path, f"{mode}b")
+
+        self.buffer = []
+        self.buffered = 0
+        self.record_count = 0
+        self.closed = False
+
+    def write(self, header, seq):
+        """Add a record to the FASTA file.
+
+        :param header: str, FASTA header, without the leading '>'
+        :param seq: str, sequence
+
+        Return nothing.
+        """
+        record = f">{header}\n{self.wrap(seq)}\n".encode()
+
+        if self.index:
+            name = header.split(maxsplit=1)[0] if header.strip() else ""
+            linebases = len(seq) if self.line_length <= 0 else min(len(seq), self.line_length)
+            self.fai_entries.append((
+                name,
+                len(seq),
+                self.offset + len(header.encode()) + 2,  # '>' and the newline
+                linebases,
+                linebases + 1 if linebases else 0,
+            ))
+            self.offset += len(record)
+
+        self.buffer.append(record)
+        self.buffered += len(record)
+        self.record_count += 1
+
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def wrap(self, seq):
+        """Split the sequence over lines of line_length characters.
+
+        Sequences that fit on one line are returned as is. Longer sequences are wrapped with a
+        single join over the line slices, which is faster in CPython than adding each line to
+        the write buffer separately.
+
+        :param seq: str, sequence
+
+        Return str.
+        """
+        width = self.line_length
+        if width <= 0 or len(seq) <= width:
+            return seq
+        return "\n".join([seq[i : i + width] for i in range(0, len(seq), width)])
+
+    def flush(self):
+        """Write all buffered records to the file.
+
+        Return nothing.
+        """
+        if self.buffer:
+            self.handle.write(b"".join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+
+    def sync(self):
+        """Write all buffered records through to disk, ending the current gzip or BGZF block.
+
+        Return nothing.
+        """
+        self.flush()
+        self.handle.flush()
+        os.fsync(self.handle.fileno())
+
+    def close(self):
+        """Write all buffered records and close the file.
+
+        Return nothing.
+        """
+        if self.closed:
+            return
+        self.flush()
+        self.handle.close()
+        self.closed = True
+
+        if self.index:
+            with open(f"{self.path}.fai", "a" if self.appending else "w") as fh:
+                fh.write("".join(["\t".join(map(str, entry)) + "\n" for entry in self.fai_entries]))
+            self.fai_entries = []
+
+            if self.compression == "bgzf":
+                write_gzi(f"{self.path}.gzi", self.gzi_entries + self.handle.block_offsets)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class FastaIndex:
+    """Random access to the sequences in a FASTA file indexed by FastaWriter or index_fasta().
+
+    Plain text FASTA files are memory mapped, so a sequence is retrieved by slicing the
+    mapped file at the offset given in the .fai index. For BGZF compressed files the .gzi
+    index gives the block containing the sequence, and only the blocks spanning the
+    sequence are decompressed.
+    """
+
+    def __init__(self, fasta_path):
+        """Load the index of the FASTA file.
+
+        :param fasta_path: Path to the FASTA file, the .fai (and .gzi) index must be alongside it
+        """
+        self.path = fasta_path
+        self.compression = get_fasta_compression(fasta_path)
+        if self.compression == "gzip":
+            raise ValueError(f"{fasta_path} is gzip but not BGZF compressed, so cannot be indexed")
+
+        self.entries = read_fai(f"{fasta_path}.fai")
+
+        if self.compression == "bgzf":
+            gzi_entries = [(0, 0)] + read_gzi(f"{fasta_path}.gzi")
+            self.compressed_offsets = [entry[0] for entry in gzi_entries]
+            self.uncompressed_offsets = [entry[1] for entry in gzi_entries]
+
+        self.handle = open(fasta_path, "rb")
+        if os.fstat(self.handle.fileno()).st_size:
+            self.data = mmap.mmap(self.handle.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.data = b""
+
+    def fetch(self, name):
+        """Retrieve a sequence from the FASTA file.
+
+        :param name: str, sequence name, i.e. the first word of the FASTA header
+
+        Return str, sequence. Raises KeyError if the name is not in the index.
+        """
+        length, offset, linebases, linewidth = self.entries[name]
+        if length == 0:
+            return ""
+
+        lines, remainder = divmod(length, linebases)
+        raw = self.read(offset, lines * linewidth + remainder)
+
+        return raw.replace(b"\n", b"").replace(b"\r", b"").decode()
+
+    def read(self, offset, size):
+        """Read bytes from the uncompressed FASTA file.
+
+        :param offset: int, uncompressed offset to start reading from
+        :param size: int, number of bytes to read
+
+        Return bytes.
+        """
+        if self.compression is None:
+            return self.data[offset:offset + size]
+
+        i = bisect_right(self.uncompressed_offsets, offset) - 1
+        skip = offset - self.uncompressed_offsets[i]
+
+        chunks, read_size = [], 0
+        for _, block in read_bgzf_blocks(self.data, self.compressed_offsets[i]):
+            chunks.append(block)
+            read_size += len(block)
+            if read_size >= skip + size:
+                break
+
+        return b"".join(chunks)[skip:skip + size]
+
+    def close(self):
+        """Close the FASTA file.
+
+        Return nothing.
+        """
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.handle.close()
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def get_fasta_compression(fasta_path):
+    """Identify the compression of a FASTA file from its first bytes.
+
+    :param fasta_path: Path to the FASTA file
+
+    Return None for plain text, 'gzip' or 'bgzf'.
+    """
+    with open(fasta_path, "rb") as fh:
+        header = fh.read(18)
+
+    if header[:2] != b"\x1f\x8b":
+        return None
+    if len(header) == 18 and header[3] & 4 and header[12:14] == b"BC":
+        return "bgzf"
+    return "gzip"
+
+
+def index_fasta(fasta_path):
+    """Write the .fai (and for BGZF compressed files the .gzi) index of an existing FASTA file.
+
+    :param fasta_path: Path to a plain text or BGZF compressed FASTA file
+
+    Return list of .fai entries, tuples (name, length, offset, linebases, linewidth).
+    """
+    compression = get_fasta_compression(fasta_path)
+    if compression == "gzip":
+        raise ValueError(f"{fasta_path} is gzip but not BGZF compressed, so cannot be indexed")
+
+    gzi_entries = []
+
+    def iter_blocks(handle):
+        uncompressed_offset = 0
+        for compressed_offset, block in read_bgzf_blocks(handle):
+            if block:
+                gzi_entries.append((compressed_offset, uncompressed_offset))
+                uncompressed_offset += len(block)
+            yield block
+
+    with open(fasta_path, "rb") as fh:
+        lines = fh if compression is None else iter_lines(iter_blocks(fh))
+
+        fai_entries, entry, offset = [], None, 0
+        for line in lines:
+            if line.startswith(b">"):
+                if entry is not None:
+                    fai_entries.append(tuple(entry))
+                words = line[1:].split(maxsplit=1)
+                entry = [words[0].decode() if words else "", 0, offset + len(line), 0, 0]
+            elif entry is not None:
+                bases = len(line.rstrip(b"\r\n"))
+                if bases and entry[3] == 0:
+                    entry[3], entry[4] = bases, len(line)
+                entry[1] += bases
+            offset += len(line)
+
+        if entry is not None:
+            fai_entries.append(tuple(entry))
+
+    with open(f"{fasta_path}.fai", "w") as fh:
+        fh.write("".join(["\t".join(map(str, entry)) + "\n" for entry in fai_entries]))
+    if compression == "bgzf":
+        write_gzi(f"{fasta_path}.gzi", gzi_entries)
+
+    return fai_entries
+
+
+def iter_lines(chunks):
+    """Split a stream of byte chunks into lines.
+
+    :param chunks: iterable of bytes
+
+    Yields bytes, each line including its newline.
+    """
+    pending = b""
+    for chunk in chunks:
+        lines = (pending + chunk).split(b"\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line + b"\n"
+    if pending:
+        yield pending
+
+
+def read_fai(fai_path):
+    """Parse a .fai index.
+
+    :param fai_path: Path to the .fai file
+
+    Return dict {name: (length, offset, linebases, linewidth)}.
+    """
+    entries = {}
+    with open(fai_path) as fh:
+        for line in fh:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) >= 5:
+                entries[fields[0]] = tuple(int(field) for field in fields[1:5])
+    return entries
+
+
+def read_gzi(gzi_path):
+    """Parse a .gzi index of a BGZF file.
+
+    :param gzi_path: Path to the .gzi file
+
+    Return list of tuples (compressed offset, uncompressed offset) of the blocks after the first.
+    """
+    with open(gzi_path, "rb") as fh:
+        data = fh.read()
+    if not data:
+        return []
+
+    count = struct.unpack_from("<Q", data)[0]
+    return list(struct.iter_unpack("<QQ", data[8:8 + 16 * count]))
+
+
+def write_gzi(gzi_path, block_offsets):
+    """Write the .gzi index of a BGZF file, in the format used by samtools/htslib.
+
+    :param gzi_path: Path to the .gzi file
+    :param block_offsets: list of tuples (compressed offset, uncompressed offset) of each block
+
+    Return nothing.
+    """
+    # htslib does not store the first block, which is always at offset (0, 0)
+    block_offsets = [offsets for offsets in block_offsets if offsets != (0, 0)]
+
+    with open(gzi_path, "wb") as fh:
+        fh.write(struct.pack("<Q", len(block_offsets)))
+        fh.write(b"".join([struct.pack("<QQ", *offsets) for offsets in block_offsets]))
+
+
+def get_bgzf_size(bgzf_path, gzi_entries):
+    """Retrieve the uncompressed size of a BGZF file, decompressing only the blocks after the last .gzi entry.
+
+    :param bgzf_path: Path to the BGZF file
+    :param gzi_entries: list of tuples (compressed offset, uncompressed offset), from read_gzi()
+
+    Return int.
+    """
+    compressed_offset, size = gzi_entries[-1] if gzi_entries else (0, 0)
+
+    with open(bgzf_path, "rb") as fh:
+        for _, block in read_bgzf_blocks(fh, compressed_offset):
+            size += len(block)
+
+    return size
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) University of St Andrews 2020-2021
+# (c) University of Strathclyde 2020-2021
+# (c) James Hutton Institute 2020-2021
+#
+# Author:
+# Emma E. M. Hobbs
+#
+# Contact
+# eemh1@st-andrews.ac.uk
+#
+# Emma E. M. Hobbs,
+# Biomolecular Sciences Building,
+# University of St Andrews,
+# North Haugh Campus,
+# St Andrews,
+# KY16 9ST
+# Scotland,
+# UK
+#
+# The MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Helpers shared by the SQLite-backed caches, manifests and checkpoints"""
+
+
+import hashlib
+import sqlite3
+import threading
+
+from pathlib import Path
+
+
+BUFFER_SIZE = 1_048_576
+
+
+class SQLiteStore:
+    """SQLite database file holding the entries of a cache, manifest or checkpoint.
+
+    The tables listed in the class attribute 'tables' are created when the database is
+    opened. The connection is shared between threads, and every use of it is guarded by
+    self.lock, so a store is safe to share between threads.
+    """
+
+    tables = ()  # CREATE TABLE IF NOT EXISTS statements
+
+    def __init__(self, db_path, pragmas=()):
+        """Open (and create if needed) the database.
+
+        :param db_path: Path, path to the SQLite database file
+        :param pragmas: iterable of str, PRAGMA statements run when the database is opened
+        """
+        self.db_path = Path(db_path)
+        self.lock = threading.Lock()
+
+        self.connection = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        with self.lock, self.connection:
+            for statement in list(pragmas) + list(self.tables):
+                self.connection.execute(statement)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Close the connection to the database."""
+        with self.lock:
+            self.connection.close()
+
+    def fetch_entries(self, query, params=(), paths=()):
+        """Run a SELECT query and convert the rows into dicts keyed by column name.
+
+        :param query: str, SQL SELECT statement
+        :param params: tuple, parameters of the query
+        :param paths: iterable of str, names of columns holding file paths, converted to Path
+
+        Return list of dicts.
+        """
+        with self.lock:
+            cursor = self.connection.execute(query, params)
+            columns = [column[0] for column in cursor.description]
+            rows = cursor.fetchall()
+
+        entries = [dict(zip(columns, row)) for row in rows]
+        for entry in entries:
+            for column in paths:
+                entry[column] = Path(entry[column])
+
+        return entries
+
+
+def hash_file(path, hasher):
+    """Update a hash with the contents of a file, read in 1 MiB blocks.
+
+    :param path: Path to the file
+    :param hasher: hashlib hash object, e.g. hashlib.md5()
+
+    Return the hash object.
+    """
+    with open(path, "rb") as fh:
+        while True:
+            buffer = fh.read(BUFFER_SIZE)
+            if not buffer:
+                break
+            hasher.update(buffer)
+
+    return hasher
+
+
+def get_file_md5(path):
+    """Calculate the MD5 checksum of a file.
+
+    :param path: Path to the file
+
+    Return str, MD5 hex digest.
+    """
+    return hash_file(path, hashlib.md5()).hexdigest()